@@ -0,0 +1,315 @@
+"""Control de admisión por proveedor de IA.
+
+Cada proveedor de config['ai_models']['providers'] tiene un token bucket
+(peticiones por minuto) y un máximo de llamadas en curso. Las peticiones que
+no caben esperan su turno hasta su deadline (el de la petición o el del
+trabajo de la cola que la lanzó) en lugar de llegar al proveedor y volver
+como un 429. El deadline solo cubre esa espera: una vez admitida, la
+llamada dura lo que tarde el SDK del proveedor (el timeout de los trabajos
+lo pone la cola). Si el proveedor responde que está limitado, su bucket se pausa
+unos segundos para todas las sesiones.
+
+Si el proveedor tiene un "fallback" configurado (otro proveedor y/o modelo,
+p. ej. un Ollama local), la petición pasa a él cuando el primario no la
+admite a tiempo, responde con límite de uso o agota el tiempo.
+
+Ajustes opcionales por proveedor en config.json:
+    "rate_per_minute": 60, "burst": 10, "max_in_flight": 8,
+    "max_queue_seconds": 10, "fallback": {"provider": "ollama", "model": "llama3"}
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Límites por defecto si config.json no los indica (0 = sin límite de ritmo)
+DEFAULT_LIMITS = {
+    "gemini": {"rate_per_minute": 60, "max_in_flight": 8},
+    "openai": {"rate_per_minute": 500, "max_in_flight": 16},
+    "mistral": {"rate_per_minute": 60, "max_in_flight": 8},
+    "ollama": {"rate_per_minute": 0, "max_in_flight": 2},
+}
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_DEADLINE_SECONDS = 120
+# Espera máxima en cola antes de pasar al fallback (si lo hay)
+DEFAULT_MAX_QUEUE_SECONDS = 10
+# Pausa del bucket tras un 429 del proveedor
+THROTTLE_PAUSE_SECONDS = 20
+LATENCY_SAMPLES = 500
+
+THROTTLE_MARKERS = ("429", "rate limit", "rate_limit", "quota", "resource_exhausted", "too many requests")
+TIMEOUT_MARKERS = ("timed out", "timeout", "deadline")
+
+
+class CallCancelled(Exception):
+    # El trabajo que pidió la llamada se ha cancelado o ha agotado su tiempo
+    pass
+
+
+class ProviderSaturated(Exception):
+    def __init__(self, provider):
+        super().__init__(f"El proveedor {provider} está saturado; inténtalo de nuevo en unos segundos")
+        self.provider = provider
+
+
+def _error_text(result):
+    # Texto del error si result es una respuesta de error del tutor
+    if isinstance(result, dict) and result.get("status") == "error":
+        return str(result.get("error") or result.get("answer") or result.get("message") or "")
+    return None
+
+
+def is_throttled(text):
+    text = (text or "").lower()
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+
+def is_timeout(error):
+    if isinstance(error, TimeoutError):
+        return True
+    text = str(error).lower()
+    return any(marker in text for marker in TIMEOUT_MARKERS)
+
+
+class ProviderGate:
+    def __init__(self, provider, rate_per_minute=0, burst=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 max_queue_seconds=DEFAULT_MAX_QUEUE_SECONDS):
+        self.provider = provider
+        self._cond = threading.Condition()
+        self.configure(rate_per_minute, burst, max_in_flight, max_queue_seconds)
+        self.tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.timeouts = 0
+        self.failovers = 0
+        self._waits = deque(maxlen=LATENCY_SAMPLES)
+
+    def configure(self, rate_per_minute=0, burst=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                  max_queue_seconds=DEFAULT_MAX_QUEUE_SECONDS):
+        # Se puede llamar en caliente al cambiar config.json
+        with self._cond:
+            self.limits = (rate_per_minute, burst, max_in_flight, max_queue_seconds)
+            self.rate_per_minute = float(rate_per_minute or 0)
+            # Por defecto se permite una ráfaga de un sexto del ritmo por minuto
+            self.burst = max(1, int(burst or self.rate_per_minute // 6 or 1))
+            self.max_in_flight = int(max_in_flight or 0)
+            self.max_queue_seconds = float(max_queue_seconds)
+            self._cond.notify_all()
+
+    def _refill(self, now):
+        if self.rate_per_minute > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self._refilled) * self.rate_per_minute / 60)
+        self._refilled = now
+
+    def acquire(self, deadline, cancelled=None):
+        # Espera un hueco y un token hasta deadline (time.monotonic); False si no llega a tiempo
+        # o si cancelled() se cumple mientras espera (se comprueba cada medio segundo)
+        start = time.monotonic()
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = None
+                    if self.max_in_flight <= 0 or self.in_flight < self.max_in_flight:
+                        # La pausa por 429 vale también para los proveedores sin límite de ritmo
+                        if now < self.paused_until:
+                            if self.paused_until >= deadline:
+                                # La pausa dura más que el plazo: no tiene sentido esperar
+                                self.rejected += 1
+                                return False
+                            wait = self.paused_until - now
+                        elif self.rate_per_minute <= 0:
+                            break
+                        elif self.tokens >= 1:
+                            self.tokens -= 1
+                            break
+                        else:
+                            wait = (1 - self.tokens) * 60 / self.rate_per_minute
+                    remaining = deadline - now
+                    if remaining <= 0 or (cancelled is not None and cancelled()):
+                        self.rejected += 1
+                        return False
+                    if cancelled is not None:
+                        remaining = min(remaining, 0.5)
+                    self._cond.wait(min(remaining, wait) if wait is not None else remaining)
+                self.in_flight += 1
+                self.admitted += 1
+                self._waits.append(time.monotonic() - start)
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def penalize(self, seconds=THROTTLE_PAUSE_SECONDS):
+        # El proveedor ha devuelto un 429: nadie más sale hasta que pase la pausa
+        with self._cond:
+            self.throttled += 1
+            self.tokens = 0.0
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._waits)
+            paused = max(0.0, self.paused_until - time.monotonic())
+            return {
+                "rate_per_minute": self.rate_per_minute,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "saturation": round(self.in_flight / self.max_in_flight, 2) if self.max_in_flight > 0 else 0.0,
+                "tokens": round(self.tokens, 1),
+                "paused_seconds": round(paused, 1),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "throttled": self.throttled,
+                "timeouts": self.timeouts,
+                "failovers": self.failovers,
+                "wait_p50": waits[len(waits) // 2] if waits else None,
+                "wait_p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else None,
+            }
+
+
+_gates = {}
+_gates_lock = threading.Lock()
+
+
+def _provider_settings(provider):
+    try:
+        from config_store import load_config
+        settings = load_config().get("ai_models", {}).get("providers", {}).get(provider, {})
+    except (OSError, ValueError):
+        settings = {}
+    return dict(DEFAULT_LIMITS.get(provider, {}), **settings)
+
+
+def get_gate(provider):
+    settings = _provider_settings(provider)
+    limits = (
+        settings.get("rate_per_minute", 0),
+        settings.get("burst"),
+        settings.get("max_in_flight", DEFAULT_MAX_IN_FLIGHT),
+        settings.get("max_queue_seconds", DEFAULT_MAX_QUEUE_SECONDS),
+    )
+    with _gates_lock:
+        gate = _gates.get(provider)
+        if gate is None:
+            gate = _gates[provider] = ProviderGate(provider, *limits)
+        elif gate.limits != limits:
+            gate.configure(*limits)
+    return gate
+
+
+def route(provider, model_name):
+    # Primario y, si está configurado, su fallback
+    targets = [(provider, model_name)]
+    fallback = _provider_settings(provider).get("fallback")
+    if fallback:
+        target = (fallback.get("provider", provider), fallback.get("model", model_name))
+        if target != targets[0]:
+            targets.append(target)
+    return targets
+
+
+def failover_targets(provider, model_name):
+    # Destinos de respaldo a los que iría ahora mismo una llamada (primario pausado por un 429)
+    targets = route(provider, model_name)
+    if len(targets) < 2 or get_gate(provider).paused_until <= time.monotonic():
+        return []
+    return targets[1:]
+
+
+def _note_failure(gate, error):
+    # Devuelve True si el error justifica pasar al fallback
+    if is_throttled(str(error)):
+        gate.penalize()
+        return True
+    if is_timeout(error):
+        gate.timeouts += 1
+        return True
+    return False
+
+
+def _check(cancelled):
+    if cancelled is not None and cancelled():
+        raise CallCancelled("Llamada cancelada")
+
+
+def _enter(targets, deadline, cancelled=None):
+    # Turno en el primer destino que lo dé a tiempo; devuelve (índice, gate)
+    for n, (target_provider, _) in enumerate(targets):
+        gate = get_gate(target_provider)
+        has_fallback = n + 1 < len(targets)
+        budget = min(deadline, time.monotonic() + gate.max_queue_seconds) if has_fallback else deadline
+        # Pausado por un 429 más allá del plazo: se pasa directamente al siguiente destino
+        if gate.paused_until < budget and gate.acquire(budget, cancelled):
+            return n, gate
+        _check(cancelled)
+        if not has_fallback:
+            raise ProviderSaturated(target_provider)
+        gate.failovers += 1
+
+
+@contextmanager
+def admit(provider, model_name, deadline=None):
+    # Mantiene el turno mientras dura el bloque (streaming); cede (proveedor, modelo) admitido
+    if deadline is None:
+        deadline = time.monotonic() + DEFAULT_DEADLINE_SECONDS
+    targets = route(provider, model_name)
+    n, gate = _enter(targets, deadline)
+    try:
+        yield targets[n]
+    except Exception as e:
+        _note_failure(gate, e)
+        raise
+    finally:
+        gate.release()
+
+
+def call_with_admission(provider, model_name, call, deadline=None, cancelled=None):
+    # call(proveedor, modelo) hace la llamada real; deadline en time.monotonic().
+    # cancelled(): si se cumple, no se espera turno ni se lanza la llamada (CallCancelled).
+    # Devuelve (resultado, (proveedor, modelo) que lo ha servido)
+    if deadline is None:
+        deadline = time.monotonic() + DEFAULT_DEADLINE_SECONDS
+    targets = route(provider, model_name)
+    while targets:
+        _check(cancelled)
+        n, gate = _enter(targets, deadline, cancelled)
+        has_fallback = n + 1 < len(targets)
+        try:
+            _check(cancelled)
+            result = call(*targets[n])
+        except CallCancelled:
+            raise
+        except Exception as e:
+            if not _note_failure(gate, e) or not has_fallback:
+                raise
+            gate.failovers += 1
+            targets = targets[n + 1:]
+            continue
+        finally:
+            gate.release()
+        if is_throttled(_error_text(result)):
+            gate.penalize()
+            if has_fallback:
+                gate.failovers += 1
+                targets = targets[n + 1:]
+                continue
+        return result, targets[n]
+
+
+def admission_stats():
+    with _gates_lock:
+        gates = dict(_gates)
+    return {provider: gate.stats() for provider, gate in sorted(gates.items())}
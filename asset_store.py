@@ -0,0 +1,105 @@
+"""Almacén de imágenes direccionado por contenido (avatares, imágenes del tema).
+
+Cada imagen se guarda una sola vez bajo static/assets/ con el hash de su
+contenido como identificador, junto con miniaturas generadas al subirla.
+Streamlit sirve esa carpeta como estática (server.enableStaticServing) y,
+al llevar ?v=<id> en la URL, el navegador puede cachearlas indefinidamente:
+un contenido distinto siempre tiene un identificador distinto.
+"""
+import hashlib
+import io
+import os
+from pathlib import Path
+
+APP_DIR = Path(__file__).parent
+ASSET_DIR = APP_DIR / "static" / "assets"
+STATIC_URL = "app/static/assets"
+THUMB_SIZES = (128, 512)
+
+_thumb_ext = {}
+
+
+def _data(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if hasattr(source, "getvalue"):
+        return source.getvalue()
+    return source.read()
+
+
+def _write_atomic(path, payload):
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(payload)
+    os.replace(tmp, path)
+
+
+def save_image(source):
+    # Devuelve el id del asset; si ya existía no se reescribe nada
+    from PIL import Image
+
+    data = _data(source)
+    asset_id = hashlib.sha256(data).hexdigest()[:32]
+    ASSET_DIR.mkdir(parents=True, exist_ok=True)
+    if find_original(asset_id):
+        return asset_id
+
+    # Ficheros corruptos o que no son imágenes: PIL.UnidentifiedImageError / OSError para quien llama
+    Image.open(io.BytesIO(data)).verify()
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    ext = (img.format or "png").lower().replace("jpeg", "jpg")
+    for size in THUMB_SIZES:
+        thumb = img.copy()
+        thumb.thumbnail((size, size))
+        if thumb.mode not in ("RGB", "RGBA"):
+            thumb = thumb.convert("RGBA")
+        buf = io.BytesIO()
+        try:
+            thumb.save(buf, format="WEBP", quality=85, method=4)
+            thumb_ext = "webp"
+        except (OSError, KeyError, ValueError):
+            # Pillow compilado sin soporte WebP
+            buf = io.BytesIO()
+            thumb.save(buf, format="PNG", optimize=True)
+            thumb_ext = "png"
+        _write_atomic(ASSET_DIR / f"{asset_id}_{size}.{thumb_ext}", buf.getvalue())
+    # El original se escribe al final: su presencia marca el asset como completo
+    _write_atomic(ASSET_DIR / f"{asset_id}.{ext}", data)
+    return asset_id
+
+
+def find_original(asset_id):
+    for path in ASSET_DIR.glob(f"{asset_id}.*"):
+        if not path.name.endswith(".tmp"):
+            return path
+    return None
+
+
+def _thumb_name(asset_id, size):
+    key = (asset_id, size)
+    if key not in _thumb_ext:
+        for ext in ("webp", "png"):
+            if (ASSET_DIR / f"{asset_id}_{size}.{ext}").exists():
+                _thumb_ext[key] = ext
+                break
+        else:
+            return None
+    return f"{asset_id}_{size}.{_thumb_ext[key]}"
+
+
+def asset_path(asset_id, size=None):
+    # Ruta relativa al directorio de la app (como el resto de rutas de config.json)
+    if size:
+        name = _thumb_name(asset_id, size)
+        path = ASSET_DIR / name if name else None
+    else:
+        path = find_original(asset_id)
+    return path.relative_to(APP_DIR).as_posix() if path else None
+
+
+def asset_url(asset_id, size=128):
+    name = _thumb_name(asset_id, size)
+    if name is None:
+        return None
+    return f"{STATIC_URL}/{name}?v={asset_id}"
@@ -0,0 +1,225 @@
+"""Seguridad del login: hashes de contraseña, tokens de sesión y throttling.
+
+Las contraseñas se guardan como PBKDF2-SHA256 con sal y un coste ajustable
+(AUTH_HASH_ITERATIONS). Las antiguas en texto plano siguen siendo válidas y
+se rehashean en el primer login correcto.
+
+Tras el login se emite un token firmado (HMAC) con el id del usuario y su
+caducidad; al recargar la página basta con verificar la firma y leer la
+fila del usuario, sin volver a comprobar la contraseña.
+
+Los intentos fallidos se cuentan por usuario y por IP en una ventana
+deslizante; superado el límite, el login se rechaza sin calcular ningún
+hash, de modo que una ráfaga de credential stuffing no satura la CPU.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+HASH_ITERATIONS = int(os.getenv("AUTH_HASH_ITERATIONS", "200000"))
+HASH_PREFIX = "pbkdf2_sha256"
+# El token va en la URL (query param "session"): vida corta y revocable (ver version en issue_token)
+SESSION_TTL_SECONDS = int(os.getenv("AUTH_SESSION_TTL", str(12 * 3600)))
+SECRET_PATH = Path(os.getenv("AUTH_SECRET_PATH", Path(__file__).parent / ".auth_secret"))
+
+# Intentos fallidos permitidos por ventana antes de bloquear
+MAX_FAILURES_PER_USER = int(os.getenv("AUTH_MAX_FAILURES_USER", "5"))
+MAX_FAILURES_PER_IP = int(os.getenv("AUTH_MAX_FAILURES_IP", "20"))
+FAILURE_WINDOW_SECONDS = int(os.getenv("AUTH_FAILURE_WINDOW", "300"))
+# Hashes calculados a la vez como máximo (el resto espera su turno)
+MAX_CONCURRENT_HASHES = max(1, (os.cpu_count() or 2) // 2)
+# Hashes de las importaciones masivas: cupo propio para no dejar sin turno a los logins
+BULK_HASH_WORKERS = max(1, MAX_CONCURRENT_HASHES // 2)
+MAX_TRACKED_KEYS = 10000
+LATENCY_SAMPLES = 500
+
+
+class LoginThrottled(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Demasiados intentos; reintenta en {int(retry_after) + 1} s")
+        self.retry_after = retry_after
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+_hash_slots = threading.BoundedSemaphore(MAX_CONCURRENT_HASHES)
+_bulk_hash_slots = threading.BoundedSemaphore(BULK_HASH_WORKERS)
+
+
+def _pbkdf2(password, salt, iterations, slots=_hash_slots):
+    with slots:
+        return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+
+
+def is_hashed(stored):
+    return isinstance(stored, str) and stored.startswith(HASH_PREFIX + "$")
+
+
+def hash_password(password, iterations=HASH_ITERATIONS, bulk=False):
+    # bulk: importaciones masivas, con su propio cupo de hashes simultáneos
+    salt = secrets.token_bytes(16)
+    digest = _pbkdf2(password, salt, iterations, _bulk_hash_slots if bulk else _hash_slots)
+    return f"{HASH_PREFIX}${iterations}${_b64(salt)}${_b64(digest)}"
+
+
+_dummy_hash = None
+
+
+def verify_password(password, stored):
+    # Devuelve (válida, necesita_rehash)
+    global _dummy_hash
+    if not stored:
+        # Usuario inexistente: mismo coste que uno real para no delatar qué usuarios existen
+        if _dummy_hash is None:
+            _dummy_hash = hash_password(secrets.token_hex(8))
+        verify_password(password, _dummy_hash)
+        return False, False
+    if not is_hashed(stored):
+        # Contraseña heredada en texto plano
+        ok = hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+        return ok, ok
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        iterations = int(iterations)
+        expected = _unb64(digest)
+        salt = _unb64(salt)
+    except ValueError:
+        return False, False
+    ok = hmac.compare_digest(_pbkdf2(password, salt, iterations), expected)
+    return ok, ok and iterations != HASH_ITERATIONS
+
+
+_secret = None
+_secret_lock = threading.Lock()
+
+
+def _session_secret():
+    global _secret
+    with _secret_lock:
+        if _secret is None:
+            env = os.getenv("AUTH_SECRET")
+            if env:
+                _secret = env.encode("utf-8")
+            elif SECRET_PATH.exists():
+                _secret = SECRET_PATH.read_bytes().strip()
+            else:
+                _secret = secrets.token_hex(32).encode("ascii")
+                tmp = SECRET_PATH.with_suffix(".tmp")
+                tmp.write_bytes(_secret)
+                os.chmod(tmp, 0o600)
+                os.replace(tmp, SECRET_PATH)
+        return _secret
+
+
+def sign(payload):
+    # Firma HMAC con la clave de la app (tokens de sesión, enlaces de descarga)
+    return _b64(hmac.new(_session_secret(), payload.encode("utf-8"), hashlib.sha256).digest())
+
+
+def issue_token(user_id, version=0, ttl=SESSION_TTL_SECONDS):
+    # version: versión de sesión del usuario; al subirla (logout, cambio de contraseña)
+    # dejan de valer todos sus tokens anteriores
+    payload = f"{user_id}.{int(version)}.{int(time.time() + ttl)}"
+    return f"{payload}.{sign(payload)}"
+
+
+def verify_token(token, current_version=None):
+    # Devuelve el id del usuario si el token es auténtico, no ha caducado y, con
+    # current_version(user_id), si no se ha revocado
+    try:
+        user_id, version, expires, signature = str(token).rsplit(".", 3)
+        version, expires = int(version), int(expires)
+    except ValueError:
+        return None
+    if not hmac.compare_digest(signature, sign(f"{user_id}.{version}.{expires}")):
+        return None
+    if expires < time.time():
+        return None
+    if current_version is not None and current_version(user_id) != version:
+        return None
+    return user_id
+
+
+class LoginThrottle:
+    def __init__(self, max_per_user=MAX_FAILURES_PER_USER, max_per_ip=MAX_FAILURES_PER_IP,
+                 window=FAILURE_WINDOW_SECONDS):
+        self.max_per_user = max_per_user
+        self.max_per_ip = max_per_ip
+        self.window = window
+        self._failures = {}
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def _recent(self, key, now):
+        attempts = self._failures.get(key)
+        if attempts is None:
+            return None
+        while attempts and attempts[0] <= now - self.window:
+            attempts.popleft()
+        if not attempts:
+            del self._failures[key]
+            return None
+        return attempts
+
+    def check(self, username, ip=None):
+        # Lanza LoginThrottled si el usuario o la IP han agotado sus intentos
+        now = time.time()
+        with self._lock:
+            for key, limit in ((("user", username.lower()), self.max_per_user), (("ip", ip), self.max_per_ip)):
+                if key[1] is None:
+                    continue
+                attempts = self._recent(key, now)
+                if attempts is not None and len(attempts) >= limit:
+                    self.rejected += 1
+                    raise LoginThrottled(attempts[0] + self.window - now)
+
+    def failure(self, username, ip=None):
+        now = time.time()
+        with self._lock:
+            for key in (("user", username.lower()), ("ip", ip)):
+                if key[1] is not None:
+                    self._failures.setdefault(key, deque()).append(now)
+            if len(self._failures) > MAX_TRACKED_KEYS:
+                # Ráfaga con muchos usuarios distintos: se descartan las entradas caducadas
+                for key in list(self._failures):
+                    self._recent(key, now)
+
+    def success(self, username):
+        with self._lock:
+            self._failures.pop(("user", username.lower()), None)
+
+
+throttle = LoginThrottle()
+
+_latencies = deque(maxlen=LATENCY_SAMPLES)
+_latency_lock = threading.Lock()
+
+
+def record_login_latency(seconds):
+    with _latency_lock:
+        _latencies.append(seconds)
+
+
+def login_stats():
+    with _latency_lock:
+        samples = sorted(_latencies)
+    if not samples:
+        return {"count": 0, "p50": None, "p95": None, "rejected": throttle.rejected}
+    return {
+        "count": len(samples),
+        "p50": samples[len(samples) // 2],
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "rejected": throttle.rejected,
+    }
@@ -0,0 +1,237 @@
+"""Importaciones masivas desde CSV, XLSX o JSON-lines.
+
+Los ficheros se leen fila a fila (nunca se cargan enteros en memoria), se
+validan y todos los cambios válidos se aplican en una sola escritura del
+almacén de usuarios. Los errores se devuelven por fila para poder
+descargarlos como CSV.
+"""
+import csv
+import io
+import json
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import data_manager
+from auth import BULK_HASH_WORKERS, hash_password
+
+# Filas que se validan juntas contra el índice de usuarios
+VALIDATE_BATCH = 500
+
+# Alias aceptados en las cabeceras (en minúsculas)
+ALIASES = {
+    "usuario": "username", "user": "username", "login": "username",
+    "correo": "email", "mail": "email", "e-mail": "email",
+    "curso": "course",
+    "accion": "action", "acción": "action",
+    "nombre": "name",
+    "contraseña": "password", "contrasena": "password", "clave": "password",
+    "rol": "role",
+    "cohorte": "cohort",
+}
+
+
+def _column(name):
+    key = str(name or "").strip().lower()
+    return ALIASES.get(key, key)
+
+
+def _text(stream):
+    return io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+
+
+def _iter_csv(stream):
+    text = _text(stream)
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(text, dialect)
+    header = [_column(h) for h in next(reader, [])]
+    for row in reader:
+        if any(cell.strip() for cell in row):
+            yield reader.line_num, dict(zip(header, (cell.strip() for cell in row)))
+
+
+def _iter_xlsx(stream):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [_column(h) for h in next(rows, ())]
+        for line, row in enumerate(rows, start=2):
+            values = ["" if v is None else str(v).strip() for v in row]
+            if any(values):
+                yield line, dict(zip(header, values))
+    finally:
+        workbook.close()
+
+
+def _iter_jsonl(stream):
+    for line, raw in enumerate(_text(stream), start=1):
+        raw = raw.strip()
+        if not raw:
+            continue
+        try:
+            record = json.loads(raw)
+        except ValueError as e:
+            yield line, ValueError(f"JSON no válido: {e}")
+            continue
+        if not isinstance(record, dict):
+            yield line, ValueError("Cada línea debe ser un objeto JSON")
+            continue
+        yield line, {_column(k): "" if v is None else str(v).strip() for k, v in record.items()}
+
+
+def iter_records(stream, file_name):
+    # Genera (número de fila, dict); una fila ilegible llega como excepción
+    suffix = Path(file_name).suffix.lower()
+    if suffix in (".xlsx", ".xlsm"):
+        return _iter_xlsx(stream)
+    if suffix in (".jsonl", ".ndjson"):
+        return _iter_jsonl(stream)
+    return _iter_csv(stream)
+
+
+def errors_csv(errors):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=["fila", "valor", "error"])
+    writer.writeheader()
+    writer.writerows(errors)
+    return buf.getvalue().encode("utf-8-sig")
+
+
+def credentials_csv(credentials):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=["usuario", "email", "contraseña"])
+    writer.writeheader()
+    writer.writerows(credentials)
+    return buf.getvalue().encode("utf-8-sig")
+
+
+def _report(rows, errors, start, **counts):
+    elapsed = time.perf_counter() - start
+    return {
+        "rows": rows,
+        "errors": errors,
+        "seconds": elapsed,
+        "rows_per_second": rows / elapsed if elapsed > 0 else 0.0,
+        **counts,
+    }
+
+
+def import_enrollments(stream, file_name, default_course=None):
+    # Columnas: username o email; course (opcional si hay curso por defecto); action (alta/baja)
+    start = time.perf_counter()
+    pending, errors, rows = [], [], 0
+    for line, record in iter_records(stream, file_name):
+        rows += 1
+        if isinstance(record, Exception):
+            errors.append({"fila": line, "valor": "", "error": str(record)})
+            continue
+        who = record.get("username") or record.get("email")
+        course = record.get("course") or default_course
+        action = (record.get("action") or "alta").lower()
+        if not who:
+            errors.append({"fila": line, "valor": "", "error": "Falta el usuario o el email"})
+        elif not course:
+            errors.append({"fila": line, "valor": who, "error": "Falta el curso"})
+        elif action not in ("alta", "baja", "enroll", "unenroll"):
+            errors.append({"fila": line, "valor": who, "error": f"Acción desconocida: {action}"})
+        else:
+            pending.append((line, who, course, action in ("alta", "enroll")))
+
+    ids = data_manager.resolve_users(who for _, who, _, _ in pending)
+    changes = []
+    for line, who, course, enrolled in pending:
+        if who in ids:
+            changes.append((ids[who], course, enrolled))
+        else:
+            errors.append({"fila": line, "valor": who, "error": "El alumno no existe"})
+    result = data_manager.set_enrollments(changes) if changes else {"enrolled": 0, "unenrolled": 0}
+    errors.sort(key=lambda e: e["fila"])
+    return _report(rows, errors, start, **result)
+
+
+def import_students(stream, file_name, default_password=None, cohort=None, progress=None):
+    # Columnas: name, username, email y opcionalmente password, role y cohort.
+    # Sin contraseña en la fila ni default_password se genera una aleatoria por alumno;
+    # esas se devuelven en report["credentials"] para entregarlas.
+    # progress(hechos, total) se llama a medida que terminan los hashes
+    start = time.perf_counter()
+    errors, rows, seen_users, seen_emails = [], 0, set(), set()
+    generated = {}
+    ready = []
+    batch = []
+
+    # pbkdf2 libera el GIL: los hashes se calculan en paralelo mientras se sigue leyendo,
+    # con el cupo de hashes masivos (los logins conservan el suyo)
+    with ThreadPoolExecutor(max_workers=BULK_HASH_WORKERS) as pool:
+        def flush():
+            taken_users, taken_emails = data_manager.existing_identities(
+                [r["username"] for _, r in batch], [r["email"] for _, r in batch]
+            )
+            for line, record in batch:
+                if record["username"] in taken_users:
+                    errors.append({"fila": line, "valor": record["username"], "error": "El usuario ya existe"})
+                elif record["email"] in taken_emails:
+                    errors.append({"fila": line, "valor": record["email"], "error": "El email ya está registrado"})
+                else:
+                    ready.append((record, pool.submit(hash_password, record["password"], bulk=True)))
+            batch.clear()
+
+        for line, record in iter_records(stream, file_name):
+            rows += 1
+            if isinstance(record, Exception):
+                errors.append({"fila": line, "valor": "", "error": str(record)})
+                continue
+            user = {
+                "username": record.get("username", ""),
+                "name": record.get("name", ""),
+                "email": data_manager.normalize_email(record.get("email", "")),
+                "password": record.get("password") or default_password,
+                "role": record.get("role") or "student",
+                "cohort": record.get("cohort") or cohort,
+            }
+            missing = [k for k in ("username", "name", "email") if not user[k]]
+            if missing:
+                errors.append({"fila": line, "valor": user["username"], "error": "Faltan campos: " + ", ".join(missing)})
+            elif "@" not in user["email"]:
+                errors.append({"fila": line, "valor": user["email"], "error": "Email no válido"})
+            elif user["role"] not in ("student", "admin"):
+                errors.append({"fila": line, "valor": user["username"], "error": f"Rol desconocido: {user['role']}"})
+            elif user["username"] in seen_users:
+                errors.append({"fila": line, "valor": user["username"], "error": "Usuario repetido en el fichero"})
+            elif user["email"] in seen_emails:
+                errors.append({"fila": line, "valor": user["email"], "error": "Email repetido en el fichero"})
+            else:
+                seen_users.add(user["username"])
+                seen_emails.add(user["email"])
+                if not user["password"]:
+                    user["password"] = generated[user["username"]] = secrets.token_urlsafe(9)
+                batch.append((line, user))
+                if len(batch) >= VALIDATE_BATCH:
+                    flush()
+        if batch:
+            flush()
+        records = []
+        for done, (record, future) in enumerate(ready, start=1):
+            records.append(dict(record, password=future.result()))
+            if progress:
+                progress(done, len(ready))
+
+    created, rejected = data_manager.add_users(records) if records else ([], [])
+    for username in rejected:
+        # Alta concurrente con el mismo usuario entre la validación y la escritura
+        errors.append({"fila": "", "valor": username, "error": "El usuario ya existe"})
+    errors.sort(key=lambda e: (e["fila"] == "", e["fila"] or 0))
+    rejected = set(rejected)
+    credentials = [
+        {"usuario": r["username"], "email": r["email"], "contraseña": generated[r["username"]]}
+        for r in records if r["username"] in generated and r["username"] not in rejected
+    ]
+    return _report(rows, errors, start, created=len(created), credentials=credentials)
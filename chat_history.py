@@ -0,0 +1,103 @@
+"""Historial de chat acotado con presupuesto de tokens para el contexto.
+
+Los mensajes más antiguos se resumen (de forma extractiva, sin llamar al
+LLM) y se descartan, de modo que tanto lo que se guarda en la sesión como
+el contexto que se envía al modelo tienen un tamaño máximo fijo.
+"""
+import os
+import re
+
+# Mensajes que se conservan literalmente en la sesión
+MAX_STORED_MESSAGES = int(os.getenv("CHAT_MAX_STORED_MESSAGES", "60"))
+# Presupuesto aproximado de tokens para el historial dentro del prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKENS", "1200"))
+# Tamaño máximo del resumen de la conversación antigua (caracteres)
+SUMMARY_MAX_CHARS = 1500
+# Mensajes que se pintan por defecto en la pestaña de chat
+RENDER_WINDOW = 20
+
+_SENTENCE_RE = re.compile(r"(.+?[.!?])(\s|$)", re.S)
+
+ROLE_LABELS = {"user": "Alumno", "assistant": "Tutor"}
+
+
+def estimate_tokens(text):
+    # Aproximación habitual: ~4 caracteres por token
+    return max(1, len(text) // 4)
+
+
+def first_sentence(text, limit=160):
+    text = " ".join(text.split())
+    match = _SENTENCE_RE.match(text)
+    sentence = match.group(1) if match else text
+    return sentence if len(sentence) <= limit else sentence[:limit - 1] + "…"
+
+
+class ChatHistory:
+    def __init__(self, max_stored=MAX_STORED_MESSAGES, token_budget=CONTEXT_TOKEN_BUDGET):
+        self.messages = []
+        self.summary = ""
+        self.max_stored = max_stored
+        self.token_budget = token_budget
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, role, content):
+        self.messages.append({"role": role, "content": content})
+        if len(self.messages) > self.max_stored:
+            overflow = len(self.messages) - self.max_stored
+            self._fold(self.messages[:overflow])
+            # Mutación in situ: otras referencias a la lista siguen siendo válidas
+            del self.messages[:overflow]
+
+    def _fold(self, old_messages):
+        lines = [f"{ROLE_LABELS.get(m['role'], m['role'])}: {first_sentence(m['content'])}" for m in old_messages]
+        summary = "\n".join(filter(None, [self.summary] + lines))
+        if len(summary) > SUMMARY_MAX_CHARS:
+            # Se conserva lo más reciente del resumen
+            summary = summary[-SUMMARY_MAX_CHARS:]
+            summary = summary[summary.find("\n") + 1:]
+        self.summary = summary
+
+    def clear(self):
+        self.messages.clear()
+        self.summary = ""
+
+    def window(self, size):
+        start = max(0, len(self.messages) - size)
+        return start, self.messages[start:]
+
+    def build_prompt(self, prompt, question=None):
+        # El mensaje del alumno que se está respondiendo ya está en el historial
+        turns = self.messages
+        if turns and turns[-1]["role"] == "user" and turns[-1]["content"] == (question or prompt):
+            turns = turns[:-1]
+
+        recent = []
+        budget = self.token_budget
+        older = []
+        for i in range(len(turns) - 1, -1, -1):
+            cost = estimate_tokens(turns[i]["content"])
+            if cost > budget:
+                older = turns[:i + 1]
+                break
+            budget -= cost
+            recent.append(turns[i])
+        recent.reverse()
+
+        summary_lines = [self.summary] if self.summary else []
+        summary_lines += [f"{ROLE_LABELS.get(m['role'], m['role'])}: {first_sentence(m['content'])}" for m in older]
+        summary = "\n".join(summary_lines)[-SUMMARY_MAX_CHARS:]
+
+        if not recent and not summary:
+            return prompt
+        parts = []
+        if summary:
+            parts.append(f"Resumen de la conversación anterior:\n{summary}")
+        if recent:
+            parts.append("Conversación reciente:\n" + "\n".join(
+                f"{ROLE_LABELS.get(m['role'], m['role'])}: {m['content']}" for m in recent
+            ))
+        parts.append(prompt)
+        return "\n\n".join(parts)
@@ -0,0 +1,61 @@
+"""Configuración compartida entre sesiones con recarga por mtime.
+
+config.json solo se vuelve a parsear cuando cambia en disco (mtime/tamaño).
+El CSS del tema se compila una vez por combinación de valores del tema.
+"""
+import json
+import os
+import re
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+CONFIG_PATH = Path(__file__).parent / "config.json"
+
+_lock = threading.Lock()
+_cache = {"stamp": None, "config": None, "version": 0}
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def load_config(path=CONFIG_PATH):
+    # Devuelve el dict compartido: solo debe modificarse para guardarlo con save_config
+    stamp = _stamp(path)
+    with _lock:
+        if _cache["stamp"] == stamp and _cache["config"] is not None:
+            return _cache["config"]
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    with _lock:
+        _cache.update(stamp=stamp, config=config, version=_cache["version"] + 1)
+    return config
+
+
+def save_config(config, path=CONFIG_PATH):
+    # Escritura atómica; la caché se actualiza en el acto para todas las sesiones
+    tmp = Path(path).with_suffix(".json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=4, ensure_ascii=False)
+    os.replace(tmp, path)
+    with _lock:
+        _cache.update(stamp=_stamp(path), config=config, version=_cache["version"] + 1)
+
+
+def config_version():
+    with _lock:
+        return _cache["version"]
+
+
+@lru_cache(maxsize=16)
+def _compile_css(template, replacements):
+    mapping = dict(replacements)
+    pattern = re.compile("|".join(re.escape(k) for k in sorted(mapping, key=len, reverse=True)))
+    return pattern.sub(lambda m: mapping[m.group(0)], template)
+
+
+def compile_theme_css(template, replacements):
+    # Una sola pasada de sustitución, memorizada por plantilla + valores del tema
+    return _compile_css(template, tuple(sorted(replacements.items())))
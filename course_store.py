@@ -0,0 +1,296 @@
+"""Contenido del curso compartido entre sesiones.
+
+El contenido se guarda como un almacén de bloques versionado (course.db):
+cada guardado del editor añade al journal solo los bloques que cambian
+(set/del y, si cambia, el nuevo orden) y cada SNAPSHOT_EVERY versiones se
+guarda el documento completo. La última versión se materializa una vez y
+se comparte entre sesiones; las siguientes se obtienen aplicando solo los
+parches nuevos. Guardar sobre una versión antigua se acepta si los cambios
+no tocan los mismos bloques (control de concurrencia optimista); si los
+tocan se lanza CourseConflict.
+
+course_content.json solo se lee para importar el curso la primera vez.
+course_metadata.json se parsea una vez por versión del fichero (mtime/tamaño).
+El curso se divide en secciones para que el visor pinte solo la sección
+activa (y cargue sus vídeos e imágenes solo al abrirla).
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+APP_DIR = Path(__file__).parent
+COURSE_FILE = APP_DIR / "course_content.json"
+COURSE_DB_PATH = Path(os.getenv("COURSE_DB_PATH", APP_DIR / "course.db"))
+META_FILE = APP_DIR / "course_metadata.json"
+SNAPSHOT_EVERY = int(os.getenv("COURSE_SNAPSHOT_EVERY", "50"))
+# Bloques por sección cuando el curso no tiene títulos que lo estructuren
+SECTION_FALLBACK_SIZE = 10
+SECTION_TYPES = ("module", "section")
+
+_lock = threading.Lock()
+_cache = {}
+
+
+class CourseConflict(Exception):
+    def __init__(self, version, blocks):
+        super().__init__(f"El curso ha cambiado (versión {version}) en bloques que también has editado")
+        self.version = version
+        self.blocks = blocks
+
+
+class Course:
+    def __init__(self, blocks, version):
+        self.blocks = blocks
+        self.version = version
+        self.sections = split_sections(blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def section_blocks(self, index):
+        # (posición global, bloque) de la sección; la posición mantiene estables las keys
+        _, start, end = self.sections[index]
+        return list(enumerate(self.blocks[start:end], start=start))
+
+
+def split_sections(blocks):
+    # Una sección empieza en cada bloque de texto con título (o bloque module/section)
+    starts = [
+        i for i, b in enumerate(blocks)
+        if b.get("type") in SECTION_TYPES or (b.get("type") == "editor" and b.get("title"))
+    ]
+    if not starts:
+        return [
+            (f"Parte {n + 1}", i, min(i + SECTION_FALLBACK_SIZE, len(blocks)))
+            for n, i in enumerate(range(0, len(blocks), SECTION_FALLBACK_SIZE))
+        ]
+    sections = []
+    if starts[0] > 0:
+        sections.append(("Introducción", 0, starts[0]))
+    for n, start in enumerate(starts):
+        end = starts[n + 1] if n + 1 < len(starts) else len(blocks)
+        sections.append((blocks[start].get("title") or f"Sección {len(sections) + 1}", start, end))
+    return sections
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _load(path, parse):
+    stamp = _stamp(path)
+    with _lock:
+        entry = _cache.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+    value = parse(path, stamp)
+    with _lock:
+        _cache[path] = (stamp, value)
+    return value
+
+
+def _read_json(path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patches (
+    version INTEGER PRIMARY KEY,
+    base INTEGER NOT NULL,
+    ops TEXT NOT NULL,
+    author TEXT NOT NULL DEFAULT '',
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    version INTEGER PRIMARY KEY,
+    doc TEXT NOT NULL
+);
+"""
+
+
+class BlockStore:
+    def __init__(self, path=COURSE_DB_PATH, legacy_file=COURSE_FILE, snapshot_every=SNAPSHOT_EVERY):
+        self.snapshot_every = snapshot_every
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._latest = None
+        self._course = None
+        if self.version() == 0 and Path(legacy_file).exists():
+            blocks = _read_json(legacy_file, [])
+            if blocks:
+                self.save(0, blocks, author="importado de course_content.json")
+
+    def version(self):
+        return self._conn.execute("SELECT COALESCE(MAX(version), 0) FROM patches").fetchone()[0]
+
+    def _materialize(self, version, start=None):
+        # start: estado (versión, orden, bloques) desde el que aplicar parches
+        if start is None or start[0] > version:
+            row = self._conn.execute(
+                "SELECT version, doc FROM snapshots WHERE version <= ? ORDER BY version DESC LIMIT 1", (version,)
+            ).fetchone()
+            if row:
+                doc = json.loads(row[1])
+                start = (row[0], doc["order"], doc["blocks"])
+            else:
+                start = (0, [], {})
+        current, order, blocks = start[0], list(start[1]), dict(start[2])
+        for (ops,) in self._conn.execute(
+            "SELECT ops FROM patches WHERE version > ? AND version <= ? ORDER BY version", (current, version)
+        ):
+            order = _apply(json.loads(ops), order, blocks)
+        return (version, order, blocks)
+
+    def latest(self):
+        # Curso de la última versión; solo se aplican los parches posteriores al cacheado
+        with self._lock:
+            version = self.version()
+            if self._course is None or self._course.version != version:
+                self._latest = self._materialize(version, self._latest)
+                _, order, blocks = self._latest
+                self._course = Course(tuple(blocks[i] for i in order), version)
+            return self._course
+
+    def save(self, base_version, new_blocks, author=""):
+        # Devuelve (versión, nº de operaciones); los bloques nuevos reciben su id in situ
+        for block in new_blocks:
+            block.setdefault("id", uuid.uuid4().hex[:12])
+        with self._lock:
+            _, base_order, base_blocks = (
+                self._latest if self._latest and self._latest[0] == base_version
+                else self._materialize(base_version)
+            )
+            ops = diff_blocks(base_order, base_blocks, new_blocks)
+            if not ops:
+                return base_version, 0
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = self.version()
+                if current != base_version:
+                    self._check_conflicts(base_version, ops)
+                    if any(op["op"] == "order" for op in ops):
+                        # Rebase del orden: se conserva el de quien guarda, con los bloques
+                        # añadidos entretanto por otros al final
+                        _, order_now, _ = self._materialize(current, self._latest)
+                        ops = _rebase_order(ops, order_now)
+                version = current + 1
+                self._conn.execute(
+                    "INSERT INTO patches (version, base, ops, author, created) VALUES (?, ?, ?, ?, ?)",
+                    (version, base_version, json.dumps(ops, ensure_ascii=False), author, time.time())
+                )
+                if version % self.snapshot_every == 0:
+                    _, order, blocks = self._materialize(version, self._latest)
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO snapshots (version, doc) VALUES (?, ?)",
+                        (version, json.dumps({"order": order, "blocks": blocks}, ensure_ascii=False))
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return version, len(ops)
+
+    def _check_conflicts(self, base_version, ops):
+        mine = {op["id"] for op in ops if "id" in op}
+        theirs = set()
+        for (ops_json,) in self._conn.execute("SELECT ops FROM patches WHERE version > ?", (base_version,)):
+            theirs.update(op["id"] for op in json.loads(ops_json) if "id" in op)
+        clash = mine & theirs
+        if clash:
+            raise CourseConflict(self.version(), sorted(clash))
+
+    def history(self, limit=20):
+        rows = self._conn.execute(
+            "SELECT version, author, created, ops FROM patches ORDER BY version DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [
+            {"version": v, "author": a, "created": c, "changes": len(json.loads(o))}
+            for v, a, c, o in rows
+        ]
+
+
+def _apply(ops, order, blocks):
+    for op in ops:
+        if op["op"] == "set":
+            blocks[op["id"]] = op["block"]
+        elif op["op"] == "del":
+            blocks.pop(op["id"], None)
+        elif op["op"] == "order":
+            order = op["ids"]
+    return [i for i in order if i in blocks]
+
+
+def _rebase_order(ops, order_now):
+    mine = next(op for op in ops if op["op"] == "order")["ids"]
+    deleted = {op["id"] for op in ops if op["op"] == "del"}
+    extra = [i for i in order_now if i not in mine and i not in deleted]
+    return [op if op["op"] != "order" else {"op": "order", "ids": mine + extra} for op in ops]
+
+
+def diff_blocks(base_order, base_blocks, new_blocks):
+    # Operaciones mínimas para pasar de la versión base a new_blocks
+    ops = []
+    new_ids = []
+    for block in new_blocks:
+        block_id = block["id"]
+        new_ids.append(block_id)
+        if base_blocks.get(block_id) != block:
+            ops.append({"op": "set", "id": block_id, "block": dict(block)})
+    kept = set(new_ids)
+    ops += [{"op": "del", "id": i} for i in base_order if i not in kept]
+    if new_ids != [i for i in base_order if i in kept]:
+        ops.append({"op": "order", "ids": new_ids})
+    return ops
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_block_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = BlockStore()
+        return _store
+
+
+def load_course():
+    # Objeto compartido: no modificar sus bloques (el editor trabaja sobre una copia)
+    return get_block_store().latest()
+
+
+def save_course(base_version, blocks, author=""):
+    return get_block_store().save(base_version, blocks, author)
+
+
+def load_metadata(path=META_FILE):
+    return _load(Path(path), lambda p, stamp: _read_json(p, {}) if stamp else {})
+
+
+def course_name(default="Curso General"):
+    return load_metadata().get("name", default)
+
+
+def save_metadata(meta, path=META_FILE):
+    path = Path(path)
+    tmp = path.with_suffix(".json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=4, ensure_ascii=False)
+    os.replace(tmp, path)
+    with _lock:
+        _cache[path] = (_stamp(path), dict(meta))
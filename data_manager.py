@@ -0,0 +1,846 @@
+"""Almacén de usuarios sobre SQLite.
+
+Mantiene la API histórica (load_users, save_users, authenticate, add_user,
+delete_user, toggle_course_enrollment) y añade consultas por fila
+(get_user, update_user, list_users) para no tener que cargar y reescribir
+toda la base de usuarios en cada cambio.
+
+La primera vez que se abre la base se importa users.json si existe.
+
+Escrituras: todas pasan por un único hilo escritor que agrupa las que llegan
+casi a la vez (ráfagas de ediciones de varias sesiones) en una sola
+transacción, es decir, un solo fsync. SQLite en modo WAL aporta el bloqueo
+entre procesos, la atomicidad (un corte nunca deja la base a medias) y el
+journal append-only, que se compacta periódicamente con un checkpoint.
+
+Las contraseñas se guardan hasheadas (ver auth.py). authenticate() resuelve
+el usuario con un índice en memoria username -> (id, hash) y aplica el
+throttling por usuario/IP antes de calcular ningún hash.
+
+Búsqueda de alumnos: nombre, email y usuario se indexan en user_grams
+(trigramas de cada palabra y prefijos de 1-2 letras), de modo que
+query_users() filtra, ordena y pagina en SQLite sin recorrer la tabla.
+
+KPIs de alumnos: student_stats guarda total, activos y suma de progreso
+global, por curso y por cohorte. Lo mantienen triggers de SQLite en cada
+alta, baja, matrícula o cambio de estado/progreso, así que leerlos es una
+búsqueda por clave primaria.
+"""
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+from concurrent.futures import Future
+from datetime import datetime
+from pathlib import Path
+
+from auth import hash_password, is_hashed, issue_token, record_login_latency, throttle, verify_password, verify_token
+
+APP_DIR = Path(__file__).parent
+DB_PATH = Path(os.getenv("USERS_DB_PATH", APP_DIR / "users.db"))
+USERS_JSON = Path(os.getenv("USERS_JSON_PATH", APP_DIR / "users.json"))
+
+# Ventana durante la que se acumulan escrituras concurrentes en un mismo commit
+WRITE_WINDOW_SECONDS = float(os.getenv("USERS_WRITE_WINDOW_MS", "15")) / 1000
+MAX_WRITE_BATCH = 256
+# Cada cuántos lotes se compacta el WAL (si no hay escrituras pendientes)
+CHECKPOINT_EVERY = 200
+
+SEARCH_FIELDS = ("name", "email", "username")
+# Orden disponible en query_users(); "Nunca" cuenta como el acceso más antiguo
+SORT_COLUMNS = {
+    "name": "u.name COLLATE NOCASE",
+    "progress": "u.progress",
+    "status": "u.status",
+    "last_access": "CASE WHEN u.last_access = 'Nunca' THEN '' ELSE u.last_access END",
+}
+
+# Columnas propias; el resto de campos del usuario se guardan en `data` (JSON)
+COLUMNS = ("id", "username", "password", "name", "email", "role", "status", "progress", "last_access", "cohort")
+
+DEFAULT_USERS = [
+    {"id": "admin", "username": "admin", "password": "1234", "name": "Profesor", "email": "admin@academia.ai",
+     "role": "admin", "status": "Activo", "progress": 0, "last_access": "Nunca"},
+    {"id": "alumno", "username": "alumno", "password": "1234", "name": "Alumno Demo", "email": "alumno@academia.ai",
+     "role": "student", "status": "Activo", "progress": 0, "last_access": "Nunca"},
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    password TEXT NOT NULL DEFAULT '',
+    name TEXT NOT NULL DEFAULT '',
+    email TEXT NOT NULL DEFAULT '',
+    role TEXT NOT NULL DEFAULT 'student',
+    status TEXT NOT NULL DEFAULT 'Activo',
+    progress INTEGER NOT NULL DEFAULT 0,
+    last_access TEXT NOT NULL DEFAULT 'Nunca',
+    cohort TEXT NOT NULL DEFAULT '',
+    session_version INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL DEFAULT '{}'
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users(username);
+CREATE INDEX IF NOT EXISTS idx_users_role ON users(role);
+CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
+CREATE INDEX IF NOT EXISTS idx_users_role_progress ON users(role, progress);
+CREATE INDEX IF NOT EXISTS idx_users_role_status ON users(role, status);
+CREATE INDEX IF NOT EXISTS idx_users_role_access ON users(role, last_access);
+CREATE TABLE IF NOT EXISTS user_search (
+    user_id TEXT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_grams (
+    gram TEXT NOT NULL,
+    user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    PRIMARY KEY (gram, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_user_grams_user ON user_grams(user_id);
+CREATE TABLE IF NOT EXISTS enrollments (
+    user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    course TEXT NOT NULL,
+    PRIMARY KEY (user_id, course)
+);
+CREATE INDEX IF NOT EXISTS idx_enrollments_course ON enrollments(course);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS student_stats (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    active INTEGER NOT NULL DEFAULT 0,
+    progress_sum INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (scope, key)
+) WITHOUT ROWID;
+"""
+
+# Mantenimiento incremental de student_stats ('all', 'course', 'cohort').
+# Las filas se crean con NOT EXISTS y no con OR IGNORE: dentro de un trigger, el
+# ON CONFLICT de la sentencia exterior (el upsert de _upsert) prevalece.
+STATS_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS trg_stats_user_insert AFTER INSERT ON users WHEN NEW.role = 'student'
+BEGIN
+    INSERT INTO student_stats (scope, key) SELECT 'all', ''
+        WHERE NOT EXISTS (SELECT 1 FROM student_stats WHERE scope = 'all' AND key = '');
+    INSERT INTO student_stats (scope, key) SELECT 'cohort', NEW.cohort
+        WHERE NOT EXISTS (SELECT 1 FROM student_stats WHERE scope = 'cohort' AND key = NEW.cohort);
+    UPDATE student_stats SET total = total + 1, active = active + (NEW.status = 'Activo'),
+        progress_sum = progress_sum + NEW.progress
+    WHERE (scope = 'all' AND key = '') OR (scope = 'cohort' AND key = NEW.cohort);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_stats_user_delete BEFORE DELETE ON users
+BEGIN
+    -- Primero las matrículas (su trigger descuenta los cursos mientras la fila existe)
+    DELETE FROM enrollments WHERE user_id = OLD.id;
+    UPDATE student_stats SET total = total - 1, active = active - (OLD.status = 'Activo'),
+        progress_sum = progress_sum - OLD.progress
+    WHERE OLD.role = 'student' AND ((scope = 'all' AND key = '') OR (scope = 'cohort' AND key = OLD.cohort));
+END;
+CREATE TRIGGER IF NOT EXISTS trg_stats_user_update AFTER UPDATE OF role, status, progress, cohort ON users
+BEGIN
+    UPDATE student_stats SET total = total - 1, active = active - (OLD.status = 'Activo'),
+        progress_sum = progress_sum - OLD.progress
+    WHERE OLD.role = 'student' AND ((scope = 'all' AND key = '') OR (scope = 'cohort' AND key = OLD.cohort)
+        OR (scope = 'course' AND key IN (SELECT course FROM enrollments WHERE user_id = OLD.id)));
+    INSERT INTO student_stats (scope, key) SELECT 'all', '' WHERE NEW.role = 'student'
+        AND NOT EXISTS (SELECT 1 FROM student_stats WHERE scope = 'all' AND key = '');
+    INSERT INTO student_stats (scope, key) SELECT 'cohort', NEW.cohort WHERE NEW.role = 'student'
+        AND NOT EXISTS (SELECT 1 FROM student_stats WHERE scope = 'cohort' AND key = NEW.cohort);
+    UPDATE student_stats SET total = total + 1, active = active + (NEW.status = 'Activo'),
+        progress_sum = progress_sum + NEW.progress
+    WHERE NEW.role = 'student' AND ((scope = 'all' AND key = '') OR (scope = 'cohort' AND key = NEW.cohort)
+        OR (scope = 'course' AND key IN (SELECT course FROM enrollments WHERE user_id = NEW.id)));
+END;
+CREATE TRIGGER IF NOT EXISTS trg_stats_enroll AFTER INSERT ON enrollments
+WHEN (SELECT role FROM users WHERE id = NEW.user_id) = 'student'
+BEGIN
+    INSERT INTO student_stats (scope, key) SELECT 'course', NEW.course
+        WHERE NOT EXISTS (SELECT 1 FROM student_stats WHERE scope = 'course' AND key = NEW.course);
+    UPDATE student_stats SET total = total + 1,
+        active = active + (SELECT status = 'Activo' FROM users WHERE id = NEW.user_id),
+        progress_sum = progress_sum + (SELECT progress FROM users WHERE id = NEW.user_id)
+    WHERE scope = 'course' AND key = NEW.course;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_stats_unenroll AFTER DELETE ON enrollments
+WHEN (SELECT role FROM users WHERE id = OLD.user_id) = 'student'
+BEGIN
+    UPDATE student_stats SET total = total - 1,
+        active = active - (SELECT status = 'Activo' FROM users WHERE id = OLD.user_id),
+        progress_sum = progress_sum - (SELECT progress FROM users WHERE id = OLD.user_id)
+    WHERE scope = 'course' AND key = OLD.course;
+END;
+"""
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _open_connection():
+    conn = sqlite3.connect(str(DB_PATH), timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+
+def _connect():
+    # Conexión de lectura por hilo (cada sesión de Streamlit corre en su hilo)
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+    _ensure_initialized(conn)
+    return conn
+
+
+def _ensure_initialized(conn):
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if _initialized:
+            return
+        conn.executescript(SCHEMA)
+        columns = {r["name"] for r in conn.execute("PRAGMA table_info(users)")}
+        if "cohort" not in columns:
+            conn.execute("ALTER TABLE users ADD COLUMN cohort TEXT NOT NULL DEFAULT ''")
+        if "session_version" not in columns:
+            conn.execute("ALTER TABLE users ADD COLUMN session_version INTEGER NOT NULL DEFAULT 0")
+        conn.executescript(STATS_TRIGGERS)
+        migrated = conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        if migrated is None:
+            _migrate_from_json(conn)
+        if conn.execute("SELECT value FROM meta WHERE key = 'search_indexed'").fetchone() is None:
+            _rebuild_search_index(conn)
+        if conn.execute("SELECT value FROM meta WHERE key = 'stats_built'").fetchone() is None:
+            _rebuild_stats(conn)
+        if conn.execute("SELECT value FROM meta WHERE key = 'emails_normalized'").fetchone() is None:
+            _normalize_emails(conn)
+        _initialized = True
+
+
+def _migrate_from_json(conn):
+    # Migración única desde el antiguo users.json (o usuarios de demo si no existe)
+    users = DEFAULT_USERS
+    if USERS_JSON.exists():
+        with open(USERS_JSON, "r", encoding="utf-8") as f:
+            users = json.load(f).get("users", [])
+    users = [_with_hashed_password(u) for u in users]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0:
+            for user in users:
+                _upsert(conn, user)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (str(USERS_JSON),))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def normalize_email(email):
+    # Los emails se guardan y se comparan siempre en minúsculas
+    return str(email or "").strip().lower()
+
+
+def _normalize_emails(conn):
+    # Migración única: emails antiguos guardados con mayúsculas
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute("SELECT id, email FROM users").fetchall()
+        conn.executemany(
+            "UPDATE users SET email = ? WHERE id = ?",
+            [(normalize_email(r["email"]), r["id"]) for r in rows if r["email"] != normalize_email(r["email"])]
+        )
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('emails_normalized', '1')")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _with_hashed_password(user):
+    # Se hashea fuera del hilo escritor para no alargar las transacciones
+    password = user.get("password")
+    if password and not is_hashed(password):
+        user = dict(user, password=hash_password(password))
+    return user
+
+
+def _search_text(*values):
+    # Minúsculas, sin acentos y con los separadores (@ . _ -) como espacios
+    text = unicodedata.normalize("NFKD", " ".join(str(v or "") for v in values).lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.split(r"[\s@._\-]+", text)).strip()
+
+
+def _grams(word):
+    if len(word) < 3:
+        return {"^" + word}
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+def _index_search(conn, user_id):
+    row = conn.execute("SELECT name, email, username FROM users WHERE id = ?", (user_id,)).fetchone()
+    conn.execute("DELETE FROM user_grams WHERE user_id = ?", (user_id,))
+    if row is None:
+        return
+    text = _search_text(*row)
+    grams = set()
+    for word in text.split():
+        grams |= _grams(word)
+        grams.update("^" + word[:n] for n in (1, 2) if len(word) >= n)
+    conn.execute("INSERT OR REPLACE INTO user_search (user_id, text) VALUES (?, ?)", (user_id, text))
+    conn.executemany("INSERT OR IGNORE INTO user_grams (gram, user_id) VALUES (?, ?)", [(g, user_id) for g in grams])
+
+
+def _rebuild_search_index(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for row in conn.execute("SELECT id FROM users").fetchall():
+            _index_search(conn, row["id"])
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('search_indexed', '1')")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _rebuild_stats(conn):
+    # Recuento completo: solo al crear la tabla; después la mantienen los triggers
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM student_stats")
+        aggregate = "COUNT(*), SUM(u.status = 'Activo'), SUM(u.progress)"
+        conn.execute(
+            f"INSERT INTO student_stats SELECT 'all', '', {aggregate} FROM users u WHERE u.role = 'student'"
+        )
+        conn.execute(
+            f"INSERT INTO student_stats SELECT 'cohort', u.cohort, {aggregate}"
+            " FROM users u WHERE u.role = 'student' GROUP BY u.cohort"
+        )
+        conn.execute(
+            f"INSERT INTO student_stats SELECT 'course', e.course, {aggregate}"
+            " FROM enrollments e JOIN users u ON u.id = e.user_id WHERE u.role = 'student' GROUP BY e.course"
+        )
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('stats_built', '1')")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _split(user):
+    cols = {k: user[k] for k in COLUMNS if k in user and user[k] is not None}
+    if "email" in cols:
+        cols["email"] = normalize_email(cols["email"])
+    extra = {k: v for k, v in user.items() if k not in COLUMNS and k != "enrolled_courses"}
+    return cols, extra
+
+
+def _upsert(conn, user):
+    user = dict(user)
+    if not user.get("id"):
+        user["id"] = uuid.uuid4().hex[:8]
+    if not user.get("username"):
+        user["username"] = user["id"]
+    cols, extra = _split(user)
+    cols["data"] = json.dumps(extra, ensure_ascii=False)
+    names = ", ".join(cols)
+    marks = ", ".join("?" for _ in cols)
+    updates = ", ".join(f"{k} = excluded.{k}" for k in cols if k != "id")
+    conn.execute(
+        f"INSERT INTO users ({names}) VALUES ({marks}) ON CONFLICT(id) DO UPDATE SET {updates}",
+        tuple(cols.values())
+    )
+    if "enrolled_courses" in user:
+        conn.execute("DELETE FROM enrollments WHERE user_id = ?", (user["id"],))
+        conn.executemany(
+            "INSERT OR IGNORE INTO enrollments (user_id, course) VALUES (?, ?)",
+            [(user["id"], c) for c in user.get("enrolled_courses") or []]
+        )
+    _index_search(conn, user["id"])
+    return user["id"]
+
+
+def _courses_for(conn, user_ids):
+    courses = {uid: [] for uid in user_ids}
+    if not user_ids:
+        return courses
+    # Consultas por lotes para no superar el límite de parámetros de SQLite
+    ids = list(user_ids)
+    for i in range(0, len(ids), 500):
+        part = ids[i:i + 500]
+        marks = ", ".join("?" for _ in part)
+        for row in conn.execute(
+            f"SELECT user_id, course FROM enrollments WHERE user_id IN ({marks}) ORDER BY rowid", part
+        ):
+            courses[row["user_id"]].append(row["course"])
+    return courses
+
+
+def _to_user(row, courses, with_password=False):
+    user = json.loads(row["data"] or "{}")
+    for k in COLUMNS:
+        user[k] = row[k]
+    if not with_password:
+        user.pop("password", None)
+    user["enrolled_courses"] = courses
+    return user
+
+
+def _fetch(conn, sql, params=(), with_password=False):
+    rows = conn.execute(sql, params).fetchall()
+    courses = _courses_for(conn, [r["id"] for r in rows])
+    return [_to_user(r, courses[r["id"]], with_password) for r in rows]
+
+
+class _WriteQueue:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.ops = 0
+        self.batches = 0
+
+    def submit(self, op):
+        # Bloquea hasta que el lote que contiene la operación se ha confirmado
+        _connect()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="users-writer", daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((op, future))
+        return future.result()
+
+    def _run(self):
+        conn = _open_connection()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + WRITE_WINDOW_SECONDS
+            while len(batch) < MAX_WRITE_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._apply(conn, batch)
+
+    def _apply(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for i, (op, future) in enumerate(batch):
+                # Cada operación en su savepoint: un error no tumba al resto del lote
+                conn.execute(f"SAVEPOINT op{i}")
+                try:
+                    results.append((future, op(conn), None))
+                    conn.execute(f"RELEASE op{i}")
+                except Exception as e:
+                    conn.execute(f"ROLLBACK TO op{i}")
+                    conn.execute(f"RELEASE op{i}")
+                    results.append((future, None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        self.ops += len(batch)
+        self.batches += 1
+        if self.batches % CHECKPOINT_EVERY == 0 and self._queue.empty():
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+_writer = _WriteQueue()
+
+
+def _write(op):
+    return _writer.submit(op)
+
+
+def write_stats():
+    batches = _writer.batches
+    return {
+        "writes": _writer.ops,
+        "commits": batches,
+        "avg_batch": round(_writer.ops / batches, 2) if batches else 0.0,
+    }
+
+
+# -----------------------------------------------------------------------------
+# API
+# -----------------------------------------------------------------------------
+
+def load_users():
+    conn = _connect()
+    return {"users": _fetch(conn, "SELECT * FROM users ORDER BY rowid", with_password=True)}
+
+
+def save_users(data):
+    # Compatibilidad: reemplaza el conjunto completo de usuarios en una transacción
+    users = [_with_hashed_password(u) for u in data.get("users", [])]
+
+    def op(conn):
+        keep = [_upsert(conn, u) for u in users]
+        existing = [r["id"] for r in conn.execute("SELECT id FROM users")]
+        gone = set(existing) - set(keep)
+        conn.executemany("DELETE FROM users WHERE id = ?", [(uid,) for uid in gone])
+
+    _write(op)
+    _reset_credentials()
+
+
+def get_user(user_id):
+    conn = _connect()
+    users = _fetch(conn, "SELECT * FROM users WHERE id = ?", (user_id,))
+    return users[0] if users else None
+
+
+def get_user_by_username(username):
+    conn = _connect()
+    users = _fetch(conn, "SELECT * FROM users WHERE username = ?", (username,))
+    return users[0] if users else None
+
+
+def list_users(role=None):
+    conn = _connect()
+    if role:
+        return _fetch(conn, "SELECT * FROM users WHERE role = ? ORDER BY rowid", (role,))
+    return _fetch(conn, "SELECT * FROM users ORDER BY rowid")
+
+
+def _user_filter(search, role):
+    where, params = [], []
+    if role:
+        where.append("u.role = ?")
+        params.append(role)
+    words = _search_text(search).split()
+    if words:
+        grams = set()
+        for word in words:
+            grams |= _grams(word)
+            # Trigramas: candidatos; instr() descarta coincidencias no contiguas
+            where.append("instr(' ' || s.text, ?) > 0" if len(word) < 3 else "instr(s.text, ?) > 0")
+            params.append(" " + word if len(word) < 3 else word)
+        marks = ", ".join("?" for _ in grams)
+        where.append(
+            f"u.id IN (SELECT user_id FROM user_grams WHERE gram IN ({marks})"
+            " GROUP BY user_id HAVING COUNT(*) = ?)"
+        )
+        params += [*grams, len(grams)]
+    clause = ("WHERE " + " AND ".join(where)) if where else ""
+    return "FROM users u JOIN user_search s ON s.user_id = u.id " + clause, params
+
+
+def query_users(search="", role=None, sort="name", descending=False, page=0, page_size=25):
+    # Devuelve (usuarios de la página, total que cumple el filtro)
+    source, params = _user_filter(search, role)
+    order = SORT_COLUMNS.get(sort, SORT_COLUMNS["name"])
+    direction = "DESC" if descending else "ASC"
+
+    conn = _connect()
+    total = conn.execute(f"SELECT COUNT(*) {source}", params).fetchone()[0]
+    users = _fetch(
+        conn,
+        f"SELECT u.* {source} ORDER BY {order} {direction}, u.rowid LIMIT ? OFFSET ?",
+        (*params, page_size, page * page_size)
+    )
+    return users, total
+
+
+def _kpis(row):
+    total = row["total"] if row else 0
+    return {
+        "total": total,
+        "active": row["active"] if row else 0,
+        "avg_progress": row["progress_sum"] / total if total else 0,
+    }
+
+
+def student_kpis(course=None, cohort=None):
+    # Lectura O(1) de los agregados mantenidos por los triggers
+    scope, key = ("course", course) if course else ("cohort", cohort) if cohort is not None else ("all", "")
+    row = _connect().execute(
+        "SELECT total, active, progress_sum FROM student_stats WHERE scope = ? AND key = ?", (scope, key)
+    ).fetchone()
+    return _kpis(row)
+
+
+def student_kpis_by(scope):
+    # Desglose por 'course' o 'cohort': {clave: kpis}
+    rows = _connect().execute(
+        "SELECT key, total, active, progress_sum FROM student_stats WHERE scope = ? AND total > 0 ORDER BY key",
+        (scope,)
+    ).fetchall()
+    return {r["key"]: _kpis(r) for r in rows}
+
+
+def update_user(user_id, **fields):
+    # Actualiza solo la fila del usuario (columnas propias y/o campos extra).
+    # Un cambio de contraseña cierra todas sus sesiones abiertas
+    return _update_user(user_id, fields, revoke="password" in fields)
+
+
+def _update_user(user_id, fields, revoke=False):
+    fields = _with_hashed_password(fields)
+
+    def op(conn):
+        row = conn.execute("SELECT data FROM users WHERE id = ?", (user_id,)).fetchone()
+        if row is None:
+            return False
+        cols, extra = _split(fields)
+        cols.pop("id", None)
+        if extra:
+            data = json.loads(row["data"] or "{}")
+            for k, v in extra.items():
+                if v is None:
+                    data.pop(k, None)
+                else:
+                    data[k] = v
+            cols["data"] = json.dumps(data, ensure_ascii=False)
+        if revoke:
+            conn.execute("UPDATE users SET session_version = session_version + 1 WHERE id = ?", (user_id,))
+        if cols:
+            assignments = ", ".join(f"{k} = ?" for k in cols)
+            conn.execute(f"UPDATE users SET {assignments} WHERE id = ?", (*cols.values(), user_id))
+            if any(k in cols for k in SEARCH_FIELDS):
+                _index_search(conn, user_id)
+        if "enrolled_courses" in fields:
+            conn.execute("DELETE FROM enrollments WHERE user_id = ?", (user_id,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO enrollments (user_id, course) VALUES (?, ?)",
+                [(user_id, c) for c in fields["enrolled_courses"] or []]
+            )
+        return True
+
+    if not _write(op):
+        return None
+    if "username" in fields or "password" in fields:
+        _reset_credentials()
+    return get_user(user_id)
+
+
+# Índice en memoria username -> (id, hash); se invalida en los cambios de credenciales
+_credentials = None
+# Sube con cada reset: un índice construido antes de un cambio de credenciales no se guarda
+_credentials_generation = 0
+_credentials_lock = threading.Lock()
+
+
+def _reset_credentials():
+    global _credentials, _credentials_generation
+    with _credentials_lock:
+        _credentials = None
+        _credentials_generation += 1
+
+
+def _credential(username):
+    global _credentials
+    while True:
+        with _credentials_lock:
+            index, generation = _credentials, _credentials_generation
+        if index is not None:
+            return index.get(username)
+        rows = _connect().execute("SELECT username, id, password FROM users").fetchall()
+        index = {r["username"]: (r["id"], r["password"]) for r in rows}
+        with _credentials_lock:
+            if generation == _credentials_generation:
+                _credentials = index
+                return index.get(username)
+        # Ha habido un reset durante la lectura: se vuelve a leer
+
+
+def authenticate(username, password, client_ip=None):
+    # Lanza auth.LoginThrottled si el usuario o la IP han agotado sus intentos
+    start = time.perf_counter()
+    throttle.check(username, client_ip)
+    try:
+        credential = _credential(username)
+        ok, needs_rehash = verify_password(password, credential[1] if credential else None)
+        if not ok:
+            throttle.failure(username, client_ip)
+            return None
+        throttle.success(username)
+        changes = {"last_access": datetime.now().strftime("%Y-%m-%d %H:%M")}
+        if needs_rehash:
+            # Contraseña heredada en claro o con otro coste: se actualiza el hash
+            # (es la misma contraseña: las sesiones abiertas siguen valiendo)
+            changes["password"] = password
+        return _update_user(credential[0], changes)
+    finally:
+        record_login_latency(time.perf_counter() - start)
+
+
+def _session_version(user_id):
+    row = _connect().execute("SELECT session_version FROM users WHERE id = ?", (user_id,)).fetchone()
+    return row["session_version"] if row else None
+
+
+def issue_session(user_id):
+    # Token de sesión firmado con la versión de sesión actual del usuario
+    return issue_token(user_id, version=_session_version(user_id) or 0)
+
+
+def user_from_session(token):
+    # Usuario del token si es válido y no se ha revocado; None en otro caso
+    user_id = verify_token(token, current_version=_session_version)
+    return get_user(user_id) if user_id else None
+
+
+def revoke_sessions(user_id):
+    # Invalida todos los tokens de sesión del usuario (logout, contraseña nueva)
+    def op(conn):
+        conn.execute("UPDATE users SET session_version = session_version + 1 WHERE id = ?", (user_id,))
+    _write(op)
+
+
+def _new_user(username, password, name, email, role='student', cohort=None):
+    return {
+        "id": uuid.uuid4().hex[:8],
+        "username": username,
+        "password": password,
+        "name": name,
+        "email": email,
+        "role": role,
+        "status": "Activo",
+        "progress": 0,
+        "last_access": "Nunca",
+        # Cohorte por defecto: mes de alta
+        "cohort": cohort or datetime.now().strftime("%Y-%m"),
+        "enrolled_courses": [],
+    }
+
+
+def add_user(username, password, name, email, role='student', cohort=None):
+    user = _new_user(username, password, name, email, role, cohort)
+    stored = _with_hashed_password(user)
+    try:
+        _write(lambda conn: _upsert(conn, stored))
+    except sqlite3.IntegrityError:
+        # Nombre de usuario ya existente
+        return None
+    _reset_credentials()
+    user.pop("password")
+    return user
+
+
+def add_users(records):
+    # Alta en bloque (una transacción). records: dicts con los argumentos de add_user;
+    # conviene pasar las contraseñas ya hasheadas. Devuelve (ids creados, usernames rechazados)
+    users = [_with_hashed_password(_new_user(**r)) for r in records]
+
+    def op(conn):
+        created, rejected = [], []
+        for user in users:
+            conn.execute("SAVEPOINT bulk_user")
+            try:
+                _upsert(conn, user)
+                created.append(user["id"])
+            except sqlite3.IntegrityError:
+                conn.execute("ROLLBACK TO bulk_user")
+                rejected.append(user["username"])
+            conn.execute("RELEASE bulk_user")
+        return created, rejected
+
+    result = _write(op)
+    _reset_credentials()
+    return result
+
+
+def existing_identities(usernames, emails):
+    # Qué usernames y emails ya están en uso (consultas por lotes sobre los índices)
+    conn = _connect()
+    taken = {"username": set(), "email": set()}
+    emails = {normalize_email(e) for e in emails}
+    for column, values in (("username", list(set(usernames))), ("email", list(emails))):
+        for i in range(0, len(values), 500):
+            part = values[i:i + 500]
+            marks = ", ".join("?" for _ in part)
+            taken[column].update(r[0] for r in conn.execute(f"SELECT {column} FROM users WHERE {column} IN ({marks})", part))
+    return taken["username"], taken["email"]
+
+
+def delete_user(user_id):
+    deleted = _write(lambda conn: conn.execute("DELETE FROM users WHERE id = ?", (user_id,)).rowcount > 0)
+    _reset_credentials()
+    return deleted
+
+
+def query_user_ids(search="", role=None):
+    # Ids de todos los usuarios que cumplen el filtro (para operaciones en bloque)
+    source, params = _user_filter(search, role)
+    return [r[0] for r in _connect().execute(f"SELECT u.id {source} ORDER BY u.rowid", params)]
+
+
+def resolve_users(identifiers):
+    # {usuario o email (tal como llega): id} para los identificadores que existen
+    conn = _connect()
+    found = {}
+    values = list(dict.fromkeys(i for i in identifiers if i))
+    for i in range(0, len(values), 400):
+        part = values[i:i + 400]
+        emails = [normalize_email(v) for v in part]
+        marks = ", ".join("?" for _ in part)
+        by_username, by_email = {}, {}
+        for row in conn.execute(
+            f"SELECT id, username, email FROM users WHERE username IN ({marks}) OR email IN ({marks})", part + emails
+        ):
+            by_username[row["username"]] = row["id"]
+            if row["email"]:
+                by_email[row["email"]] = row["id"]
+        for value, email in zip(part, emails):
+            user_id = by_username.get(value) or by_email.get(email)
+            if user_id:
+                found[value] = user_id
+    return found
+
+
+def set_enrollments(changes):
+    # changes: (user_id, curso, matricular) -> todo en una única transacción
+    enroll, unenroll = [], []
+    for user_id, course, enrolled in changes:
+        (enroll if enrolled else unenroll).append((user_id, course))
+
+    def op(conn):
+        added = conn.executemany(
+            "INSERT OR IGNORE INTO enrollments (user_id, course)"
+            " SELECT ?1, ?2 WHERE EXISTS (SELECT 1 FROM users WHERE id = ?1)", enroll
+        ).rowcount if enroll else 0
+        removed = conn.executemany(
+            "DELETE FROM enrollments WHERE user_id = ? AND course = ?", unenroll
+        ).rowcount if unenroll else 0
+        return {"enrolled": added, "unenrolled": removed}
+
+    return _write(op)
+
+
+def toggle_course_enrollment(user_id, course_name):
+    # Devuelve True si el alumno queda matriculado, False si se le da de baja
+    def op(conn):
+        cur = conn.execute("DELETE FROM enrollments WHERE user_id = ? AND course = ?", (user_id, course_name))
+        if cur.rowcount:
+            return False
+        conn.execute("INSERT INTO enrollments (user_id, course) VALUES (?, ?)", (user_id, course_name))
+        return True
+
+    return _write(op)
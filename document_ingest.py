@@ -0,0 +1,197 @@
+"""Ingesta de documentos por streaming (PDF, DOCX, TXT) con memoria acotada.
+
+Los documentos se leen página a página / párrafo a párrafo / línea a línea,
+se trocean en fragmentos y los fragmentos se añaden al índice vectorial por
+lotes pequeños según se producen, sin materializar nunca el texto completo
+del fichero. Esos fragmentos no se ven en las búsquedas ni cuentan como
+documento hasta que el fichero entero se ha procesado (register_file): si
+falla a medias, no queda nada a la vista.
+"""
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+CHUNK_CHARS = int(os.getenv("INGEST_CHUNK_CHARS", "1500"))
+CHUNK_OVERLAP = int(os.getenv("INGEST_CHUNK_OVERLAP", "200"))
+INGEST_BATCH = 64
+
+
+def _stream_size(stream):
+    try:
+        pos = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(pos)
+        return size
+    except (AttributeError, OSError):
+        return 0
+
+
+def iter_units(stream, file_name):
+    # Devuelve (texto, ubicación, hecho, total) por página, párrafo o línea
+    ext = Path(file_name).suffix.lower()
+    if ext == ".pdf":
+        from PyPDF2 import PdfReader
+        reader = PdfReader(stream)
+        total = len(reader.pages)
+        for i in range(total):
+            # PyPDF2 parsea cada página al accederla; no se retienen las anteriores
+            text = reader.pages[i].extract_text() or ""
+            yield text, i + 1, i + 1, total
+    elif ext == ".docx":
+        from docx import Document
+        paragraphs = Document(stream).paragraphs
+        total = len(paragraphs)
+        for i, para in enumerate(paragraphs):
+            yield para.text, i + 1, i + 1, total
+    else:
+        total = _stream_size(stream)
+        text_stream = io.TextIOWrapper(stream, encoding="utf-8", errors="replace")
+        try:
+            for line_no, line in enumerate(text_stream, start=1):
+                done = stream.tell() if total else line_no
+                yield line, line_no, done, total
+        finally:
+            # No cerrar el stream subyacente al destruir el wrapper
+            text_stream.detach()
+
+
+def iter_chunks(stream, file_name, chunk_chars=CHUNK_CHARS, overlap=CHUNK_OVERLAP, progress=None):
+    buf = ""
+    buf_location = None
+    for text, location, done, total in iter_units(stream, file_name):
+        if text:
+            if buf_location is None:
+                buf_location = location
+            buf += text if text.endswith("\n") else text + "\n"
+            while len(buf) >= chunk_chars:
+                yield {"text": buf[:chunk_chars], "source": file_name, "location": buf_location}
+                buf = buf[chunk_chars - overlap:]
+                buf_location = location
+        if progress:
+            progress(done, total)
+    if buf.strip():
+        yield {"text": buf, "source": file_name, "location": buf_location}
+
+
+def ingest_stream(store, stream, file_name, progress=None, batch_size=INGEST_BATCH, owner=""):
+    # Si el mismo contenido ya se ingirió (por cualquier usuario) se reutilizan
+    # sus fragmentos y embeddings sin volver a extraer nada. El documento solo
+    # lo ve el ámbito owner.
+    from vector_index import file_hash
+
+    content_hash = file_hash(stream)
+    size = _stream_size(stream)
+    if store.lookup_file(content_hash):
+        entry = store.attach_file(content_hash, file_name, owner)
+        if progress:
+            progress(1, 1)
+        return {"status": "success", "file_name": file_name, "chunks": entry["chunks"], "cached": True}
+
+    # Los fragmentos se embeben y guardan por lotes pequeños según se producen
+    # (ocultos hasta register_file: un error a medias no deja nada en las búsquedas)
+    rows = []
+    locations = []
+    batch = []
+    try:
+        for chunk in iter_chunks(stream, file_name, progress=progress):
+            batch.append(chunk)
+            locations.append(chunk["location"])
+            if len(batch) >= batch_size:
+                rows.extend(store.add_chunks(batch))
+                batch = []
+        if batch:
+            rows.extend(store.add_chunks(batch))
+    except Exception as e:
+        return {"status": "error", "file_name": file_name, "error": str(e), "chunks": len(rows)}
+    if not rows:
+        return {"status": "error", "file_name": file_name, "error": "No se pudo extraer texto del documento", "chunks": 0}
+    store.register_file(content_hash, file_name, size, rows, owner, locations)
+    return {"status": "success", "file_name": file_name, "chunks": len(rows), "cached": False}
+
+
+def extract_file_chunks(path, file_name):
+    # Se ejecuta en un proceso hijo: extracción y troceado (CPU) fuera del hilo del script
+    try:
+        with open(path, "rb") as f:
+            chunks = list(iter_chunks(f, file_name))
+    except Exception as e:
+        return {"status": "error", "file_name": file_name, "error": str(e)}
+    if not chunks:
+        return {"status": "error", "file_name": file_name, "error": "No se pudo extraer texto del documento"}
+    return {"status": "success", "file_name": file_name, "chunks": chunks}
+
+
+def default_workers():
+    return max(1, min(4, os.cpu_count() or 1))
+
+
+def ingest_parallel(store, files, max_workers=None, progress=None, owner=""):
+    # files: lista de (ruta, nombre). Los resultados se fusionan en el almacén
+    # desde el proceso principal según van terminando, en el ámbito owner.
+    from vector_index import file_hash
+
+    results = []
+    if not files:
+        return results
+    # Los ficheros ya conocidos (mismo hash de contenido) no llegan al pool
+    pending = []
+    for path, name in files:
+        with open(path, "rb") as f:
+            content_hash = file_hash(f)
+        if store.lookup_file(content_hash):
+            entry = store.attach_file(content_hash, name, owner)
+            results.append({"status": "success", "file_name": name, "chunks": entry["chunks"], "cached": True})
+            if progress:
+                progress(len(results), len(files), name)
+        else:
+            pending.append((path, name, content_hash))
+    if not pending:
+        return results
+    # "spawn" evita heredar los hilos de Streamlit en los procesos hijos
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers or default_workers(), mp_context=ctx) as executor:
+        futures = {executor.submit(extract_file_chunks, path, name): (path, name, h) for path, name, h in pending}
+        for future in as_completed(futures):
+            path, name, content_hash = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"status": "error", "file_name": name, "error": str(e)}
+            if result["status"] == "success":
+                chunks = result.pop("chunks")
+                rows = []
+                try:
+                    for i in range(0, len(chunks), INGEST_BATCH):
+                        rows.extend(store.add_chunks(chunks[i:i + INGEST_BATCH]))
+                except Exception as e:
+                    # Las filas ya añadidas siguen ocultas (no se registra el fichero)
+                    result = {"status": "error", "file_name": name, "error": str(e), "chunks": len(rows)}
+                else:
+                    store.register_file(
+                        content_hash, name, os.path.getsize(path), rows, owner, [c["location"] for c in chunks]
+                    )
+                    result["chunks"] = len(chunks)
+                    result["cached"] = False
+            results.append(result)
+            if progress:
+                progress(len(results), len(files), name)
+    return results
+
+
+def build_context_prompt(question, chunks):
+    if not chunks:
+        return question
+    context = "\n\n".join(f"[{c['source']} · {c.get('location', '?')}]\n{c['text']}" for c in chunks)
+    return (
+        "Usa el siguiente contexto de los documentos del curso si es relevante para responder.\n\n"
+        f"{context}\n\nPregunta: {question}"
+    )
+
+
+def get_document_store():
+    # El almacén de documentos del tutor es el índice vectorial persistente
+    from vector_index import get_vector_index
+    return get_vector_index()
@@ -0,0 +1,298 @@
+"""Cola de trabajos en segundo plano para las llamadas largas al LLM.
+
+Generar un test, completar un trabajo o "Mejorar con IA" se envían como
+trabajos: la sesión solo guarda el id y consulta su estado, así que un rerun,
+cambiar de página o reconectar no pierde el resultado (se recupera por
+usuario con latest()). Los trabajos se guardan en una tabla SQLite
+(jobs.sqlite3) y los ejecuta un pool de hilos del proceso; al arrancar, los
+que estaban en marcha cuando se paró la app vuelven a la cola.
+
+Cada intento tiene un tiempo máximo; los fallos y los timeouts se
+reintentan con espera exponencial hasta max_attempts. Un trabajo en cola se
+cancela al momento y uno en marcha se abandona en cuanto se pide: el
+handler recibe cancelled() y lo consulta entre pasos (no espera turno ni
+llama al proveedor si se cumple), y su resultado se descarta. Un reintento
+no sale hasta que el hilo del intento anterior ha terminado, para no tener
+dos llamadas del mismo trabajo a la vez.
+"""
+import importlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+
+JOBS_DB_PATH = Path(os.getenv("JOBS_DB_PATH", Path(__file__).parent / "jobs.sqlite3"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_TIMEOUT_SECONDS = int(os.getenv("JOB_TIMEOUT", "180"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Los trabajos terminados se borran tras este tiempo
+JOB_RETENTION_SECONDS = 7 * 24 * 3600
+RETRY_BASE_SECONDS = 2
+# Espera máxima a que termine el intento abandonado antes de reintentar
+ORPHAN_WAIT_SECONDS = JOB_TIMEOUT_SECONDS
+LATENCY_SAMPLES = 500
+
+# Tipo de trabajo -> "módulo:función(tipo, params, deadline=, cancelled=)" que lo ejecuta (se importa al primer uso)
+JOB_HANDLERS = {
+    "generate_test": "tutor_pool:run_tutor_job",
+    "complete_assignment": "tutor_pool:run_tutor_job",
+    "generate_response": "tutor_pool:run_tutor_job",
+}
+
+PENDING = ("queued", "running")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    owner TEXT NOT NULL DEFAULT '',
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    timeout REAL NOT NULL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_owner ON jobs(owner, kind, created);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created);
+"""
+
+
+class JobFailed(Exception):
+    pass
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0, "p50": None, "p95": None}
+    return {
+        "count": len(samples),
+        "p50": samples[len(samples) // 2],
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+    }
+
+
+class JobQueue:
+    def __init__(self, path=JOBS_DB_PATH, workers=JOB_WORKERS, handlers=None):
+        self._handlers = dict(JOB_HANDLERS if handlers is None else handlers)
+        self._resolved = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._queue = queue.Queue()
+        self._cancelled = set()
+        self._waits = deque(maxlen=LATENCY_SAMPLES)
+        self._runs = deque(maxlen=LATENCY_SAMPLES)
+        self.retries = 0
+        self.timeouts = 0
+        self._recover()
+        for n in range(max(1, workers)):
+            threading.Thread(target=self._worker, name=f"job-worker-{n}", daemon=True).start()
+
+    def _execute(self, sql, params=()):
+        # Una sola conexión compartida: consulta y lectura de filas bajo el lock
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            columns = [c[0] for c in cursor.description or ()]
+            return columns, cursor.fetchall()
+
+    def _recover(self):
+        # Lo que quedó a medias al parar la app vuelve a la cola, en orden de llegada
+        now = time.time()
+        self._execute(
+            "DELETE FROM jobs WHERE status NOT IN ('queued', 'running') AND finished < ?",
+            (now - JOB_RETENTION_SECONDS,)
+        )
+        self._execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+        for (job_id,) in self._execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created")[1]:
+            self._queue.put(job_id)
+
+    def submit(self, kind, params, owner="", timeout=JOB_TIMEOUT_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        if kind not in self._handlers:
+            raise ValueError(f"Tipo de trabajo desconocido: {kind}")
+        job_id = uuid.uuid4().hex
+        self._execute(
+            "INSERT INTO jobs (id, kind, owner, params, status, max_attempts, timeout, created)"
+            " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+            (job_id, kind, str(owner), json.dumps(params, ensure_ascii=False), max_attempts, timeout, time.time())
+        )
+        self._queue.put(job_id)
+        return job_id
+
+    def _row(self, where, params):
+        columns, rows = self._execute(f"SELECT * FROM jobs WHERE {where}", params)
+        if not rows:
+            return None
+        job = dict(zip(columns, rows[0]))
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def get(self, job_id):
+        return self._row("id = ?", (job_id,))
+
+    def latest(self, owner, kind):
+        # Último trabajo del usuario de ese tipo (para recuperarlo tras reconectar)
+        return self._row("owner = ? AND kind = ? ORDER BY created DESC LIMIT 1", (str(owner), kind))
+
+    def cancel(self, job_id):
+        # Devuelve False si el trabajo ya había terminado
+        with self._lock:
+            updated = self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id)
+            ).rowcount
+            if updated:
+                return True
+            running = self._conn.execute(
+                "SELECT 1 FROM jobs WHERE id = ? AND status = 'running'", (job_id,)
+            ).fetchone()
+            if running:
+                self._cancelled.add(job_id)
+            return bool(running)
+
+    def _handler(self, kind):
+        if kind not in self._resolved:
+            module, name = self._handlers[kind].split(":")
+            self._resolved[kind] = getattr(importlib.import_module(module), name)
+        return self._resolved[kind]
+
+    def _claim(self, job_id):
+        # Pasa el trabajo a "running" si sigue en cola (otro worker o una cancelación pueden ganarle)
+        with self._lock:
+            now = time.time()
+            claimed = self._conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, started = ?"
+                " WHERE id = ? AND status = 'queued'",
+                (now, job_id)
+            ).rowcount
+        if not claimed:
+            return None
+        job = self.get(job_id)
+        if job["attempts"] == 1:
+            self._waits.append(now - job["created"])
+        return job
+
+    def _call(self, job):
+        # La llamada va en su propio hilo para poder abandonarla por timeout o cancelación;
+        # devuelve (resultado, valor, hilo) y el hilo puede seguir vivo si se abandonó
+        outcome = {}
+        deadline = time.monotonic() + job["timeout"]
+        stop = threading.Event()
+
+        def cancelled():
+            return stop.is_set() or time.monotonic() >= deadline
+
+        def target():
+            try:
+                outcome["result"] = self._handler(job["kind"])(
+                    job["kind"], job["params"], deadline=deadline, cancelled=cancelled
+                )
+            except Exception as e:
+                outcome["error"] = e
+
+        thread = threading.Thread(target=target, name=f"job-{job['id'][:8]}", daemon=True)
+        thread.start()
+        while thread.is_alive():
+            if job["id"] in self._cancelled:
+                stop.set()
+                return "cancelled", None, thread
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                stop.set()
+                self.timeouts += 1
+                return "timeout", None, thread
+            thread.join(min(0.5, remaining))
+        if "error" in outcome:
+            return "error", outcome["error"], thread
+        result = outcome.get("result")
+        if isinstance(result, dict) and result.get("status") == "error":
+            # Error del proveedor devuelto como resultado (cuota, red...)
+            error = JobFailed(result.get("error") or result.get("answer") or result.get("message") or "Error del proveedor")
+            return "error", error, thread
+        return "done", result, thread
+
+    def _finish(self, job_id, status, result=None, error=None):
+        self._execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? WHERE id = ?",
+            (status, None if result is None else json.dumps(result, ensure_ascii=False, default=str),
+             error, time.time(), job_id)
+        )
+        with self._lock:
+            self._cancelled.discard(job_id)
+
+    def _retry(self, job_id, delay, previous):
+        # Vuelve a encolar tras la espera, y solo cuando el intento anterior ha terminado
+        time.sleep(delay)
+        previous.join(ORPHAN_WAIT_SECONDS)
+        if previous.is_alive():
+            self._execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE id = ? AND status = 'queued'",
+                ("El intento anterior sigue en marcha", time.time(), job_id)
+            )
+            return
+        self._queue.put(job_id)
+
+    def _worker(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                job = self._claim(job_id)
+                if job is None:
+                    continue
+                outcome, value, thread = self._call(job)
+                if outcome == "done":
+                    self._runs.append(time.time() - job["started"])
+                    self._finish(job_id, "done", result=value)
+                elif outcome == "cancelled":
+                    self._finish(job_id, "cancelled")
+                else:
+                    error = "Tiempo de espera agotado" if outcome == "timeout" else str(value) or type(value).__name__
+                    if job["attempts"] < job["max_attempts"]:
+                        self.retries += 1
+                        self._execute("UPDATE jobs SET status = 'queued', error = ? WHERE id = ?", (error, job_id))
+                        delay = RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1)
+                        threading.Thread(
+                            target=self._retry, args=(job_id, delay, thread), name=f"job-retry-{job_id[:8]}", daemon=True
+                        ).start()
+                    else:
+                        self._finish(job_id, "failed", error=error)
+            except Exception as e:
+                self._finish(job_id, "failed", error=str(e))
+
+    def stats(self):
+        counts = dict(self._execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")[1])
+        return {
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "cancelled": counts.get("cancelled", 0),
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "wait": _percentiles(self._waits),
+            "run": _percentiles(self._runs),
+        }
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
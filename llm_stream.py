@@ -0,0 +1,175 @@
+"""Streaming de respuestas token a token para los proveedores del tutor."""
+import json
+import os
+import threading
+import time
+import urllib.request
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+_ttft_samples = []
+_ttft_lock = threading.Lock()
+MAX_TTFT_SAMPLES = 500
+
+
+class StreamError(Exception):
+    pass
+
+
+# Variable de entorno con la clave de cada proveedor si el handle no trae una propia
+API_KEY_ENV = {"gemini": "GOOGLE_API_KEY", "openai": "OPENAI_API_KEY", "mistral": "MISTRAL_API_KEY"}
+
+
+def _api_key(provider, api_key):
+    # La clave del handle es la de Gemini (GOOGLE_API_KEY o la introducida en la app):
+    # solo vale para gemini. El resto de proveedores (también como respaldo) usan la suya
+    if provider == "gemini" and api_key and not str(api_key).startswith("dummy_key"):
+        return api_key
+    return os.getenv(API_KEY_ENV.get(provider, ""), "")
+
+
+def _client(provider, api_key):
+    # Un cliente configurado por proveedor y huella de credenciales, reutilizado entre
+    # peticiones y sesiones (nada de configuración global del SDK por petición)
+    from tutor_pool import credentials_fingerprint
+
+    cache_key = (provider, credentials_fingerprint(provider, api_key))
+    with _clients_lock:
+        client = _clients.get(cache_key)
+        if client is not None:
+            return client
+
+    if provider == "gemini":
+        from google.ai import generativelanguage as glm
+        client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+    elif provider == "openai":
+        from openai import OpenAI
+        client = OpenAI(api_key=api_key)
+    elif provider == "mistral":
+        try:
+            from mistralai import Mistral
+            client = Mistral(api_key=api_key)
+        except ImportError:
+            from mistralai.client import MistralClient
+            client = MistralClient(api_key=api_key)
+    else:
+        raise StreamError(f"Proveedor sin cliente de streaming: {provider}")
+
+    with _clients_lock:
+        _clients[cache_key] = client
+    return client
+
+
+def _stream_gemini(model_name, prompt, api_key):
+    import google.generativeai as genai
+    model = genai.GenerativeModel(model_name)
+    # Cliente propio en lugar del global de genai.configure()
+    model._client = _client("gemini", api_key)
+    for chunk in model.generate_content(prompt, stream=True):
+        try:
+            text = chunk.text
+        except ValueError:
+            # Fragmentos sin texto (p. ej. bloqueados por seguridad)
+            continue
+        if text:
+            yield text
+
+
+def _stream_openai(model_name, prompt, api_key):
+    client = _client("openai", api_key)
+    stream = client.chat.completions.create(
+        model=model_name,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True
+    )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def _stream_mistral(model_name, prompt, api_key):
+    client = _client("mistral", api_key)
+    if hasattr(client, "chat") and hasattr(client.chat, "stream"):
+        for event in client.chat.stream(model=model_name, messages=[{"role": "user", "content": prompt}]):
+            delta = event.data.choices[0].delta.content if event.data.choices else None
+            if delta:
+                yield delta
+    else:
+        from mistralai.models.chat_completion import ChatMessage
+        for chunk in client.chat_stream(model=model_name, messages=[ChatMessage(role="user", content=prompt)]):
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield delta
+
+
+def _stream_ollama(model_name, prompt, api_key=None):
+    host = os.getenv("OLLAMA_API_HOST", "http://localhost:11434").rstrip("/")
+    body = json.dumps({
+        "model": model_name,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": True
+    }).encode("utf-8")
+    req = urllib.request.Request(f"{host}/api/chat", data=body, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=300) as resp:
+        for line in resp:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            if data.get("error"):
+                raise StreamError(data["error"])
+            text = data.get("message", {}).get("content", "")
+            if text:
+                yield text
+            if data.get("done"):
+                break
+
+
+STREAMERS = {
+    "gemini": _stream_gemini,
+    "openai": _stream_openai,
+    "mistral": _stream_mistral,
+    "ollama": _stream_ollama,
+}
+
+
+def stream_completion(provider, model_name, prompt, api_key=None):
+    # api_key: la del TutorHandle (solo se usa con gemini); si no, la variable de entorno del proveedor
+    streamer = STREAMERS.get(provider)
+    if streamer is None:
+        raise StreamError(f"Proveedor no soportado para streaming: {provider}")
+    return streamer(model_name, prompt, _api_key(provider, api_key))
+
+
+def record_ttft(seconds):
+    with _ttft_lock:
+        _ttft_samples.append(seconds)
+        if len(_ttft_samples) > MAX_TTFT_SAMPLES:
+            del _ttft_samples[:len(_ttft_samples) - MAX_TTFT_SAMPLES]
+
+
+def ttft_stats():
+    with _ttft_lock:
+        samples = sorted(_ttft_samples)
+    if not samples:
+        return {"count": 0, "avg": None, "p50": None, "p95": None}
+    return {
+        "count": len(samples),
+        "avg": sum(samples) / len(samples),
+        "p50": samples[len(samples) // 2],
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+    }
+
+
+def timed_stream(tokens, on_first_token=None):
+    # Envuelve un iterador de tokens midiendo el tiempo hasta el primer token
+    start = time.perf_counter()
+    first = True
+    for token in tokens:
+        if first:
+            first = False
+            ttft = time.perf_counter() - start
+            record_ttft(ttft)
+            if on_first_token:
+                on_first_token(ttft)
+        yield token
@@ -0,0 +1,512 @@
+"""Materiales del curso: almacén por contenido y descarga bajo demanda.
+
+Cada fichero se guarda una sola vez, como blob con nombre su sha256, en
+course_materials/.blobs; el manifiesto (materials_manifest.json) es el
+índice nombre -> blob con el tamaño y el tipo MIME, así que listar los
+materiales no lee ningún fichero y subir el mismo PDF con otro nombre no
+ocupa más disco. Los formatos que comprimen bien (texto, DOCX, PDF sin
+comprimir...) se guardan con gzip si una muestra ahorra al menos un 10 % y
+no pasan de MATERIALS_COMPRESS_MAX_MB (un Range sobre un .gz obliga a
+descomprimir desde el principio), y se descomprimen al vuelo al servirlos.
+Los ficheros sueltos que aparezcan en course_materials (p. ej. copiados a
+mano) los incorpora un hilo en segundo plano al arrancar y cada
+LOOSE_SCAN_SECONDS, cuando llevan un rato sin cambiar. Los blobs que ya no
+referencia ningún nombre se borran con collect_garbage().
+
+Las descargas no pasan por el websocket de Streamlit: un pequeño servidor
+HTTP (hilo del mismo proceso, puerto MATERIALS_PORT) sirve cada fichero en
+streaming con soporte de Range (descargas reanudables) y ETag (el sha256).
+Los enlaces van firmados y caducan, como los tokens de sesión.
+
+El mismo servidor recibe las subidas por trozos del temario (uploads.py).
+Por defecto solo escucha en localhost; para que lo usen los navegadores hay
+que publicarlo (MATERIALS_HOST=0.0.0.0 en una LAN, o MATERIALS_PUBLIC_URL
+detrás del proxy HTTPS de la app). Si no es accesible, server_url() devuelve
+None y la app vuelve a st.download_button y st.file_uploader.
+"""
+import gzip
+import hashlib
+import hmac
+import json
+import mimetypes
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+from auth import sign
+
+APP_DIR = Path(__file__).parent
+MATERIALS_DIR = APP_DIR / "course_materials"
+BLOBS_DIR = MATERIALS_DIR / ".blobs"
+MANIFEST_PATH = APP_DIR / "materials_manifest.json"
+MATERIALS_HOST = os.getenv("MATERIALS_HOST", "127.0.0.1")
+MATERIALS_PORT = int(os.getenv("MATERIALS_PORT", "8502"))
+# URL pública del servidor de descargas (obligatoria si la app va por HTTPS)
+MATERIALS_PUBLIC_URL = os.getenv("MATERIALS_PUBLIC_URL", "")
+LINK_TTL_SECONDS = int(os.getenv("MATERIALS_LINK_TTL", str(6 * 3600)))
+STREAM_CHUNK = 256 * 1024
+MATERIALS_COMPRESS = os.getenv("MATERIALS_COMPRESS", "1") != "0"
+# Los ficheros más grandes se guardan sin comprimir para servir los Range sin recorrerlos
+COMPRESS_MAX_BYTES = int(os.getenv("MATERIALS_COMPRESS_MAX_MB", "64")) * 1024 * 1024
+# Se comprime si la muestra queda por debajo de este ratio
+COMPRESS_RATIO = 0.9
+COMPRESS_SAMPLE = 256 * 1024
+# Formatos ya comprimidos: ni se intenta
+COMPRESSED_SUFFIXES = {
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp",
+    ".mp3", ".m4a", ".ogg", ".mp4", ".mov", ".avi", ".mkv", ".webm",
+}
+# Los blobs recién escritos no se recogen (pueden estar a punto de indexarse)
+GC_GRACE_SECONDS = 3600
+# Ficheros sueltos: cada cuánto se buscan y cuánto deben llevar sin cambiar (pueden estar copiándose)
+LOOSE_SCAN_SECONDS = 300
+LOOSE_MIN_AGE_SECONDS = 60
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _worth_compressing(path, name):
+    if not MATERIALS_COMPRESS or Path(name).suffix.lower() in COMPRESSED_SUFFIXES:
+        return False
+    if os.path.getsize(path) > COMPRESS_MAX_BYTES:
+        return False
+    with open(path, "rb") as f:
+        sample = f.read(COMPRESS_SAMPLE)
+    return len(sample) >= 512 and len(zlib.compress(sample, 6)) < len(sample) * COMPRESS_RATIO
+
+
+class Manifest:
+    def __init__(self, directory=MATERIALS_DIR, path=MANIFEST_PATH, blobs=None):
+        self.directory = Path(directory)
+        self.path = Path(path)
+        self.blobs = Path(blobs) if blobs else self.directory / ".blobs"
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._index = None
+        self._stamp = None
+
+    def _blob(self, sha256):
+        # Ruta del blob (comprimido o no) o None si no existe
+        base = self.blobs / sha256[:2] / sha256
+        for path in (base.with_name(sha256 + ".gz"), base):
+            if path.exists():
+                return path
+        return None
+
+    def _refresh(self):
+        # Relee el índice si otro proceso lo ha cambiado; descarta entradas sin blob
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if self._index is not None and stamp == self._stamp:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                loaded = json.load(f)
+        except (OSError, ValueError):
+            loaded = []
+        self._index = {e["name"]: e for e in loaded if "stored" in e and self._blob(e["sha256"])}
+        self._stamp = stamp
+
+    def _save(self):
+        tmp = self.path.with_suffix(".json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(sorted(self._index.values(), key=lambda e: e["name"].lower()), f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        st = os.stat(self.path)
+        self._stamp = (st.st_mtime_ns, st.st_size)
+
+    def _store(self, path, name):
+        # Guarda el contenido de path como blob (se consume el fichero) y devuelve su entrada
+        sha256 = _file_hash(path)
+        size = os.path.getsize(path)
+        blob = self._blob(sha256)
+        if blob is None:
+            target = self.blobs / sha256[:2] / sha256
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if _worth_compressing(path, name):
+                blob = target.with_name(sha256 + ".gz")
+                tmp = target.with_name(sha256 + ".gz.tmp")
+                with open(path, "rb") as src, open(tmp, "wb") as raw:
+                    with gzip.GzipFile(filename="", mode="wb", fileobj=raw, compresslevel=6, mtime=0) as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+                    raw.flush()
+                    os.fsync(raw.fileno())
+                os.replace(tmp, blob)
+                os.unlink(path)
+            else:
+                blob = target
+                shutil.move(path, blob)
+        else:
+            # Contenido repetido: basta con otro nombre apuntando al mismo blob
+            os.unlink(path)
+        os.utime(blob)
+        return {
+            "name": name,
+            "size": size,
+            "sha256": sha256,
+            "mime": mimetypes.guess_type(name)[0] or "application/octet-stream",
+            "stored": blob.stat().st_size,
+            "compressed": blob.suffix == ".gz",
+        }
+
+    def add(self, name, path):
+        # Incorpora el fichero path con el nombre name (sustituye al anterior si lo hay)
+        entry = self._store(path, name)
+        with self._lock:
+            self._refresh()
+            self._index[name] = entry
+            self._save()
+        return entry
+
+    def ingest_loose(self, min_age=LOOSE_MIN_AGE_SECONDS):
+        # Incorpora los ficheros sueltos de course_materials; devuelve cuántos.
+        # Los modificados hace menos de min_age se dejan para la siguiente pasada
+        added = 0
+        with self._scan_lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            now = time.time()
+            for item in os.scandir(self.directory):
+                try:
+                    if not item.is_file() or item.name.startswith("."):
+                        continue
+                    if now - item.stat().st_mtime < min_age:
+                        continue
+                    self.add(item.name, item.path)
+                    added += 1
+                except FileNotFoundError:
+                    # Lo han movido o borrado mientras tanto
+                    continue
+        return added
+
+    def entries(self):
+        # Solo el índice: no toca el directorio
+        with self._lock:
+            self._refresh()
+            return sorted(self._index.values(), key=lambda e: e["name"].lower())
+
+    def remove(self, name):
+        with self._lock:
+            self._refresh()
+            if self._index.pop(name, None) is None:
+                return False
+            self._save()
+        return True
+
+    def collect_garbage(self, grace=GC_GRACE_SECONDS):
+        # Borra los blobs sin ningún nombre que los use; devuelve (blobs, bytes) liberados
+        removed = freed = 0
+        now = time.time()
+        with self._lock:
+            self._refresh()
+            referenced = {e["sha256"] for e in self._index.values()}
+            for path in self.blobs.glob("*/*"):
+                if path.name.split(".")[0] in referenced and not path.name.endswith(".tmp"):
+                    continue
+                st = path.stat()
+                if now - st.st_mtime < grace:
+                    continue
+                path.unlink(missing_ok=True)
+                removed += 1
+                freed += st.st_size
+        return removed, freed
+
+    def report(self):
+        # Espacio que ahorran la deduplicación y la compresión
+        entries = self.entries()
+        unique = {e["sha256"]: e for e in entries}
+        logical = sum(e["size"] for e in entries)
+        unique_bytes = sum(e["size"] for e in unique.values())
+        stored = sum(e["stored"] for e in unique.values())
+        return {
+            "files": len(entries),
+            "blobs": len(unique),
+            "compressed": sum(1 for e in unique.values() if e["compressed"]),
+            "logical_bytes": logical,
+            "stored_bytes": stored,
+            "saved_dedup": logical - unique_bytes,
+            "saved_compression": unique_bytes - stored,
+        }
+
+    def find(self, sha256):
+        with self._lock:
+            self._refresh()
+            for entry in self._index.values():
+                if entry["sha256"] == sha256:
+                    return entry
+        return None
+
+    def open(self, entry):
+        # Siempre devuelve el contenido original (los blobs .gz se descomprimen al leer)
+        blob = self._blob(entry["sha256"])
+        if blob is None:
+            raise FileNotFoundError(entry["name"])
+        if blob.suffix == ".gz":
+            return gzip.open(blob, "rb")
+        return open(blob, "rb")
+
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def _scan_loose(manifest):
+    while True:
+        try:
+            manifest.ingest_loose()
+        except OSError:
+            pass
+        time.sleep(LOOSE_SCAN_SECONDS)
+
+
+def get_manifest():
+    global _manifest
+    with _manifest_lock:
+        if _manifest is None:
+            _manifest = Manifest()
+            threading.Thread(target=_scan_loose, args=(_manifest,), name="materials-scan", daemon=True).start()
+        return _manifest
+
+
+def human_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def _link_payload(sha256, expires):
+    return f"material:{sha256}.{expires}"
+
+
+def _is_loopback(hostname):
+    return hostname in ("localhost", "127.0.0.1", "::1")
+
+
+def server_url(host=None, secure=False):
+    # URL del servidor de materiales para el navegador, o None si no puede usarlo.
+    # host: cabecera Host de la petición a la app; secure: la app va por HTTPS
+    if not ensure_server():
+        return None
+    if MATERIALS_PUBLIC_URL:
+        return MATERIALS_PUBLIC_URL.rstrip("/")
+    hostname = urlsplit(f"//{host or 'localhost'}").hostname or "localhost"
+    # Un enlace http:// desde una página https:// lo bloquea el navegador
+    if secure or (_is_loopback(MATERIALS_HOST) and not _is_loopback(hostname)):
+        return None
+    if ":" in hostname:
+        hostname = f"[{hostname}]"
+    return f"http://{hostname}:{MATERIALS_PORT}"
+
+
+def download_url(entry, base_url, ttl=LINK_TTL_SECONDS):
+    # Enlace firmado y con caducidad; base_url viene de server_url()
+    expires = int(time.time() + ttl)
+    sig = sign(_link_payload(entry["sha256"], expires))
+    return f"{base_url}/{entry['sha256']}/{quote(entry['name'])}?exp={expires}&sig={sig}"
+
+
+class _MaterialsHandler(BaseHTTPRequestHandler):
+    server_version = "CourseMaterials/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _resolve(self):
+        parts = urlsplit(self.path)
+        segments = parts.path.strip("/").split("/", 1)
+        query = parse_qs(parts.query)
+        try:
+            sha256 = segments[0]
+            expires = int(query["exp"][0])
+            signature = query["sig"][0]
+        except (IndexError, KeyError, ValueError):
+            return None
+        if expires < time.time() or not hmac.compare_digest(signature, sign(_link_payload(sha256, expires))):
+            return None
+        entry = get_manifest().find(sha256)
+        if entry is None:
+            return None
+        name = unquote(segments[1]) if len(segments) > 1 else entry["name"]
+        return entry, name
+
+    def _range(self, size, etag):
+        # (inicio, fin) inclusivo, None para el fichero completo o "invalid"
+        header = self.headers.get("Range")
+        if not header:
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range != etag:
+            return None
+        match = _RANGE_RE.match(header.strip())
+        if not match or match.groups() == ("", ""):
+            return None
+        first, last = match.groups()
+        if first == "":
+            length = int(last)
+            if length == 0:
+                return "invalid"
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start >= size or start > end:
+            return "invalid"
+        return start, end
+
+    def _serve(self, send_body):
+        resolved = self._resolve()
+        if resolved is None:
+            self.send_error(404, "Enlace no válido o caducado")
+            return
+        entry, name = resolved
+        etag = f'"{entry["sha256"]}"'
+        size = entry["size"]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        byte_range = self._range(size, etag)
+        if byte_range == "invalid":
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return
+        start, end = byte_range or (0, size - 1)
+        length = end - start + 1 if size else 0
+
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Type", entry["mime"])
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "private, max-age=3600")
+        self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(name)}")
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not send_body or not length:
+            return
+        with get_manifest().open(entry) as f:
+            f.seek(start)
+            remaining = length
+            while remaining > 0:
+                data = f.read(min(STREAM_CHUNK, remaining))
+                if not data:
+                    break
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                remaining -= len(data)
+
+    def _cors(self):
+        # Las subidas llegan desde la página de la app (otro puerto); van con token, no con cookies
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, PUT, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, X-Chunk-CRC32")
+
+    def _json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self._cors()
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _upload(self, method):
+        # /uploads (alta o reanudación), /uploads/<id> (estado),
+        # /uploads/<id>/<n> (trozo n) y /uploads/<id>/complete
+        import uploads
+
+        parts = urlsplit(self.path)
+        segments = parts.path.strip("/").split("/")[1:]
+        token = parse_qs(parts.query).get("token", [""])[0]
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            if method == "POST" and not segments:
+                if length > 4096:
+                    raise uploads.UploadError(413, "Petición demasiado grande")
+                body = json.loads(self.rfile.read(length) or b"{}")
+                result = uploads.start_upload(body.get("token"), body.get("name"), body.get("size"), body.get("modified", 0))
+            elif method == "GET" and len(segments) == 1:
+                result = uploads.upload_status(token, segments[0])
+            elif method == "POST" and len(segments) == 2 and segments[1] == "complete":
+                result = {"name": uploads.finish_upload(token, segments[0])}
+            elif method == "PUT" and len(segments) == 2 and segments[1].isdigit():
+                received, chunks = uploads.write_chunk(
+                    token, segments[0], int(segments[1]), self.rfile, length, self.headers.get("X-Chunk-CRC32", "")
+                )
+                result = {"received": received, "chunks": chunks}
+            else:
+                raise uploads.UploadError(404, "Ruta desconocida")
+        except uploads.UploadError as e:
+            # El cuerpo puede haber quedado a medio leer: se cierra la conexión
+            self.close_connection = True
+            self._json(e.status, {"error": str(e)})
+            return
+        except ValueError:
+            self.close_connection = True
+            self._json(400, {"error": "Petición no válida"})
+            return
+        self._json(200, result)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self._cors()
+        self.send_header("Access-Control-Max-Age", "86400")
+        self.end_headers()
+
+    def do_POST(self):
+        self._upload("POST")
+
+    def do_PUT(self):
+        self._upload("PUT")
+
+    def do_GET(self):
+        if self.path.startswith("/uploads"):
+            self._upload("GET")
+            return
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def ensure_server():
+    # Arranca (una vez por proceso) el servidor de descargas en segundo plano
+    global _server
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((MATERIALS_HOST, MATERIALS_PORT), _MaterialsHandler)
+            except OSError:
+                # Puerto ocupado: la app usa la descarga y la subida de Streamlit
+                _server = False
+                return False
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="materials-server", daemon=True).start()
+        return bool(_server)
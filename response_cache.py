@@ -0,0 +1,188 @@
+"""Caché persistente de respuestas del LLM (memoria LRU + SQLite en disco).
+
+La clave combina proveedor, modelo, tipo de petición, prompt normalizado y
+parámetros de generación. Las entradas caducan por TTL y el fichero se
+mantiene por debajo de un número máximo de entradas (se descartan las menos
+usadas recientemente).
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+CACHE_PATH = Path(os.getenv("LLM_CACHE_PATH", Path(__file__).parent / "llm_cache.sqlite3"))
+CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "256"))
+# Cada cuántas escrituras se ejecuta la purga por TTL / tamaño
+EVICT_EVERY = 50
+
+
+def normalize_prompt(prompt):
+    text = unicodedata.normalize("NFC", str(prompt))
+    return " ".join(text.split())
+
+
+def make_key(provider, model_name, kind, prompt, params=None):
+    payload = json.dumps(
+        [provider, model_name, kind, normalize_prompt(prompt), params or {}],
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_cacheable(value):
+    # Los errores del proveedor (cuota, red...) nunca se guardan
+    if value is None:
+        return False
+    if isinstance(value, dict) and value.get("status") == "error":
+        return False
+    return True
+
+
+class ResponseCache:
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES,
+                 memory_entries=MEMORY_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL,"
+            " last_access REAL NOT NULL, latency REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_access ON llm_cache(last_access)")
+        self._puts = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.latency_saved = 0.0
+
+    def _remember(self, key, value, expires, latency):
+        self._memory[key] = (value, expires, latency)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, expires, latency = entry
+                if expires > now:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    self.latency_saved += latency
+                    return value
+                del self._memory[key]
+
+            row = self._conn.execute(
+                "SELECT value, created, latency FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] + self.ttl <= now:
+                if row is not None:
+                    self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            value = json.loads(row[0])
+            self._remember(key, value, row[1] + self.ttl, row[2])
+            self.disk_hits += 1
+            self.latency_saved += row[2]
+            return value
+
+    def put(self, key, value, latency):
+        now = time.time()
+        try:
+            encoded = json.dumps(value, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            self._remember(key, value, now + self.ttl, latency)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created, last_access, latency) VALUES (?, ?, ?, ?, ?)",
+                (key, encoded, now, now, latency)
+            )
+            self._puts += 1
+            if self._puts % EVICT_EVERY == 0:
+                self._evict(now)
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM llm_cache WHERE created <= ?", (now - self.ttl,))
+        self._conn.execute(
+            "DELETE FROM llm_cache WHERE key IN ("
+            " SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def cached_call(self, fn, provider, model_name, kind, prompt, params=None, use_cache=True, served=None,
+                    fallbacks=()):
+        # served(): (proveedor, modelo) que ha generado de verdad la respuesta, si puede no ser el pedido.
+        # fallbacks: (proveedor, modelo) cuyas respuestas valen si no hay la del pedido (p. ej. el
+        # respaldo mientras el primario está limitado); las respuestas del respaldo solo se guardan
+        # con su clave, así que con el primario sano no se sirven en su lugar
+        if not use_cache:
+            with self._lock:
+                self.bypassed += 1
+            return fn()
+        key = make_key(provider, model_name, kind, prompt, params)
+        value = self.get(key)
+        if value is not None:
+            return value
+        for alt_provider, alt_model in fallbacks:
+            value = self.get(make_key(alt_provider, alt_model, kind, prompt, params))
+            if value is not None:
+                return value
+        start = time.perf_counter()
+        value = fn()
+        if is_cacheable(value):
+            if served is not None and served() != (provider, model_name):
+                # Respuesta del respaldo: no debe servirse como si fuera del primario
+                key = make_key(*served(), kind, prompt, params)
+            self.put(key, value, time.perf_counter() - start)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute("DELETE FROM llm_cache")
+
+    def stats(self):
+        with self._lock:
+            disk_entries = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+                "latency_saved_seconds": round(self.latency_saved, 2),
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
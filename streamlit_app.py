@@ -6,6 +6,7 @@ from pathlib import Path
 import os
 from dotenv import load_dotenv
 import tempfile
+import shutil
 
 # Cargar variables de entorno
 load_dotenv()
@@ -20,19 +21,11 @@ def get_base64_image(image_path):
     except:
         return ""
 
-# Cargar configuración
-def load_config():
-    config_path = Path(__file__).parent / "config.json"
-    with open(config_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+# Cargar configuración (solo se re-parsea si config.json cambia en disco)
+from config_store import load_config, save_config, compile_theme_css
 
 config = load_config()
 
-def save_config(config):
-    config_path = Path(__file__).parent / "config.json"
-    with open(config_path, "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=4, ensure_ascii=False)
-
 def render_admin_panel(config):
     st.title("⚙️ Panel de Configuración")
     
@@ -74,7 +67,7 @@ def render_admin_panel(config):
             config["theme"]["bg_color"] = new_bg_color
             config["theme"]["font_family"] = new_font
             save_config(config)
-            st.success("¡Estilo actualizado! Recarga la página.")
+            st.success("¡Estilo actualizado!")
             st.rerun()
 
     with tab2:
@@ -131,9 +124,69 @@ def render_admin_panel(config):
                 st.success("API Keys guardadas correctamente. Reinicia la app si es necesario.")
                 load_dotenv(override=True)
                 # Forzar recarga del tutor para que coja las nuevas keys inmediatamente
+                from tutor_pool import get_tutor_pool
+                get_tutor_pool().clear()
                 st.session_state.tutor = None
                 st.rerun()
 
+        with st.expander("📊 Pool de motores IA"):
+            from tutor_pool import get_tutor_pool
+            pool_stats = get_tutor_pool().stats()
+            m1, m2, m3 = st.columns(3)
+            m1.metric("Motores vivos", pool_stats["live_engines"])
+            m2.metric("Tasa de aciertos", f"{pool_stats['hit_rate'] * 100:.0f}%")
+            m3.metric("Memoria aprox.", f"{pool_stats['approx_memory_bytes'] / 1024 / 1024:.1f} MB")
+            st.json(pool_stats)
+
+        with st.expander("⚡ Caché y latencias IA"):
+            from response_cache import get_response_cache
+            cache_stats = get_response_cache().stats()
+            st.markdown("**Caché de respuestas IA**")
+            k1, k2, k3 = st.columns(3)
+            k1.metric("Aciertos", cache_stats["memory_hits"] + cache_stats["disk_hits"])
+            k2.metric("Fallos", cache_stats["misses"])
+            k3.metric("Tiempo ahorrado", f"{cache_stats['latency_saved_seconds']:.0f} s")
+            if st.button("🧹 Vaciar caché de respuestas"):
+                get_response_cache().clear()
+                st.rerun()
+
+            from llm_stream import ttft_stats
+            ttft = ttft_stats()
+            if ttft["count"]:
+                st.caption(f"Tiempo hasta primer token (chat): p50 {ttft['p50']:.2f} s · p95 {ttft['p95']:.2f} s · {ttft['count']} respuestas")
+
+            from auth import login_stats
+            logins = login_stats()
+            if logins["count"]:
+                st.caption(f"Latencia de login: p50 {logins['p50'] * 1000:.0f} ms · p95 {logins['p95'] * 1000:.0f} ms · {logins['count']} intentos · {logins['rejected']} bloqueados")
+
+        with st.expander("🧵 Cola de trabajos IA"):
+            from job_queue import get_job_queue
+            job_stats = get_job_queue().stats()
+            j1, j2, j3, j4 = st.columns(4)
+            j1.metric("En cola", job_stats["queued"])
+            j2.metric("En curso", job_stats["running"])
+            j3.metric("Espera p95", f"{job_stats['wait']['p95']:.1f} s" if job_stats['wait']['p95'] is not None else "—")
+            j4.metric("Duración p95", f"{job_stats['run']['p95']:.1f} s" if job_stats['run']['p95'] is not None else "—")
+            st.json(job_stats)
+
+        with st.expander("🚦 Admisión por proveedor IA"):
+            from admission import admission_stats
+            gate_stats = admission_stats()
+            if not gate_stats:
+                st.caption("Aún no se ha llamado a ningún proveedor.")
+            for provider_key, g in gate_stats.items():
+                st.markdown(f"**{provider_key}** · {g['in_flight']}/{g['max_in_flight'] or '∞'} en curso · {g['waiting']} esperando"
+                            + (f" · ⏸️ pausado {g['paused_seconds']:.0f} s por límite del proveedor" if g['paused_seconds'] else ""))
+                st.progress(min(1.0, g['saturation']))
+                a1, a2, a3, a4 = st.columns(4)
+                a1.metric("Admitidas", g['admitted'])
+                a2.metric("Rechazadas", g['rejected'])
+                a3.metric("Límites (429)", g['throttled'])
+                a4.metric("Desviadas al respaldo", g['failovers'])
+            if gate_stats:
+                st.json(gate_stats)
+
     with tab4:
         st.subheader("Despliegue y Móvil")
         st.subheader("📱 Acceso Móvil (Red Local)")
@@ -214,37 +267,44 @@ def render_admin_panel(config):
         st.subheader("Gestión de Imágenes")
         st.write("Sube nuevas imágenes para personalizar tu plataforma.")
         
+        from asset_store import save_image, asset_path
+        
+        # Cada imagen se guarda por hash de contenido; config.json apunta al asset
+        def update_theme_image(uploaded, theme_key, message):
+            from PIL import Image, UnidentifiedImageError
+            try:
+                new_path = asset_path(save_image(uploaded))
+            except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+                st.error(f"❌ {uploaded.name} no es una imagen válida o está dañada.")
+                return
+            if config["theme"].get(theme_key) != new_path:
+                config["theme"][theme_key] = new_path
+                save_config(config)
+                st.success(message)
+        
         # Hero Image
         st.markdown("### 🖼️ Imagen Principal (Hero)")
         hero_file = st.file_uploader("Subir imagen Hero", type=["png", "jpg", "jpeg"], key="hero_upload")
         if hero_file:
-            with open(config["theme"]["hero_image"], "wb") as f:
-                f.write(hero_file.getbuffer())
-            st.success("Imagen Hero actualizada!")
+            update_theme_image(hero_file, "hero_image", "Imagen Hero actualizada!")
 
         # Module 1
         st.markdown("### 📦 Imagen Módulo 1")
         m1_file = st.file_uploader("Subir imagen Módulo 1", type=["png", "jpg", "jpeg"], key="m1_upload")
         if m1_file:
-            with open(config["theme"]["module1_image"], "wb") as f:
-                f.write(m1_file.getbuffer())
-            st.success("Imagen Módulo 1 actualizada!")
+            update_theme_image(m1_file, "module1_image", "Imagen Módulo 1 actualizada!")
 
         # Module 2
         st.markdown("### 📦 Imagen Módulo 2")
         m2_file = st.file_uploader("Subir imagen Módulo 2", type=["png", "jpg", "jpeg"], key="m2_upload")
         if m2_file:
-            with open(config["theme"]["module2_image"], "wb") as f:
-                f.write(m2_file.getbuffer())
-            st.success("Imagen Módulo 2 actualizada!")
+            update_theme_image(m2_file, "module2_image", "Imagen Módulo 2 actualizada!")
 
         # App Icon
         st.markdown("### 🌟 Icono de la Aplicación")
         icon_file = st.file_uploader("Subir nuevo icono", type=["png", "jpg", "jpeg"], key="icon_upload")
         if icon_file:
-            with open(config["theme"]["app_icon"], "wb") as f:
-                f.write(icon_file.getbuffer())
-            st.success("Icono de la aplicación actualizado!")
+            update_theme_image(icon_file, "app_icon", "Icono de la aplicación actualizado!")
 
 # Configuración de la página
 st.set_page_config(
@@ -405,15 +465,17 @@ p, span, div {
 </script>
 """
 
-# Inyectar variables manualmente
-css_styles = css_styles.replace('CUSTOM_FONT', font)
-css_styles = css_styles.replace('PRIMARY_COLOR', p_color)
-css_styles = css_styles.replace('SECONDARY_COLOR', s_color)
-css_styles = css_styles.replace('BG_COLOR', bg_main)
-css_styles = css_styles.replace('SIDEBAR_BG', sidebar_bg)
-css_styles = css_styles.replace('CARD_BG', card_bg)
-css_styles = css_styles.replace('TEXT_MAIN', text_main)
-css_styles = css_styles.replace('TEXT_MUTED', text_muted)
+# Inyectar variables (compilado una vez por versión del tema y compartido entre sesiones)
+css_styles = compile_theme_css(css_styles, {
+    'CUSTOM_FONT': font,
+    'PRIMARY_COLOR': p_color,
+    'SECONDARY_COLOR': s_color,
+    'BG_COLOR': bg_main,
+    'SIDEBAR_BG': sidebar_bg,
+    'CARD_BG': card_bg,
+    'TEXT_MAIN': text_main,
+    'TEXT_MUTED': text_muted,
+})
 
 st.markdown(css_styles, unsafe_allow_html=True)
 
@@ -424,8 +486,12 @@ if 'tutor_provider' not in st.session_state:
     st.session_state.tutor_provider = config.get('ai_models', {}).get('default_provider', 'gemini')
 if 'tutor_model' not in st.session_state:
     st.session_state.tutor_model = config.get('ai_models', {}).get('default_model', 'gemini-1.5-flash')
-if 'chat_messages' not in st.session_state:
-    st.session_state.chat_messages = []
+if 'chat_history' not in st.session_state:
+    from chat_history import ChatHistory
+    st.session_state.chat_history = ChatHistory()
+if 'chat_window' not in st.session_state:
+    from chat_history import RENDER_WINDOW
+    st.session_state.chat_window = RENDER_WINDOW
 if 'generated_test' not in st.session_state:
     st.session_state.generated_test = None
 if 'generated_work' not in st.session_state:
@@ -434,19 +500,62 @@ if 'generated_work' not in st.session_state:
 # Intentar inicializar el tutor AI
 try:
     if st.session_state.tutor is None:
-        from ai_tutor import AITutor
-        api_key_to_use = os.getenv('GOOGLE_API_KEY')
-        if not api_key_to_use:
-             api_key_to_use = "dummy_key_for_local_models"
+        from tutor_pool import get_tutor_pool, session_api_key, TutorHandle
+        api_key_to_use = session_api_key()
              
-        st.session_state.tutor = AITutor(
-            api_key_to_use, 
-            provider=st.session_state.tutor_provider,
-            model_name=st.session_state.tutor_model
+        # El motor AITutor se comparte entre sesiones; la sesión solo guarda un handle
+        st.session_state.tutor = TutorHandle(
+            get_tutor_pool(),
+            st.session_state.tutor_provider,
+            st.session_state.tutor_model,
+            api_key_to_use,
+            history=st.session_state.chat_history
         )
 except Exception as e:
     st.session_state.tutor_error = str(e)
 
+JOB_STATUS_LABELS = {"queued": "⏳ En cola", "running": "⚙️ Generando", "done": "✅ Listo", "failed": "❌ Error", "cancelled": "✖️ Cancelado"}
+
+def job_owner():
+    # Los trabajos se recuperan por usuario (sobreviven a reruns y reconexiones)
+    user = st.session_state.get('user_info') or {}
+    return str(user.get('id') or user.get('email') or '')
+
+def current_job(session_key, kind):
+    # Trabajo enviado en esta sesión o, tras reconectar, el último del usuario
+    from job_queue import get_job_queue
+    job_id = st.session_state.get(session_key)
+    job = get_job_queue().get(job_id) if job_id else get_job_queue().latest(job_owner(), kind)
+    if job:
+        st.session_state[session_key] = job['id']
+    return job
+
+def cancel_job(job_id):
+    from job_queue import get_job_queue
+    get_job_queue().cancel(job_id)
+
+def render_pending_job(job, label, auto_refresh=True):
+    # Estado del trabajo con botón de cancelar; se refresca solo si Streamlit tiene fragmentos periódicos
+    attempt = f" (intento {job['attempts']} de {job['max_attempts']})" if job['attempts'] > 1 else ""
+    st.info(f"{JOB_STATUS_LABELS[job['status']]}: {label}{attempt}")
+    if job['attempts'] > 1 and job.get('error'):
+        st.caption(f"Último error: {job['error']}")
+    c_cancel, c_check = st.columns(2)
+    c_cancel.button("✖️ Cancelar", key=f"cancel_{job['id']}", on_click=cancel_job, args=(job['id'],))
+    fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+    if auto_refresh and fragment is not None:
+        try:
+            @fragment(run_every=2)
+            def poll_job():
+                from job_queue import PENDING, get_job_queue
+                if get_job_queue().get(job['id'])['status'] not in PENDING:
+                    st.rerun()
+            poll_job()
+            return
+        except TypeError:
+            pass
+    c_check.button("🔄 Comprobar", key=f"check_{job['id']}")
+
 def render_tutor_chat():
     st.markdown(f"# {config['tutor_section']['title']}")
     with st.expander("🧠 Configuración del Modelo de IA", expanded=False):
@@ -488,11 +597,13 @@ def render_tutor_chat():
 
     if st.session_state.tutor is None:
         try:
-             from ai_tutor import AITutor
-             st.session_state.tutor = AITutor(
-                "dummy_key", 
-                provider=st.session_state.tutor_provider,
-                model_name=st.session_state.tutor_model
+             from tutor_pool import get_tutor_pool, TutorHandle
+             st.session_state.tutor = TutorHandle(
+                get_tutor_pool(),
+                st.session_state.tutor_provider,
+                st.session_state.tutor_model,
+                "dummy_key",
+                history=st.session_state.chat_history
             )
         except:
             pass
@@ -502,6 +613,8 @@ def render_tutor_chat():
         st.error(f"Error al inicializar el tutor AI: {error_msg}")
         st.info("Intenta seleccionar 'Ollama' en la configuración si no tienes claves API.")
     else:
+        # Documentos del tutor por usuario: cada uno solo consulta lo que ha subido
+        st.session_state.tutor.owner = job_owner()
         tab1, tab2, tab3, tab4 = st.tabs([
             config['tutor_section']['tabs']['chat'],
             config['tutor_section']['tabs']['documents'],
@@ -511,34 +624,53 @@ def render_tutor_chat():
         with tab1:
             st.markdown(f"### {config['tutor_section']['chat']['title']}")
             chat_container = st.container()
+            chat_history = st.session_state.chat_history
             with chat_container:
-                if len(st.session_state.chat_messages) == 0:
+                if len(chat_history) == 0:
                     st.info(config['tutor_section']['chat']['empty_message'])
                 else:
-                    for message in st.session_state.chat_messages:
+                    # Solo se pinta la ventana más reciente; el resto bajo demanda
+                    hidden, visible_messages = chat_history.window(st.session_state.chat_window)
+                    if hidden or chat_history.summary:
+                        c_more, c_info = st.columns([1, 2])
+                        if hidden and c_more.button(f"⬆️ Cargar anteriores ({hidden})", key="chat_load_more"):
+                            from chat_history import RENDER_WINDOW
+                            st.session_state.chat_window += RENDER_WINDOW
+                            st.rerun()
+                        if chat_history.summary:
+                            c_info.caption("🗂️ Los mensajes más antiguos se han resumido para el contexto del tutor.")
+                    for message in visible_messages:
                         with st.chat_message(message["role"]):
                             st.markdown(message["content"])
             
             if prompt := st.chat_input(config['tutor_section']['chat']['placeholder']):
-                st.session_state.chat_messages.append({"role": "user", "content": prompt})
+                chat_history.append("user", prompt)
                 with chat_container:
                     with st.chat_message("user"):
                         st.markdown(prompt)
                 
                 with st.chat_message("assistant"):
-                    with st.spinner(config['tutor_section']['chat']['loading_message']):
-                        response_obj = st.session_state.tutor.answer_question(prompt)
-                        if isinstance(response_obj, dict):
-                            answer_text = response_obj.get('answer', str(response_obj))
-                            if response_obj.get('status') == 'error':
-                                st.error(answer_text)
-                            else:
-                                st.markdown(answer_text)
-                        else:
-                            answer_text = str(response_obj)
-                            st.markdown(answer_text)
-                        
-                        st.session_state.chat_messages.append({"role": "assistant", "content": answer_text})
+                    # Pintar los tokens según llegan (refresco limitado para no saturar el websocket)
+                    placeholder = st.empty()
+                    placeholder.caption(config['tutor_section']['chat']['loading_message'])
+                    parts = []
+                    last_paint = 0.0
+                    try:
+                        for token in st.session_state.tutor.answer_question_stream(prompt):
+                            parts.append(token)
+                            now = time.monotonic()
+                            if now - last_paint > 0.05:
+                                placeholder.markdown("".join(parts) + "▌")
+                                last_paint = now
+                        answer_text = "".join(parts)
+                        placeholder.markdown(answer_text)
+                        if st.session_state.tutor.last_ttft is not None:
+                            st.caption(f"⏱️ Primer token en {st.session_state.tutor.last_ttft:.2f} s")
+                    except Exception as e:
+                        answer_text = "".join(parts) or str(e)
+                        placeholder.error(answer_text)
+                    
+                    chat_history.append("assistant", answer_text)
 
         with tab2:
             st.markdown(f"### {config['tutor_section']['documents']['title']}")
@@ -548,36 +680,97 @@ def render_tutor_chat():
                 accept_multiple_files=True
             )
             
+            ingest_cfg = config.get('ingestion', {})
+            c_par, c_workers = st.columns([2, 1])
+            parallel_mode = c_par.checkbox(
+                "⚡ Procesar varios archivos en paralelo",
+                value=ingest_cfg.get('parallel', True),
+                help="Reparte la extracción de texto entre varios procesos"
+            )
+            max_workers = c_workers.number_input(
+                "Procesos",
+                min_value=1,
+                max_value=os.cpu_count() or 1,
+                value=min(ingest_cfg.get('max_workers', 4), os.cpu_count() or 1),
+                disabled=not parallel_mode
+            )
+            
             if st.button(config['tutor_section']['documents']['upload_button']):
                 if uploaded_files:
-                    with st.spinner(config['tutor_section']['documents']['processing_message']):
-                        success_count = 0
-                        errors = []
-                        for file in uploaded_files:
-                            # Crear archivo temporal para procesar
-                            with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.name).suffix) as tmp:
-                                tmp.write(file.getvalue())
-                                tmp_path = tmp.name
+                    st.caption(config['tutor_section']['documents']['processing_message'])
+                    progress_bar = st.progress(0.0)
+                    success_count = 0
+                    cached_count = 0
+                    errors = []
+                    if parallel_mode and len(uploaded_files) > 1:
+                        # Volcar cada subida a disco por bloques para que los procesos la lean por ruta
+                        tmp_files = []
+                        try:
+                            for file in uploaded_files:
+                                file.seek(0)
+                                with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.name).suffix) as tmp:
+                                    shutil.copyfileobj(file, tmp, 1024 * 1024)
+                                    tmp_files.append((tmp.name, file.name))
+                            
+                            def report_file(done, total, name):
+                                progress_bar.progress(done / total, text=f"{name} ({done}/{total})")
+                            
+                            results = st.session_state.tutor.ingest_parallel(tmp_files, max_workers=int(max_workers), progress=report_file)
+                            for result in results:
+                                if result.get("status") == "success":
+                                    success_count += 1
+                                    cached_count += 1 if result.get("cached") else 0
+                                else:
+                                    errors.append(f"{result.get('file_name')}: {result.get('error')}")
+                        except Exception as e:
+                            errors.append(str(e))
+                        finally:
+                            for tmp_path, _ in tmp_files:
+                                if os.path.exists(tmp_path):
+                                    os.unlink(tmp_path)
+                    else:
+                        for n, file in enumerate(uploaded_files):
+                            # Avance real por página / párrafo / línea en lugar de un spinner
+                            def report(done, total, _n=n, _name=file.name):
+                                fraction = (_n + (done / total if total else 1)) / len(uploaded_files)
+                                progress_bar.progress(min(fraction, 1.0), text=f"{_name}: {done}/{total or '?'}")
                             try:
-                                result = st.session_state.tutor.ingest_file(tmp_path, file_name=file.name)
+                                # Se lee directamente del fichero subido, sin copia completa ni temporal
+                                file.seek(0)
+                                result = st.session_state.tutor.ingest_stream(file, file.name, progress=report)
                                 if result.get("status") == "success":
                                     success_count += 1
+                                    cached_count += 1 if result.get("cached") else 0
                                 else:
                                     errors.append(f"{file.name}: {result.get('error')}")
                             except Exception as e:
                                 errors.append(f"{file.name}: {str(e)}")
-                            finally:
-                                if os.path.exists(tmp_path):
-                                    os.unlink(tmp_path)
-                        
-                        if success_count > 0:
-                            st.success(f"✅ {success_count} documentos procesados correctamente.")
-                        
-                        if errors:
-                            for err in errors:
-                                st.error(f"❌ Error: {err}")
+                    progress_bar.progress(1.0)
+                    
+                    if success_count > 0:
+                        st.success(f"✅ {success_count} documentos procesados correctamente.")
+                    if cached_count > 0:
+                        st.info(f"♻️ {cached_count} ya estaban indexados y se han reutilizado sin reprocesar.")
+                    
+                    if errors:
+                        for err in errors:
+                            st.error(f"❌ Error: {err}")
                 else:
                     st.warning(config['tutor_section']['documents']['no_files_message'])
+            
+            from document_ingest import get_document_store
+            doc_store = get_document_store()
+            dedup = doc_store.dedup_stats()
+            if dedup["file_hits"] or dedup["chunk_hits"]:
+                d1, d2, d3 = st.columns(3)
+                d1.metric("♻️ Archivos reutilizados", dedup["file_hits"])
+                d2.metric("♻️ Fragmentos reutilizados", dedup["chunk_hits"])
+                d3.metric("💾 Ahorrado", f"{dedup['bytes_saved'] / 1024 / 1024:.1f} MB")
+            indexed_docs = doc_store.documents(owner=job_owner())
+            if indexed_docs:
+                with st.expander(f"📚 Documentos indexados ({len(indexed_docs)})"):
+                    for doc_name, n_chunks in sorted(indexed_docs.items()):
+                        st.caption(f"📄 {doc_name} · {n_chunks} fragmentos")
 
         with tab3:
             st.markdown(f"### {config['tutor_section']['tests']['title']}")
@@ -591,14 +784,25 @@ def render_tutor_chat():
                 options=['Básico', 'Intermedio', 'Avanzado']
             )
             
+            fresh_test = st.checkbox("🎲 Generar una versión nueva (sin caché)", key="fresh_test")
+            
             if st.button(config['tutor_section']['tests']['generate_button'], use_container_width=True):
                 if test_topic:
-                    with st.spinner(config['tutor_section']['tests']['generating_message']):
-                        test = st.session_state.tutor.generate_test(test_topic, num_q, difficulty)
-                        st.session_state.generated_test = test
+                    # Trabajo en segundo plano: la generación sigue aunque se cambie de página
+                    st.session_state.test_job = st.session_state.tutor.submit_job(
+                        "generate_test", test_topic, num_q, difficulty, owner=job_owner(), use_cache=not fresh_test
+                    )
                 else:
                     st.warning("Por favor introduce un tema para el test.")
             
+            test_job = current_job('test_job', 'generate_test')
+            if test_job and test_job['status'] in ('queued', 'running'):
+                render_pending_job(test_job, config['tutor_section']['tests']['generating_message'])
+            elif test_job and test_job['status'] == 'failed':
+                st.error(f"❌ {test_job['error']}")
+            elif test_job and test_job['status'] == 'done':
+                st.session_state.generated_test = test_job['result']
+            
             if st.session_state.generated_test:
                 st.markdown("---")
                 st.json(st.session_state.generated_test)
@@ -625,13 +829,22 @@ def render_tutor_chat():
                 format_func=lambda x: config['tutor_section']['assignments']['type_options'][x]
             )
             
+            fresh_work = st.checkbox("🎲 Generar una versión nueva (sin caché)", key="fresh_work")
+            
             if st.button(config['tutor_section']['assignments']['generate_button'], use_container_width=True):
                 if assignment_desc:
-                    with st.spinner(config['tutor_section']['assignments']['generating_message']):
-                        result = st.session_state.tutor.complete_assignment(assignment_desc, assignment_type)
-                        if result['status'] == 'success':
-                            st.session_state.generated_work = result
-                            st.success("✅ Trabajo generado correctamente")
+                    st.session_state.work_job = st.session_state.tutor.submit_job(
+                        "complete_assignment", assignment_desc, assignment_type, owner=job_owner(), use_cache=not fresh_work
+                    )
+            
+            work_job = current_job('work_job', 'complete_assignment')
+            if work_job and work_job['status'] in ('queued', 'running'):
+                render_pending_job(work_job, config['tutor_section']['assignments']['generating_message'])
+            elif work_job and work_job['status'] == 'failed':
+                st.error(f"❌ {work_job['error']}")
+            elif work_job and work_job['status'] == 'done' and st.session_state.generated_work != work_job['result']:
+                st.session_state.generated_work = work_job['result']
+                st.success("✅ Trabajo generado correctamente")
             
             if st.session_state.generated_work:
                 st.markdown("---")
@@ -651,6 +864,68 @@ if 'auth_status' not in st.session_state:
 if 'user_info' not in st.session_state:
     st.session_state.user_info = None
 
+# Proxies propios (IPs o redes, separadas por comas) cuyo X-Forwarded-For es de fiar
+TRUSTED_PROXIES = [p.strip() for p in os.getenv("TRUSTED_PROXIES", "").split(",") if p.strip()]
+
+def _is_trusted_proxy(ip):
+    import ipaddress
+    try:
+        address = ipaddress.ip_address(ip)
+        return any(address in ipaddress.ip_network(p, strict=False) for p in TRUSTED_PROXIES)
+    except ValueError:
+        return False
+
+def client_ip():
+    # IP del cliente para el throttling del login. X-Forwarded-For lo escribe el cliente:
+    # solo se usa si la petición llega de un proxy propio, y se toma el último salto
+    # que no es uno de ellos (los anteriores los puede inventar el cliente)
+    try:
+        peer = getattr(st.context, "ip_address", None)
+        forwarded = st.context.headers.get("X-Forwarded-For")
+    except AttributeError:
+        return None
+    if not forwarded or not peer or not _is_trusted_proxy(peer):
+        return peer
+    for hop in reversed([h.strip() for h in forwarded.split(",") if h.strip()]):
+        if not _is_trusted_proxy(hop):
+            return hop
+    return peer
+
+def request_host():
+    # Host con el que el navegador ha llegado a la app (para enlaces a otros puertos)
+    try:
+        return st.context.headers.get("Host")
+    except AttributeError:
+        return None
+
+def request_is_secure():
+    # La app se sirve por HTTPS (directamente o detrás de un proxy)
+    try:
+        headers = st.context.headers
+    except AttributeError:
+        return False
+    proto = (headers.get("X-Forwarded-Proto") or "").split(",")[0].strip().lower()
+    return proto == "https" or (headers.get("Origin") or "").startswith("https://")
+
+def materials_url():
+    # URL del servidor de materiales o None si hay que usar la descarga/subida de Streamlit
+    from materials import server_url
+    return server_url(request_host(), request_is_secure())
+
+# Token de sesión de la URL: restaura la sesión al recargar y, si se ha revocado
+# (logout en otra pestaña, cambio de contraseña) o caducado, la cierra también aquí
+if st.query_params.get("session"):
+    from data_manager import user_from_session
+    session_user = user_from_session(st.query_params["session"])
+    if session_user:
+        if not st.session_state.auth_status:
+            st.session_state.auth_status = session_user['role']
+            st.session_state.user_info = session_user
+    else:
+        del st.query_params["session"]
+        st.session_state.auth_status = None
+        st.session_state.user_info = None
+
 def login_form():
     st.markdown("## 🔐 Iniciar Sesión")
     
@@ -660,12 +935,18 @@ def login_form():
         submitted = st.form_submit_button("Entrar", use_container_width=True)
         
         if submitted:
-            from data_manager import authenticate
-            user = authenticate(username, password)
+            from auth import LoginThrottled
+            from data_manager import authenticate, issue_session
+            try:
+                user = authenticate(username, password, client_ip=client_ip())
+            except LoginThrottled as e:
+                st.error(f"⏳ {e}")
+                return
             
             if user:
                 st.session_state.auth_status = user['role']
                 st.session_state.user_info = user
+                st.query_params["session"] = issue_session(user['id'])
                 
                 if user['role'] == 'admin':
                     st.toast(f"👋 ¡Hola {user['name']}!", icon="👨‍🏫")
@@ -802,8 +1083,12 @@ with st.sidebar:
     
     st.markdown("---")
     if st.button("🚪 Cerrar Sesión", key=f"sidebar_logout_{st.session_state.user_info.get('id','anon')}", use_container_width=True):
+        # Revoca el token: una copia de la URL (historial, enlace compartido) deja de valer
+        from data_manager import revoke_sessions
+        revoke_sessions(st.session_state.user_info.get('id'))
         st.session_state.auth_status = None
         st.session_state.user_info = None
+        st.query_params.pop("session", None)
         st.rerun()
             
     menu = st.session_state.menu_choice
@@ -813,24 +1098,31 @@ with st.sidebar:
 # -----------------------------------------------------------------------------
 
 if menu == "Mi Perfil":
-    from data_manager import load_users, save_users
-    
-    # Cargar datos actualizados para asegurar persistencia
-    all_users_data = load_users()
-    current_user_idx = next((i for i, u in enumerate(all_users_data['users']) if u['id'] == st.session_state.user_info['id']), None)
+    from data_manager import get_user, update_user
     
-    if current_user_idx is not None:
-        user_data = all_users_data['users'][current_user_idx]
-    else:
-        user_data = st.session_state.user_info
+    # Cargar datos actualizados (consulta indexada por id, una sola fila)
+    stored_user = get_user(st.session_state.user_info['id'])
+    user_exists = stored_user is not None
+    user_data = stored_user if user_exists else st.session_state.user_info
 
     u_name = user_data.get('name', 'Estudiante')
     u_initial = u_name[0] if u_name else 'E'
-    u_avatar = user_data.get('avatar', None)
+    
+    from asset_store import save_image, asset_url
+    # Migrar avatares antiguos (base64 dentro del JSON de usuarios) al almacén de assets
+    if user_data.get('avatar') and user_exists:
+        try:
+            user_data['avatar_id'] = save_image(base64.b64decode(user_data.pop('avatar')))
+            update_user(user_data['id'], avatar_id=user_data['avatar_id'], avatar=None)
+        except Exception:
+            pass
+    u_avatar_url = asset_url(user_data['avatar_id'], 128) if user_data.get('avatar_id') else None
     
     # --- DISEÑO DE PERFIL ---
-    if u_avatar:
-        avatar_inner = f'<img src="data:image/png;base64,{u_avatar}" style="width:100%; height:100%; object-fit:cover;">'
+    if u_avatar_url:
+        avatar_inner = f'<img src="{u_avatar_url}" style="width:100%; height:100%; object-fit:cover;">'
+    elif user_data.get('avatar'):
+        avatar_inner = f'<img src="data:image/png;base64,{user_data["avatar"]}" style="width:100%; height:100%; object-fit:cover;">'
     else:
         avatar_inner = u_initial
 
@@ -853,8 +1145,7 @@ if menu == "Mi Perfil":
         new_name = st.text_input("Nombre Completo", value=u_name)
         if new_name != u_name:
             user_data['name'] = new_name
-            all_users_data['users'][current_user_idx] = user_data
-            save_users(all_users_data)
+            update_user(user_data['id'], name=new_name)
             st.session_state.user_info = user_data
             st.rerun()
             
@@ -862,15 +1153,21 @@ if menu == "Mi Perfil":
     with c2:
         with st.expander("📸 Cambiar Foto"):
             uploaded_file = st.file_uploader("Sube tu imagen", type=['png', 'jpg', 'jpeg'])
+            avatar_id = None
             if uploaded_file:
-                bytes_data = uploaded_file.getvalue()
-                base64_str = base64.b64encode(bytes_data).decode()
-                user_data['avatar'] = base64_str
-                all_users_data['users'][current_user_idx] = user_data
-                save_users(all_users_data)
-                st.session_state.user_info = user_data
-                st.success("¡Foto actualizada!")
-                st.rerun()
+                from PIL import Image, UnidentifiedImageError
+                try:
+                    avatar_id = save_image(uploaded_file)
+                except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+                    st.error("❌ El archivo no es una imagen válida o está dañado.")
+            if avatar_id:
+                if avatar_id != user_data.get('avatar_id'):
+                    user_data['avatar_id'] = avatar_id
+                    user_data.pop('avatar', None)
+                    update_user(user_data['id'], avatar_id=avatar_id, avatar=None)
+                    st.session_state.user_info = user_data
+                    st.success("¡Foto actualizada!")
+                    st.rerun()
 
     st.write("") # Spacer
 
@@ -883,8 +1180,7 @@ if menu == "Mi Perfil":
             new_bio = st.text_area("Sobre mí", value=bio, placeholder="Cuéntanos algo sobre ti...")
             if st.button("Guardar Biografía"):
                 user_data['bio'] = new_bio
-                all_users_data['users'][current_user_idx] = user_data
-                save_users(all_users_data)
+                update_user(user_data['id'], bio=new_bio)
                 st.success("Biografía guardada")
             
             st.divider()
@@ -897,8 +1193,7 @@ if menu == "Mi Perfil":
                 if col_del.button("🗑️", key=f"del_exp_{i}"):
                     experiences.pop(i)
                     user_data['experience'] = experiences
-                    all_users_data['users'][current_user_idx] = user_data
-                    save_users(all_users_data)
+                    update_user(user_data['id'], experience=experiences)
                     st.rerun()
             
             new_exp = st.text_input("Añadir nueva experiencia")
@@ -906,22 +1201,21 @@ if menu == "Mi Perfil":
                 if new_exp:
                     if 'experience' not in user_data: user_data['experience'] = []
                     user_data['experience'].append(new_exp)
-                    all_users_data['users'][current_user_idx] = user_data
-                    save_users(all_users_data)
+                    update_user(user_data['id'], experience=user_data['experience'])
                     st.rerun()
 
 # Vista: Secuencias e-Learning (Ruta de Aprendizaje - Diseño captura usuario)
 elif menu == "Secuencias e-learning" or menu == "Mi Curso":
     # VERIFICACIÓN DE MATRÍCULA
     # Cargar nombre del curso actual
-    current_course_name = "Curso General"
-    if os.path.exists("course_metadata.json"):
-        with open("course_metadata.json", 'r', encoding='utf-8') as f:
-            meta = json.load(f)
-            current_course_name = meta.get('name', "Curso General")
+    from course_store import course_name, load_course
+    current_course_name = course_name("Curso General")
             
     # Verificar si el alumno tiene acceso (Admin y Tutor siempre tienen acceso)
-    user_courses = st.session_state.user_info.get('enrolled_courses', [])
+    # Se consulta la fila del usuario para ver matrículas hechas tras el login
+    from data_manager import get_user
+    fresh_user = get_user(st.session_state.user_info.get('id'))
+    user_courses = (fresh_user or st.session_state.user_info).get('enrolled_courses', [])
     has_access = (current_course_name in user_courses) or (st.session_state.auth_status in ['admin', 'tutor'])
     
     if not has_access:
@@ -935,20 +1229,30 @@ elif menu == "Secuencias e-learning" or menu == "Mi Curso":
     
     st.markdown("### Ruta de aprendizaje actual")
     
-    # Cargar contenido dinámico del curso
-    COURSE_FILE = "course_content.json"
-    course_content = []
-    if os.path.exists(COURSE_FILE):
-        try:
-            with open(COURSE_FILE, 'r', encoding='utf-8') as f:
-                course_content = json.load(f)
-        except:
-            course_content = []
+    # Contenido del curso: parseado una vez por versión del fichero y compartido entre sesiones
+    course = load_course()
 
-    if not course_content:
+    if not course.blocks:
         st.info("🚧 Este curso aún no tiene contenido estructurado. El profesor está trabajando en ello.")
     else:
-        for idx, block in enumerate(course_content):
+        # Solo se pinta la sección activa (los vídeos e imágenes del resto no se cargan)
+        section_count = len(course.sections)
+        if st.session_state.get('course_section', 0) >= section_count:
+            st.session_state.course_section = 0
+
+        def move_section(step):
+            st.session_state.course_section += step
+
+        nav_prev, nav_select, nav_next = st.columns([1, 4, 1])
+        current = nav_select.selectbox(
+            "Sección", range(section_count), key="course_section", label_visibility="collapsed",
+            format_func=lambda i: f"{i + 1}. {course.sections[i][0]}"
+        )
+        nav_prev.button("◀", key="section_prev", on_click=move_section, args=(-1,), disabled=current == 0, use_container_width=True)
+        nav_next.button("▶", key="section_next", on_click=move_section, args=(1,), disabled=current >= section_count - 1, use_container_width=True)
+        st.progress((current + 1) / section_count, text=f"Sección {current + 1} de {section_count}")
+        
+        for idx, block in course.section_blocks(current):
             # Contenedor visual para cada bloque
             with st.container():
                 if block['type'] == 'editor':
@@ -1043,15 +1347,24 @@ elif menu == "Interfaz Moderna":
     # MOSTRAR MATERIALES PUBLICADOS (Para que el alumno vea el test)
     st.markdown("---")
     st.markdown("### 📂 Materiales y Recursos del Curso")
-    mat_dir = "course_materials"
-    if os.path.exists(mat_dir) and os.listdir(mat_dir):
-        for f_name in os.listdir(mat_dir):
+    # Solo metadatos del manifiesto; el fichero se descarga del servidor de materiales
+    from materials import download_url, get_manifest, human_size
+    material_entries = get_manifest().entries()
+    if material_entries:
+        base_url = materials_url()
+        for entry in material_entries:
             c_icon, c_name, c_dl = st.columns([1, 6, 2])
             c_icon.markdown("📄")
-            c_name.markdown(f"**{f_name}**")
-            file_path = os.path.join(mat_dir, f_name)
-            with open(file_path, "rb") as f:
-                c_dl.download_button("⬇️ Descargar", f, file_name=f_name, key=f"dl_{f_name}")
+            c_name.markdown(f"**{entry['name']}**  \n<span style='font-size: 0.8rem; color: var(--text-muted);'>{human_size(entry['size'])} · {entry['mime']}</span>", unsafe_allow_html=True)
+            ready_key = f"dl_ready_{entry['name']}"
+            if base_url:
+                c_dl.markdown(f"<a href='{download_url(entry, base_url)}' download>⬇️ Descargar</a>", unsafe_allow_html=True)
+            elif st.session_state.get(ready_key):
+                # Sin servidor accesible: el fichero pasa por Streamlit, solo el que se pide
+                with get_manifest().open(entry) as f:
+                    c_dl.download_button("⬇️ Descargar", f.read(), file_name=entry['name'], mime=entry['mime'], key=f"dl_{entry['name']}")
+            else:
+                c_dl.button("📦 Preparar", key=f"prep_{entry['name']}", on_click=st.session_state.__setitem__, args=(ready_key, True))
     else:
         st.info("No hay materiales adicionales disponibles por el momento.")
 
@@ -1066,15 +1379,10 @@ elif (menu == "Gestión Cursos" or menu == "Editor Programa") and st.session_sta
     with tab_ficha:
         st.markdown("### Especificaciones del Curso")
         
-        # Cargar metadatos
-        META_FILE = "course_metadata.json"
+        # Cargar metadatos (copia: el dict de course_store es compartido)
+        from course_store import load_metadata, save_metadata
         default_meta = {"name": "", "code": "", "hours": 0, "modality": "Online", "description": "", "objectives": ""}
-        
-        if os.path.exists(META_FILE):
-            with open(META_FILE, 'r', encoding='utf-8') as f:
-                course_meta = json.load(f)
-        else:
-            course_meta = default_meta
+        course_meta = dict(load_metadata() or default_meta)
             
         with st.form("course_meta_form"):
             c1, c2 = st.columns(2)
@@ -1089,8 +1397,7 @@ elif (menu == "Gestión Cursos" or menu == "Editor Programa") and st.session_sta
             course_meta['objectives'] = st.text_area("Objetivos Pedagógicos", value=course_meta.get('objectives', ''))
             
             if st.form_submit_button("💾 Guardar Ficha Técnica"):
-                with open(META_FILE, 'w', encoding='utf-8') as f:
-                    json.dump(course_meta, f, indent=4, ensure_ascii=False)
+                save_metadata(course_meta)
                 st.success("Ficha técnica actualizada correctamente")
 
     # --- TAB 2: REPOSITORIO DE TEMARIOS ---
@@ -1099,50 +1406,94 @@ elif (menu == "Gestión Cursos" or menu == "Editor Programa") and st.session_sta
         st.info("Sube aquí los archivos PDF, ZIP o documentos grandes que componen el temario oficial del curso.")
         
         # Directorio de materiales
-        MATERIALS_DIR = "course_materials"
-        os.makedirs(MATERIALS_DIR, exist_ok=True)
+        from materials import get_manifest, human_size
+        from uploads import MAX_FILE_BYTES, UploadError, issue_upload_token, quota_usage, store_file, uploader_html
         
-        # Uploader
-        uploaded_materials = st.file_uploader("Arrastra tus archivos aquí", accept_multiple_files=True)
-        if uploaded_materials:
-            for u_file in uploaded_materials:
-                file_path = os.path.join(MATERIALS_DIR, u_file.name)
-                with open(file_path, "wb") as f:
-                    f.write(u_file.getbuffer())
-            st.success(f"✅ {len(uploaded_materials)} archivos subidos correctamente.")
+        base_url = materials_url()
+        if base_url:
+            # Uploader: el navegador envía el fichero por trozos al servidor de materiales
+            # (no pasa por la memoria de Streamlit y se puede reanudar si se corta)
+            import streamlit.components.v1 as components
+            components.html(
+                uploader_html(base_url, issue_upload_token(st.session_state.user_info.get('id', ''))),
+                height=180, scrolling=True
+            )
+        else:
+            # Servidor de materiales no accesible (app en HTTPS sin MATERIALS_PUBLIC_URL, solo localhost...)
+            upload_round = st.session_state.get('materials_upload_round', 0)
+            uploaded_materials = st.file_uploader("Arrastra tus archivos aquí", accept_multiple_files=True, key=f"materials_upload_{upload_round}")
+            if uploaded_materials:
+                try:
+                    for u_file in uploaded_materials:
+                        store_file(u_file.name, u_file, u_file.size)
+                except UploadError as e:
+                    st.error(str(e))
+                else:
+                    # Nueva clave: el uploader se vacía y no se vuelven a guardar en el siguiente rerun
+                    st.session_state.materials_upload_round = upload_round + 1
+                    st.success(f"✅ {len(uploaded_materials)} archivos subidos correctamente.")
+        usage = quota_usage()
+        st.progress(
+            min(1.0, (usage['used'] + usage['reserved']) / usage['quota']),
+            text=f"Espacio usado: {human_size(usage['used'])} de {human_size(usage['quota'])}"
+                 + (f" (+{human_size(usage['reserved'])} en subidas pendientes)" if usage['reserved'] else "")
+                 + f" · máximo por archivo: {human_size(MAX_FILE_BYTES)}"
+        )
+        # También incorpora ya los ficheros copiados a mano en course_materials (sin esperar al escaneo)
+        st.button("🔄 Actualizar lista", key="refresh_materials", on_click=get_manifest().ingest_loose)
         
         st.divider()
         st.markdown("#### 📑 Archivos Disponibles")
         
-        files = os.listdir(MATERIALS_DIR)
-        if not files:
+        material_entries = get_manifest().entries()
+        if not material_entries:
             st.caption("No hay archivos subidos aún.")
         else:
-            for f_name in files:
+            # Nombres que comparten contenido (se guardan una sola vez)
+            same_content = {}
+            for entry in material_entries:
+                same_content.setdefault(entry['sha256'], []).append(entry['name'])
+            for entry in material_entries:
+                f_name = entry['name']
                 col_f1, col_f2, col_f3 = st.columns([1, 4, 1])
                 col_f1.markdown("📄")
-                col_f2.markdown(f"**{f_name}**")
+                badges = ""
+                if entry['compressed']:
+                    badges += f" · 🗜️ {human_size(entry['stored'])} en disco"
+                others = [n for n in same_content[entry['sha256']] if n != f_name]
+                if others:
+                    badges += f" · 🔗 mismo contenido que {', '.join(others)}"
+                col_f2.markdown(f"**{f_name}** · {human_size(entry['size'])}{badges}")
                 
-                f_path = os.path.join(MATERIALS_DIR, f_name)
                 if col_f3.button("🗑️", key=f"del_mat_{f_name}"):
-                    os.remove(f_path)
+                    get_manifest().remove(f_name)
+                    get_manifest().collect_garbage()
                     st.rerun()
+            
+            with st.expander("💾 Almacenamiento"):
+                storage = get_manifest().report()
+                c_st1, c_st2, c_st3, c_st4 = st.columns(4)
+                c_st1.metric("Archivos", storage['files'], f"{storage['blobs']} únicos", delta_color="off")
+                c_st2.metric("En disco", human_size(storage['stored_bytes']), f"de {human_size(storage['logical_bytes'])}", delta_color="off")
+                c_st3.metric("Ahorro por duplicados", human_size(storage['saved_dedup']))
+                c_st4.metric("Ahorro por compresión", human_size(storage['saved_compression']), f"{storage['compressed']} comprimidos", delta_color="off")
+                if st.button("🧹 Liberar espacio", help="Borra del disco los contenidos que ya no usa ningún archivo"):
+                    removed, freed = get_manifest().collect_garbage()
+                    st.success(f"{removed} contenidos borrados ({human_size(freed)} liberados)")
 
     # --- TAB 3: EDITOR DE CONTENIDOS (Lo que ya tenías) ---
     with tab_editor:
         st.markdown("### 🛠️ Constructor de Secuencias Didácticas")
     
     # Archivo de persistencia
-    COURSE_FILE = "course_content.json"
+    from course_store import CourseConflict, get_block_store, load_course, save_course
     
-    # Cargar contenido existente o iniciar vacío
+    # Cargar la última versión (copia editable) o iniciar con un bloque de bienvenida
     if 'editor_course_content' not in st.session_state:
-        if os.path.exists(COURSE_FILE):
-            try:
-                with open(COURSE_FILE, 'r', encoding='utf-8') as f:
-                    st.session_state.editor_course_content = json.load(f)
-            except:
-                st.session_state.editor_course_content = []
+        base_course = load_course()
+        st.session_state.editor_base_version = base_course.version
+        if base_course.blocks:
+            st.session_state.editor_course_content = [dict(b) for b in base_course.blocks]
         else:
             st.session_state.editor_course_content = [
                 {"type": "editor", "title": "Bienvenida", "content": "Bienvenido al curso. Edita este texto."}
@@ -1151,13 +1502,29 @@ elif (menu == "Gestión Cursos" or menu == "Editor Programa") and st.session_sta
     # Barra de Acciones Superior
     col_info, col_actions = st.columns([2, 2])
     with col_info:
-        st.caption(f"Editando: {len(st.session_state.editor_course_content)} bloques")
+        # El número de bloques lo muestra el fragmento del editor (cambia sin rerun completo)
+        st.caption(f"Versión {st.session_state.editor_base_version}")
     with col_actions:
         c_save, c_export, c_clear = st.columns([2, 2, 1])
         if c_save.button("💾 Guardar Cambios", type="primary", use_container_width=True):
-            with open(COURSE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(st.session_state.editor_course_content, f, indent=4, ensure_ascii=False)
-            st.success("✅ Curso guardado correctamente")
+            # Solo se guardan los bloques modificados; si otra persona ha guardado entretanto
+            # cambios en los mismos bloques, se avisa en lugar de sobrescribirlos
+            try:
+                new_version, changes = save_course(
+                    st.session_state.editor_base_version,
+                    st.session_state.editor_course_content,
+                    author=st.session_state.user_info.get('name', '')
+                )
+                if changes:
+                    latest = load_course()
+                    st.session_state.editor_base_version = latest.version
+                    st.session_state.editor_course_content = [dict(b) for b in latest.blocks]
+                    st.success(f"✅ Curso guardado (versión {latest.version}, {changes} cambios)")
+                else:
+                    st.info("No hay cambios que guardar")
+            except CourseConflict as e:
+                st.session_state.editor_conflict = e.blocks
+                st.error(f"⚠️ {e}. Recarga la última versión para no sobrescribir su trabajo.")
 
         # Funcionalidad de Exportar a Markdown (Nueva)
         if c_export.button("📥 Exportar MD", use_container_width=True, help="Descargar curso en formato Markdown"):
@@ -1184,144 +1551,268 @@ elif (menu == "Gestión Cursos" or menu == "Editor Programa") and st.session_sta
             st.session_state.editor_course_content = []
             st.rerun()
 
+    if st.session_state.get('editor_conflict'):
+        if st.button("🔄 Cargar la última versión (descarta tus cambios sin guardar)"):
+            latest = load_course()
+            st.session_state.editor_base_version = latest.version
+            st.session_state.editor_course_content = [dict(b) for b in latest.blocks]
+            st.session_state.editor_conflict = None
+            st.rerun()
+
+    with st.expander("🕘 Historial de versiones"):
+        for entry in get_block_store().history():
+            st.caption(f"v{entry['version']} · {datetime.fromtimestamp(entry['created']).strftime('%d/%m/%Y %H:%M')} · {entry['author'] or 'anónimo'} · {entry['changes']} cambios")
+
     st.markdown("---")
 
     # ÁREA DE EDICIÓN PRINCIPAL
-    indices_to_remove = []
+    # Lista compacta (una línea por bloque, por ventanas) y widgets completos solo para
+    # el bloque activo. Todo va en un fragmento: editar, mover o insertar solo vuelve a
+    # ejecutar esta zona y su coste no depende del número de bloques del curso.
+    import uuid
+    EDITOR_WINDOW = 25
+    BLOCK_ICONS = {"editor": "📝", "accordion": "📂", "video": "🎥", "image": "🖼️", "quiz": "❓"}
+    NEW_BLOCKS = {
+        "editor": ("📝 Texto", {"type": "editor", "title": "Nuevo Texto", "content": ""}),
+        "accordion": ("📂 Acordeón", {"type": "accordion", "title": "Desplegable", "items": ["Elemento 1", "Elemento 2"]}),
+        "video": ("🎥 Video", {"type": "video", "title": "Video", "url": ""}),
+        "image": ("🖼️ Imagen", {"type": "image", "title": "Imagen", "url": ""}),
+        "quiz": ("❓ Test", {"type": "quiz", "title": "Evaluación", "question": "¿...?", "options": ["Sí", "No"], "correct": "Sí"}),
+    }
     
-    for idx, block in enumerate(st.session_state.editor_course_content):
-        with st.container():
-            # Cabecera del bloque
-            c_head, c_del = st.columns([6, 1])
-            with c_head:
-                # Icono según tipo
-                icons = {"editor": "📝", "accordion": "📂", "video": "🎥", "image": "🖼️", "quiz": "❓"}
-                icon = icons.get(block['type'], "📄")
-                
-                new_title = st.text_input(f"Título (Bloque {idx+1})", value=block.get('title', ''), key=f"title_{idx}", label_visibility="collapsed")
-                block['title'] = new_title
-            with c_del:
-                if st.button("❌", key=f"del_{idx}", help="Eliminar bloque"):
-                    indices_to_remove.append(idx)
-            
-            # Contenido Editable según tipo
-            if block['type'] == "editor":
-                st.caption(f"{icon} Editor de Texto")
-                block['content'] = st.text_area("Contenido", block.get('content', ''), key=f"content_{idx}", height=150)
-                
-                # Botón IA
-                if st.button("✨ Mejorar con IA", key=f"ai_{idx}"):
-                    if st.session_state.tutor:
-                        with st.spinner("Mejorando texto..."):
-                            try:
-                                improved = st.session_state.tutor._generate_response(f"Mejora este texto educativo para que sea más claro y profesional:\n\n{block['content']}")
-                                block['content'] = improved
-                                st.rerun()
-                            except Exception as e:
-                                st.error(f"Error IA: {e}")
-                
-            elif block['type'] == "accordion":
-                st.caption(f"{icon} Lista Desplegable")
-                items_text = "\n".join(block.get('items', []))
-                new_items = st.text_area("Items (uno por línea)", items_text, key=f"acc_{idx}")
-                block['items'] = new_items.split('\n')
-            
-            elif block['type'] == "video":
-                st.caption(f"{icon} Reproductor de Video")
-                block['url'] = st.text_input("URL del Video (YouTube)", block.get('url', ''), key=f"vid_{idx}")
-                if block['url']:
-                    st.video(block['url'])
-            
-            elif block['type'] == "image":
-                st.caption(f"{icon} Visor de Imagen")
-                block['url'] = st.text_input("URL de la Imagen", block.get('url', ''), key=f"img_{idx}")
-                if block['url']:
-                    st.image(block['url'], width=300)
-            
-            elif block['type'] == "quiz":
-                st.caption(f"{icon} Pregunta de Test")
-                block['question'] = st.text_input("Pregunta", block.get('question', ''), key=f"q_{idx}")
-                opts_text = "\n".join(block.get('options', []))
-                new_opts = st.text_area("Opciones (una por línea)", opts_text, key=f"qo_{idx}")
-                block['options'] = new_opts.split('\n')
-                if block['options']:
-                    block['correct'] = st.selectbox("Respuesta Correcta", block['options'], key=f"qc_{idx}")
-
-    # Eliminar bloques marcados
-    if indices_to_remove:
-        for i in sorted(indices_to_remove, reverse=True):
-            st.session_state.editor_course_content.pop(i)
-        st.rerun()
-
-    # BARRA DE HERRAMIENTAS FUNCIONAL
-    st.markdown("### ➕ Añadir Contenido")
+    blocks = st.session_state.editor_course_content
+    for block in blocks:
+        if 'id' not in block:
+            block['id'] = uuid.uuid4().hex[:12]
+    st.session_state.setdefault('editor_active', None)
+    st.session_state.setdefault('editor_window', 0)
     
-    b1, b2, b3, b4, b5 = st.columns(5)
+    def block_position(block_id):
+        return next((i for i, b in enumerate(blocks) if b['id'] == block_id), None)
     
-    if b1.button(" Texto", use_container_width=True):
-        st.session_state.editor_course_content.append({"type": "editor", "title": "Nuevo Texto", "content": ""})
-        st.rerun()
+    def show_block(pos):
+        # Ajusta la ventana para que el bloque quede visible
+        if not st.session_state.editor_window <= pos < st.session_state.editor_window + EDITOR_WINDOW:
+            st.session_state.editor_window = max(0, pos - EDITOR_WINDOW // 2)
+    
+    def set_window(start):
+        st.session_state.editor_window = max(0, start)
+    
+    def select_block(block_id):
+        st.session_state.editor_active = None if st.session_state.editor_active == block_id else block_id
+    
+    def move_block(pos, step):
+        target = pos + step
+        if 0 <= target < len(blocks):
+            blocks[pos], blocks[target] = blocks[target], blocks[pos]
+            show_block(target)
+    
+    def remove_block(pos):
+        removed = blocks.pop(pos)
+        if st.session_state.editor_active == removed['id']:
+            st.session_state.editor_active = None
+    
+    def insert_block(kind):
+        # Se inserta tras el bloque activo (o al final) y pasa a editarse
+        block = dict(NEW_BLOCKS[kind][1], id=uuid.uuid4().hex[:12])
+        active = block_position(st.session_state.editor_active)
+        pos = len(blocks) if active is None else active + 1
+        blocks.insert(pos, block)
+        st.session_state.editor_active = block['id']
+        show_block(pos)
+    
+    def improve_block(block, key):
+        # Callback: la mejora va a la cola de trabajos; el resultado se aplica al pintar el bloque
+        if not st.session_state.tutor:
+            return
+        st.session_state[f"ai_job_{key}"] = st.session_state.tutor.submit_job(
+            "generate_response", f"Mejora este texto educativo para que sea más claro y profesional:\n\n{block['content']}",
+            owner=job_owner()
+        )
+    
+    def improvement_job(block, key):
+        # Aplica la mejora terminada antes de crear el text_area; devuelve el trabajo si sigue pendiente
+        from job_queue import PENDING, get_job_queue
+        job_id = st.session_state.get(f"ai_job_{key}")
+        job = get_job_queue().get(job_id) if job_id else None
+        if job is None or job['status'] in PENDING:
+            return job
+        del st.session_state[f"ai_job_{key}"]
+        if job['status'] == 'done':
+            block['content'] = job['result']
+            st.session_state[f"content_{key}"] = job['result']
+        elif job['status'] == 'failed':
+            st.session_state.editor_ai_error = f"Error IA: {job['error']}"
+        return None
+    
+    def render_block_editor(block):
+        # Widgets completos del bloque activo (keys por id: no cambian al mover bloques)
+        key = f"{block['id']}_{st.session_state.editor_base_version}"
+        icon = BLOCK_ICONS.get(block['type'], "📄")
+        block['title'] = st.text_input("Título", value=block.get('title', ''), key=f"title_{key}")
         
-    if b2.button("📂 Acordeón", use_container_width=True):
-        st.session_state.editor_course_content.append({"type": "accordion", "title": "Desplegable", "items": ["Elemento 1", "Elemento 2"]})
-        st.rerun()
+        if block['type'] == "editor":
+            st.caption(f"{icon} Editor de Texto")
+            ai_job = improvement_job(block, key)
+            block['content'] = st.text_area("Contenido", block.get('content', ''), key=f"content_{key}", height=150)
+            
+            # Botón IA (dentro del fragmento del editor no se anidan fragmentos: se comprueba a mano)
+            if ai_job:
+                render_pending_job(ai_job, "Mejorando el texto con IA", auto_refresh=False)
+            else:
+                st.button("✨ Mejorar con IA", key=f"ai_{key}", on_click=improve_block, args=(block, key))
+            if st.session_state.get('editor_ai_error'):
+                st.error(st.session_state.pop('editor_ai_error'))
         
-    if b3.button("🎥 Video", use_container_width=True):
-        st.session_state.editor_course_content.append({"type": "video", "title": "Video", "url": ""})
-        st.rerun()
+        elif block['type'] == "accordion":
+            st.caption(f"{icon} Lista Desplegable")
+            items_text = "\n".join(block.get('items', []))
+            new_items = st.text_area("Items (uno por línea)", items_text, key=f"acc_{key}")
+            block['items'] = new_items.split('\n')
         
-    if b4.button("🖼️ Imagen", use_container_width=True):
-        st.session_state.editor_course_content.append({"type": "image", "title": "Imagen", "url": ""})
-        st.rerun()
+        elif block['type'] == "video":
+            st.caption(f"{icon} Reproductor de Video")
+            block['url'] = st.text_input("URL del Video (YouTube)", block.get('url', ''), key=f"vid_{key}")
+            if block['url']:
+                st.video(block['url'])
         
-    if b5.button("❓ Test", use_container_width=True):
-        st.session_state.editor_course_content.append({"type": "quiz", "title": "Evaluación", "question": "¿...?", "options": ["Sí", "No"], "correct": "Sí"})
-        st.rerun()
+        elif block['type'] == "image":
+            st.caption(f"{icon} Visor de Imagen")
+            block['url'] = st.text_input("URL de la Imagen", block.get('url', ''), key=f"img_{key}")
+            if block['url']:
+                st.image(block['url'], width=300)
+        
+        elif block['type'] == "quiz":
+            st.caption(f"{icon} Pregunta de Test")
+            block['question'] = st.text_input("Pregunta", block.get('question', ''), key=f"q_{key}")
+            opts_text = "\n".join(block.get('options', []))
+            new_opts = st.text_area("Opciones (una por línea)", opts_text, key=f"qo_{key}")
+            block['options'] = new_opts.split('\n')
+            if block['options']:
+                correct = block.get('correct')
+                index = block['options'].index(correct) if correct in block['options'] else 0
+                block['correct'] = st.selectbox("Respuesta Correcta", block['options'], index=index, key=f"qc_{key}")
+    
+    fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
+    
+    @fragment
+    def course_editor():
+        total = len(blocks)
+        start = min(st.session_state.editor_window, max(0, total - 1))
+        end = min(start + EDITOR_WINDOW, total)
+        st.caption(f"Editando: {total} bloques")
+        
+        if total > EDITOR_WINDOW:
+            w1, w2, w3 = st.columns([1, 2, 1])
+            w1.button("◀ Anteriores", key="editor_prev", on_click=set_window, args=(start - EDITOR_WINDOW,), disabled=start == 0, use_container_width=True)
+            w2.caption(f"Bloques {start + 1}–{end} de {total}")
+            w3.button("Siguientes ▶", key="editor_next", on_click=set_window, args=(start + EDITOR_WINDOW,), disabled=end >= total, use_container_width=True)
+        
+        for pos in range(start, end):
+            block = blocks[pos]
+            active = block['id'] == st.session_state.editor_active
+            c_sum, c_edit, c_up, c_down, c_del = st.columns([8, 1, 1, 1, 1])
+            icon = BLOCK_ICONS.get(block['type'], "📄")
+            snippet = " ".join(str(block.get('content') or block.get('question') or block.get('url') or "").split())[:60]
+            c_sum.markdown(f"{'**' if active else ''}{pos + 1}. {icon} {block.get('title') or '(sin título)'}{'**' if active else ''}  \n<span style='color: var(--text-muted); font-size: 0.8rem;'>{snippet}</span>", unsafe_allow_html=True)
+            c_edit.button("✏️" if not active else "✅", key=f"edit_{block['id']}", on_click=select_block, args=(block['id'],), help="Editar / cerrar")
+            c_up.button("⬆️", key=f"up_{block['id']}", on_click=move_block, args=(pos, -1), disabled=pos == 0)
+            c_down.button("⬇️", key=f"down_{block['id']}", on_click=move_block, args=(pos, 1), disabled=pos == total - 1)
+            c_del.button("❌", key=f"del_{block['id']}", on_click=remove_block, args=(pos,), help="Eliminar bloque")
+            if active:
+                with st.container():
+                    render_block_editor(block)
+        
+        # BARRA DE HERRAMIENTAS FUNCIONAL
+        st.markdown("### ➕ Añadir Contenido")
+        st.caption("Los bloques nuevos se insertan después del bloque que estás editando.")
+        for col, (kind, (label, _)) in zip(st.columns(len(NEW_BLOCKS)), NEW_BLOCKS.items()):
+            col.button(label, key=f"add_{kind}", on_click=insert_block, args=(kind,), use_container_width=True)
+    
+    course_editor()
 
     # --- TAB 4: ASIGNAR ALUMNOS (NUEVO) ---
     with tab_asignar:
         st.markdown("### 👥 Matriculación de Alumnos")
         
         # Obtener nombre del curso actual
-        curr_course_name = "Curso Sin Nombre"
-        if os.path.exists("course_metadata.json"):
-            with open("course_metadata.json", 'r', encoding='utf-8') as f:
-                curr_course_name = json.load(f).get('name', "Curso Sin Nombre")
+        from course_store import course_name
+        curr_course_name = course_name("Curso Sin Nombre")
         
         st.info(f"Gestionando acceso para: **{curr_course_name}**")
         
-        from data_manager import load_users, toggle_course_enrollment
-        users_db = load_users()['users']
-        students = [u for u in users_db if u['role'] == 'student']
+        from data_manager import query_users, query_user_ids, set_enrollments
         
-        if not students:
-            st.warning("No hay alumnos registrados en la plataforma.")
+        enroll_search = st.text_input("🔍 Filtrar alumnos", key="enroll_search", placeholder="Nombre, email o usuario...")
+        page_size = 50
+        if st.session_state.get("enroll_query") != enroll_search:
+            st.session_state.enroll_query = enroll_search
+            st.session_state.enroll_page = 0
+        students, total_filtered = query_users(enroll_search, role='student', page=st.session_state.enroll_page, page_size=page_size)
+        
+        if not total_filtered:
+            st.warning("No hay alumnos que coincidan." if enroll_search else "No hay alumnos registrados en la plataforma.")
         else:
-            # Crear tabla de asignación
-            st.markdown(f"**Selecciona los alumnos que pueden acceder a este curso:**")
+            # Operaciones sobre todos los alumnos filtrados (una sola transacción)
+            b1, b2 = st.columns(2)
+            if b1.button(f"✅ Matricular a los {total_filtered} filtrados", use_container_width=True):
+                res = set_enrollments((sid, curr_course_name, True) for sid in query_user_ids(enroll_search, role='student'))
+                st.success(f"{res['enrolled']} alumnos matriculados")
+            if b2.button(f"❌ Dar de baja a los {total_filtered} filtrados", use_container_width=True):
+                res = set_enrollments((sid, curr_course_name, False) for sid in query_user_ids(enroll_search, role='student'))
+                st.success(f"{res['unenrolled']} alumnos dados de baja")
             
-            for stu in students:
-                col_check, col_name, col_email = st.columns([1, 3, 3])
-                
-                is_enrolled = curr_course_name in stu.get('enrolled_courses', [])
-                
-                with col_check:
-                    if st.checkbox("", value=is_enrolled, key=f"enroll_{stu['id']}"):
-                        if not is_enrolled:
-                            toggle_course_enrollment(stu['id'], curr_course_name)
-                            st.rerun()
-                    else:
-                        if is_enrolled:
-                            toggle_course_enrollment(stu['id'], curr_course_name)
-                            st.rerun()
+            # Crear tabla de asignación: los cambios se guardan juntos al enviar
+            st.markdown(f"**Selecciona los alumnos que pueden acceder a este curso:**")
+            with st.form(f"enroll_form_{st.session_state.enroll_page}"):
+                select_all = st.checkbox("Seleccionar todos los de esta página")
+                choices = {}
+                for stu in students:
+                    col_check, col_name, col_email = st.columns([1, 3, 3])
+                    is_enrolled = curr_course_name in stu.get('enrolled_courses', [])
+                    with col_check:
+                        choices[stu['id']] = (is_enrolled, st.checkbox("Matricular", value=is_enrolled, key=f"enroll_{stu['id']}_{is_enrolled}", label_visibility="collapsed"))
+                    with col_name:
+                        st.write(f"**{stu['name']}**")
+                    with col_email:
+                        st.caption(stu['email'])
                 
-                with col_name:
-                    st.write(f"**{stu['name']}**")
-                with col_email:
-                    st.caption(stu['email'])
+                if st.form_submit_button("💾 Guardar matrículas", use_container_width=True):
+                    changes = [
+                        (sid, curr_course_name, select_all or checked)
+                        for sid, (was, checked) in choices.items() if (select_all or checked) != was
+                    ]
+                    if changes:
+                        res = set_enrollments(changes)
+                        st.success(f"{res['enrolled']} altas · {res['unenrolled']} bajas")
+                        st.rerun()
             
-            st.divider()
-            st.caption("Nota: Los cambios se guardan automáticamente al marcar/desmarcar.")
+            page_count = max(1, -(-total_filtered // page_size))
+            if page_count > 1:
+                pg1, pg2, pg3 = st.columns([1, 2, 1])
+                if pg1.button("◀ Anterior", key="enroll_prev", disabled=st.session_state.enroll_page == 0, use_container_width=True):
+                    st.session_state.enroll_page -= 1
+                    st.rerun()
+                pg2.markdown(f"<div style='text-align:center;'>Página {st.session_state.enroll_page + 1} de {page_count}</div>", unsafe_allow_html=True)
+                if pg3.button("Siguiente ▶", key="enroll_next", disabled=st.session_state.enroll_page >= page_count - 1, use_container_width=True):
+                    st.session_state.enroll_page += 1
+                    st.rerun()
+        
+        st.divider()
+        with st.expander("📥 Importar matrículas (CSV / XLSX)"):
+            st.caption("Columnas: `usuario` o `email`, y opcionalmente `curso` (por defecto el actual) y `accion` (alta/baja).")
+            enroll_file = st.file_uploader("Fichero de matrículas", type=["csv", "xlsx"], key="enroll_import")
+            if enroll_file and st.button("Importar matrículas"):
+                from bulk_import import import_enrollments, errors_csv
+                with st.spinner("Importando..."):
+                    report = import_enrollments(enroll_file, enroll_file.name, default_course=curr_course_name)
+                m1, m2, m3, m4 = st.columns(4)
+                m1.metric("Filas", report['rows'])
+                m2.metric("Altas / bajas", f"{report['enrolled']} / {report['unenrolled']}")
+                m3.metric("Errores", len(report['errors']))
+                m4.metric("Filas/s", f"{report['rows_per_second']:.0f}")
+                if report['errors']:
+                    st.download_button("⬇️ Descargar errores", errors_csv(report['errors']), file_name="errores_matriculas.csv", mime="text/csv")
 
 # Vista: Inicio (Dashboard Admin / General)
 elif menu == "Inicio":
@@ -1360,18 +1851,11 @@ elif menu == "Inicio":
     st.markdown("### 🎓 Cursos Destacados")
     
     # Cargar datos del curso real
-    course_name = "Curso General"
-    course_hours = 0
-    course_modality = "Online"
-    if os.path.exists("course_metadata.json"):
-        try:
-            with open("course_metadata.json", 'r', encoding='utf-8') as f:
-                meta = json.load(f)
-                course_name = meta.get('name', course_name)
-                course_hours = meta.get('hours', 0)
-                course_modality = meta.get('modality', "Online")
-        except:
-            pass
+    from course_store import load_metadata
+    meta = load_metadata()
+    course_name = meta.get('name', "Curso General")
+    course_hours = meta.get('hours', 0)
+    course_modality = meta.get('modality', "Online")
             
     # Grid de 3 columnas
     col1, col2, col3 = st.columns(3)
@@ -1575,24 +2059,31 @@ elif menu == config['navigation']['sections']['design']:
 elif menu == "Alumnos":
     st.markdown(f"## 👥 Gestión de Estudiantes")
     
-    # Cargar datos reales
-    from data_manager import load_users, add_user, delete_user
-    all_users = load_users()['users']
-    students_data = [u for u in all_users if u['role'] == 'student']
-    
-    st.session_state.students_data = students_data # Sync for display
+    # Cargar datos reales (solo agregados y la página visible)
+    from data_manager import query_users, student_kpis, student_kpis_by, add_user, delete_user
+    course_kpis = student_kpis_by('course')
+    cohort_kpis = student_kpis_by('cohort')
+    kpi_scopes = ["Todos los alumnos"] + [f"Curso: {c}" for c in course_kpis] + [f"Cohorte: {c or 'Sin cohorte'}" for c in cohort_kpis]
+    kpi_scope = st.selectbox("Indicadores de", kpi_scopes, key="kpi_scope")
+    if kpi_scope.startswith("Curso: "):
+        kpis = course_kpis[kpi_scope[len("Curso: "):]]
+    elif kpi_scope.startswith("Cohorte: "):
+        cohort_key = kpi_scope[len("Cohorte: "):]
+        kpis = cohort_kpis[cohort_key if cohort_key != 'Sin cohorte' else '']
+    else:
+        kpis = student_kpis()
 
     # KPIs Superiores
     kpi1, kpi2, kpi3 = st.columns(3)
     with kpi1:
         st.markdown(f"""
         <div class='progress-widget'>
-            <div style='color:var(--primary); font-size:2rem; font-weight:700;'>{len(students_data)}</div>
+            <div style='color:var(--primary); font-size:2rem; font-weight:700;'>{kpis['total']}</div>
             <div style='font-size:0.9rem; color:var(--text-muted);'>Total Alumnos</div>
         </div>
         """, unsafe_allow_html=True)
     with kpi2:
-        active_count = sum(1 for s in students_data if s['status'] == 'Activo')
+        active_count = kpis['active']
         st.markdown(f"""
         <div class='progress-widget'>
             <div style='color:#10b981; font-size:2rem; font-weight:700;'>{active_count}</div>
@@ -1600,9 +2091,7 @@ elif menu == "Alumnos":
         </div>
         """, unsafe_allow_html=True)
     with kpi3:
-        avg_progress = 0
-        if len(students_data) > 0:
-            avg_progress = sum(s['progress'] for s in students_data) / len(students_data)
+        avg_progress = kpis['avg_progress']
         
         st.markdown(f"""
         <div class='progress-widget'>
@@ -1611,6 +2100,16 @@ elif menu == "Alumnos":
         </div>
         """, unsafe_allow_html=True)
 
+    with st.expander("📊 Desglose por curso y cohorte"):
+        bd1, bd2 = st.columns(2)
+        for col, title, rows in ((bd1, "Curso", course_kpis), (bd2, "Cohorte", cohort_kpis)):
+            with col:
+                st.dataframe(
+                    [{title: key or "Sin cohorte", "Alumnos": k['total'], "Activos": k['active'],
+                      "Progreso medio": f"{k['avg_progress']:.0f}%"} for key, k in rows.items()],
+                    hide_index=True, use_container_width=True
+                )
+
     # Barra de Herramientas + Añadir
     st.markdown("### Listado de Clase")
     
@@ -1625,15 +2124,66 @@ elif menu == "Alumnos":
             
             if st.form_submit_button("Guardar Alumno"):
                 if new_name and new_user and new_email:
-                    add_user(new_user, new_pass, new_name, new_email, role='student')
-                    st.success("Alumno creado correctamente")
-                    st.rerun()
+                    if add_user(new_user, new_pass, new_name, new_email, role='student'):
+                        st.success("Alumno creado correctamente")
+                        st.rerun()
+                    else:
+                        st.error("Ese nombre de usuario ya existe")
                 else:
                     st.error("Rellena todos los campos")
 
-    tb_col1, tb_col2 = st.columns([3, 1])
+    with st.expander("📥 Importar alumnos (CSV / JSON-lines)", expanded=False):
+        st.caption("Columnas: `nombre`, `usuario`, `email` y opcionalmente `contraseña`, `rol` y `cohorte`.")
+        students_file = st.file_uploader("Fichero de alumnos", type=["csv", "jsonl", "ndjson"], key="students_import")
+        imp1, imp2 = st.columns(2)
+        import_password = imp1.text_input("Contraseña común (vacío = aleatoria por alumno)", type="password", key="import_password")
+        import_cohort = imp2.text_input("Cohorte (vacío = mes actual)", key="import_cohort")
+        if students_file and st.button("Importar alumnos"):
+            from bulk_import import import_students, errors_csv
+            hash_bar = st.progress(0.0, text="Validando y protegiendo contraseñas...")
+            report = import_students(
+                students_file, students_file.name, default_password=import_password or None, cohort=import_cohort or None,
+                progress=lambda done, total: hash_bar.progress(done / total, text=f"Contraseñas {done}/{total}")
+            )
+            hash_bar.empty()
+            m1, m2, m3, m4 = st.columns(4)
+            m1.metric("Filas", report['rows'])
+            m2.metric("Creados", report['created'])
+            m3.metric("Errores", len(report['errors']))
+            m4.metric("Filas/s", f"{report['rows_per_second']:.0f}")
+            # Se guardan en la sesión: descargar los errores recarga la página y no deben perderse
+            st.session_state.import_credentials = report['credentials']
+            if report['errors']:
+                st.download_button("⬇️ Descargar errores", errors_csv(report['errors']), file_name="errores_alumnos.csv", mime="text/csv")
+        if st.session_state.get("import_credentials"):
+            from bulk_import import credentials_csv
+            st.warning("Se han generado contraseñas aleatorias: descárgalas y entrégalas, no se guardan en claro.")
+            st.download_button("⬇️ Descargar contraseñas", credentials_csv(st.session_state.import_credentials), file_name="credenciales_alumnos.csv", mime="text/csv")
+
+    sort_options = {"Nombre": "name", "Progreso": "progress", "Estado": "status", "Último acceso": "last_access"}
+    tb_col1, tb_col2, tb_col3 = st.columns([3, 1, 1])
     with tb_col1:
-        search = st.text_input("🔍 Buscar...", key="student_search", label_visibility="collapsed", placeholder="Buscar estudiante...")
+        search = st.text_input("🔍 Buscar...", key="student_search", label_visibility="collapsed", placeholder="Buscar por nombre, email o usuario...")
+    with tb_col2:
+        sort_label = st.selectbox("Ordenar por", list(sort_options), key="student_sort", label_visibility="collapsed")
+    with tb_col3:
+        descending = st.toggle("Descendente", key="student_desc")
+
+    # Paginación: solo se consulta y se pinta la página visible
+    page_size = 25
+    query_key = (search, sort_label, descending)
+    if st.session_state.get("student_query") != query_key:
+        st.session_state.student_query = query_key
+        st.session_state.student_page = 0
+    page_students, total_students = query_users(
+        search, role='student', sort=sort_options[sort_label], descending=descending,
+        page=st.session_state.student_page, page_size=page_size
+    )
+    page_count = max(1, -(-total_students // page_size))
+    if st.session_state.student_page >= page_count:
+        # La última página se ha quedado vacía (p. ej. tras eliminar alumnos)
+        st.session_state.student_page = page_count - 1
+        st.rerun()
     
     # Tabla de Alumnos
     st.divider()
@@ -1644,45 +2194,53 @@ elif menu == "Alumnos":
     h_c4.markdown("**Acciones**")
     st.divider()
 
-    for student in students_data:
-        if not search or search.lower() in student['name'].lower() or student['email'] and search.lower() in student['email'].lower():
-            r_c1, r_c2, r_c3, r_c4 = st.columns([3, 2, 2, 1])
-            
-            with r_c1:
-                st.markdown(f"""
-                <div style='display: flex; align-items: center; margin-bottom: 10px;'>
-                    <div class='student-avatar'>{student['name'][0]}</div>
-                    <div style='margin-left: 10px;'>
-                        <div style='font-weight: 600; color: var(--text-main);'>{student['name']}</div>
-                        <div style='font-size: 0.8rem; color: var(--text-muted);'>{student.get('email', '')}</div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-            
-            with r_c2:
-                prog = student.get('progress', 0)
-                st.progress(prog / 100)
-                st.caption(f"{prog}% Completado")
-            
-            with r_c3:
-                status = student.get('status', 'Inactivo')
-                status_color = "#10b981" if status == "Activo" else "#ef4444"
-                last_acc = student.get('last_access', 'Nunca')
-                
-                st.markdown(f"""
-                <div>
-                    <span class='status-badge' style='background: {status_color}20; color: {status_color}; border: 1px solid {status_color}40;'>● {status}</span>
-                    <div style='font-size: 0.75rem; color: var(--text-muted); margin-top: 4px;'>{last_acc}</div>
+    for student in page_students:
+        r_c1, r_c2, r_c3, r_c4 = st.columns([3, 2, 2, 1])
+        
+        with r_c1:
+            st.markdown(f"""
+            <div style='display: flex; align-items: center; margin-bottom: 10px;'>
+                <div class='student-avatar'>{student['name'][0]}</div>
+                <div style='margin-left: 10px;'>
+                    <div style='font-weight: 600; color: var(--text-main);'>{student['name']}</div>
+                    <div style='font-size: 0.8rem; color: var(--text-muted);'>{student.get('email', '')}</div>
                 </div>
-                """, unsafe_allow_html=True)
-            
-            with r_c4:
-                # Delete functionality
-                if st.button("🗑️", key=f"del_{student['id']}", help="Eliminar Alumno"):
-                    delete_user(student['id'])
-                    st.rerun()
+            </div>
+            """, unsafe_allow_html=True)
+        
+        with r_c2:
+            prog = student.get('progress', 0)
+            st.progress(prog / 100)
+            st.caption(f"{prog}% Completado")
+        
+        with r_c3:
+            status = student.get('status', 'Inactivo')
+            status_color = "#10b981" if status == "Activo" else "#ef4444"
+            last_acc = student.get('last_access', 'Nunca')
             
-            st.markdown("<div style='height: 1px; background: var(--border); margin: 5px 0 15px 0;'></div>", unsafe_allow_html=True)
+            st.markdown(f"""
+            <div>
+                <span class='status-badge' style='background: {status_color}20; color: {status_color}; border: 1px solid {status_color}40;'>● {status}</span>
+                <div style='font-size: 0.75rem; color: var(--text-muted); margin-top: 4px;'>{last_acc}</div>
+            </div>
+            """, unsafe_allow_html=True)
+        
+        with r_c4:
+            # Delete functionality
+            if st.button("🗑️", key=f"del_{student['id']}", help="Eliminar Alumno"):
+                delete_user(student['id'])
+                st.rerun()
+        
+        st.markdown("<div style='height: 1px; background: var(--border); margin: 5px 0 15px 0;'></div>", unsafe_allow_html=True)
+
+    pg1, pg2, pg3 = st.columns([1, 2, 1])
+    if pg1.button("◀ Anterior", disabled=st.session_state.student_page == 0, use_container_width=True):
+        st.session_state.student_page -= 1
+        st.rerun()
+    pg2.markdown(f"<div style='text-align:center;'>Página {st.session_state.student_page + 1} de {page_count} · {total_students} alumnos</div>", unsafe_allow_html=True)
+    if pg3.button("Siguiente ▶", disabled=st.session_state.student_page >= page_count - 1, use_container_width=True):
+        st.session_state.student_page += 1
+        st.rerun()
 
 # Lógica de ruteo para Configuración (Admin Panel)
 elif menu == "Configuración":
@@ -0,0 +1,385 @@
+"""Pool de motores AITutor compartido por todas las sesiones del proceso.
+
+Cada sesión de Streamlit recibe un TutorHandle ligero (modelo elegido,
+historial de chat acotado) que delega en un motor compartido, identificado por
+(proveedor, modelo, huella de credenciales). Todas las llamadas al
+proveedor pasan por su control de admisión (admission.py), que puede
+desviarlas al motor de un proveedor o modelo de respaldo.
+
+Las llamadas largas (tests, trabajos, "Mejorar con IA") se pueden enviar a
+la cola de trabajos (job_queue.py) con submit_job(); el worker las ejecuta
+con run_tutor_job() sobre un motor del mismo pool.
+"""
+import hashlib
+import os
+import sys
+import threading
+import time
+
+# Segundos sin uso tras los que un motor se descarta
+IDLE_TTL_SECONDS = int(os.getenv("TUTOR_POOL_IDLE_TTL", "1800"))
+# Número máximo de motores vivos a la vez (se descarta el menos usado)
+MAX_ENGINES = int(os.getenv("TUTOR_POOL_MAX_ENGINES", "8"))
+
+# Variables de entorno que cada proveedor lee además de la api_key explícita
+PROVIDER_ENV_KEYS = {
+    "gemini": ("GOOGLE_API_KEY",),
+    "openai": ("OPENAI_API_KEY",),
+    "mistral": ("MISTRAL_API_KEY",),
+    "ollama": ("OLLAMA_API_HOST",),
+}
+
+
+def credentials_fingerprint(provider, api_key):
+    # Nunca guardamos la clave en claro como parte de la clave del pool
+    h = hashlib.sha256()
+    h.update((api_key or "").encode("utf-8"))
+    for var in PROVIDER_ENV_KEYS.get(provider, ()):
+        h.update(b"\0")
+        h.update(os.getenv(var, "").encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def default_factory(api_key, provider, model_name):
+    from ai_tutor import AITutor
+    return AITutor(api_key, provider=provider, model_name=model_name)
+
+
+def approx_size(obj, _seen=None, _depth=0):
+    # Estimación aproximada de memoria (recorre contenedores y atributos)
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen or _depth > 6:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, (str, bytes, bytearray, int, float, bool)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += approx_size(k, _seen, _depth + 1) + approx_size(v, _seen, _depth + 1)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += approx_size(item, _seen, _depth + 1)
+    elif hasattr(obj, "__dict__"):
+        size += approx_size(vars(obj), _seen, _depth + 1)
+    return size
+
+
+class TutorEngine:
+    def __init__(self, key, tutor):
+        self.key = key
+        self.tutor = tutor
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.evicted = False
+
+    def touch(self):
+        self.last_used = time.time()
+
+
+class TutorPool:
+    def __init__(self, factory=None, idle_ttl=IDLE_TTL_SECONDS, max_engines=MAX_ENGINES):
+        self._factory = factory or default_factory
+        self.idle_ttl = idle_ttl
+        self.max_engines = max_engines
+        self._engines = {}
+        self._lock = threading.Lock()
+        # Un lock por clave para que cien sesiones simultáneas construyan un solo motor
+        self._build_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, provider, model_name, api_key):
+        key = (provider, model_name, credentials_fingerprint(provider, api_key))
+        with self._lock:
+            self._evict_idle()
+            engine = self._engines.get(key)
+            if engine is not None:
+                self.hits += 1
+                engine.touch()
+                return engine
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        with build_lock:
+            with self._lock:
+                engine = self._engines.get(key)
+                if engine is not None:
+                    self.hits += 1
+                    engine.touch()
+                    return engine
+                self.misses += 1
+            # La construcción (imports del SDK, cliente del proveedor) va fuera del lock global
+            tutor = self._factory(api_key, provider, model_name)
+            with self._lock:
+                engine = TutorEngine(key, tutor)
+                self._engines[key] = engine
+                self._build_locks.pop(key, None)
+                self._enforce_capacity()
+                return engine
+
+    def _evict(self, key):
+        engine = self._engines.pop(key, None)
+        if engine is not None:
+            engine.evicted = True
+            self.evictions += 1
+
+    def _evict_idle(self):
+        if self.idle_ttl <= 0:
+            return
+        limit = time.time() - self.idle_ttl
+        for key in [k for k, e in self._engines.items() if e.last_used < limit]:
+            self._evict(key)
+
+    def _enforce_capacity(self):
+        while self.max_engines > 0 and len(self._engines) > self.max_engines:
+            oldest = min(self._engines.values(), key=lambda e: e.last_used)
+            self._evict(oldest.key)
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict_idle()
+
+    def clear(self):
+        # Se usa al cambiar las API keys: todas las sesiones recrean su motor
+        with self._lock:
+            for key in list(self._engines):
+                self._evict(key)
+
+    def stats(self):
+        with self._lock:
+            engines = list(self._engines.values())
+            hits, misses, evictions = self.hits, self.misses, self.evictions
+        now = time.time()
+        details = []
+        total_mem = 0
+        for e in engines:
+            mem = approx_size(e.tutor)
+            total_mem += mem
+            details.append({
+                "provider": e.key[0],
+                "model": e.key[1],
+                "idle_seconds": int(now - e.last_used),
+                "approx_memory_bytes": mem,
+            })
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "evictions": evictions,
+            "live_engines": len(engines),
+            "approx_memory_bytes": total_mem,
+            "engines": details,
+        }
+
+
+class TutorHandle:
+    """Estado por sesión; los métodos del tutor se delegan al motor compartido."""
+
+    def __init__(self, pool, provider, model_name, api_key, history=None, owner=""):
+        self._pool = pool
+        self._api_key = api_key
+        # Ámbito de los documentos del tutor (el usuario de la sesión)
+        self.owner = owner
+        self.provider = provider
+        self.model_name = model_name
+        if history is None:
+            from chat_history import ChatHistory
+            history = ChatHistory()
+        self.history = history
+        self.last_ttft = None
+        self._engine = pool.acquire(provider, model_name, api_key)
+
+    @property
+    def engine(self):
+        # Si el pool descartó el motor, se vuelve a pedir uno en lugar de retenerlo
+        if self._engine.evicted:
+            self._engine = self._pool.acquire(self.provider, self.model_name, self._api_key)
+        self._engine.touch()
+        return self._engine
+
+    @property
+    def tutor(self):
+        return self.engine.tutor
+
+    def set_model(self, provider, model_name):
+        # No se toca el motor compartido: se cambia de motor en el pool
+        self.provider = provider
+        self.model_name = model_name
+        self._engine = self._pool.acquire(provider, model_name, self._api_key)
+
+    def ingest_stream(self, stream, file_name, progress=None):
+        from document_ingest import get_document_store, ingest_stream
+        return ingest_stream(get_document_store(), stream, file_name, progress=progress, owner=self.owner)
+
+    def ingest_parallel(self, files, max_workers=None, progress=None):
+        from document_ingest import get_document_store, ingest_parallel
+        return ingest_parallel(get_document_store(), files, max_workers=max_workers, progress=progress, owner=self.owner)
+
+    def _with_document_context(self, prompt):
+        from document_ingest import build_context_prompt, get_document_store
+        store = get_document_store()
+        if not len(store):
+            return prompt
+        return build_context_prompt(prompt, store.search(prompt, owner=self.owner))
+
+    def _build_prompt(self, question):
+        # Contexto de documentos + historial acotado por presupuesto de tokens
+        return self.history.build_prompt(self._with_document_context(question), question=question)
+
+    def _tutor_for(self, provider, model_name):
+        # Motor propio o, si la admisión ha desviado la llamada, el del respaldo
+        if (provider, model_name) == (self.provider, self.model_name):
+            return self.tutor
+        return self._pool.acquire(provider, model_name, self._api_key).tutor
+
+    def _admitted(self, call, deadline=None, cancelled=None):
+        # call(tutor): la llamada espera turno en el proveedor (deadline en time.monotonic());
+        # el deadline limita solo la espera de turno, no la llamada al proveedor.
+        # Devuelve (resultado, (proveedor, modelo) que lo ha servido: el propio o el de respaldo)
+        from admission import call_with_admission
+        return call_with_admission(
+            self.provider, self.model_name, lambda provider, model: call(self._tutor_for(provider, model)),
+            deadline, cancelled
+        )
+
+    def answer_question(self, prompt, deadline=None):
+        prompt = self._build_prompt(prompt)
+        return self._admitted(lambda tutor: tutor.answer_question(prompt), deadline)[0]
+
+    def _cached(self, kind, prompt, params, call, use_cache, deadline=None, cancelled=None):
+        from response_cache import get_response_cache
+        outcome = {}
+
+        def run():
+            result, outcome["served"] = self._admitted(call, deadline, cancelled)
+            return result
+
+        # Si respondió el respaldo, la caché la guarda con su (proveedor, modelo); mientras el
+        # primario está pausado también se buscan las respuestas ya guardadas del respaldo
+        from admission import failover_targets
+        return get_response_cache().cached_call(
+            run, self.provider, self.model_name, kind, prompt, params,
+            use_cache=use_cache, served=lambda: outcome["served"],
+            fallbacks=failover_targets(self.provider, self.model_name) if use_cache else ()
+        )
+
+    def generate_test(self, topic, num_questions, difficulty, use_cache=True, deadline=None, cancelled=None):
+        return self._cached(
+            "generate_test", topic, {"num_questions": num_questions, "difficulty": difficulty},
+            lambda tutor: tutor.generate_test(topic, num_questions, difficulty), use_cache, deadline, cancelled
+        )
+
+    def complete_assignment(self, description, assignment_type, use_cache=True, deadline=None, cancelled=None):
+        return self._cached(
+            "complete_assignment", description, {"type": assignment_type},
+            lambda tutor: tutor.complete_assignment(description, assignment_type), use_cache, deadline, cancelled
+        )
+
+    def _generate_response(self, prompt, use_cache=True, deadline=None, cancelled=None):
+        return self._cached(
+            "generate_response", prompt, None,
+            lambda tutor: tutor._generate_response(prompt), use_cache, deadline, cancelled
+        )
+
+    def submit_job(self, kind, *args, owner="", use_cache=True):
+        # Encola generate_test / complete_assignment / generate_response y devuelve el id.
+        # La API key no se guarda en la tabla, solo su huella: el worker la busca en memoria
+        from job_queue import get_job_queue
+        credentials = credentials_fingerprint(self.provider, self._api_key)
+        with _job_keys_lock:
+            _job_keys[credentials] = self._api_key
+        params = {
+            "provider": self.provider, "model": self.model_name, "args": list(args), "use_cache": use_cache,
+            "credentials": credentials,
+        }
+        return get_job_queue().submit(kind, params, owner=owner)
+
+    def answer_question_stream(self, prompt):
+        # Usa el streaming nativo del tutor si existe; si no, el del proveedor.
+        # Si el stream falla antes del primer token se recurre a answer_question; si lo que
+        # falla es la admisión (proveedor saturado, cancelación), no se vuelve a esperar turno
+        from admission import CallCancelled, ProviderSaturated, admit
+        from llm_stream import record_ttft, stream_completion, timed_stream
+
+        self.last_ttft = None
+        prompt = self._build_prompt(prompt)
+
+        def on_first_token(ttft):
+            self.last_ttft = ttft
+
+        produced = False
+        try:
+            # El turno en el proveedor se mantiene mientras dura el stream
+            with admit(self.provider, self.model_name) as (provider, model_name):
+                native = getattr(self._tutor_for(provider, model_name), "answer_question_stream", None)
+                source = native(prompt) if native else stream_completion(provider, model_name, prompt, self._api_key)
+                for token in timed_stream(source, on_first_token):
+                    produced = True
+                    yield token
+            return
+        except (ProviderSaturated, CallCancelled):
+            raise
+        except Exception:
+            if produced:
+                raise
+
+        start = time.perf_counter()
+        response_obj, _ = self._admitted(lambda tutor: tutor.answer_question(prompt))
+        self.last_ttft = time.perf_counter() - start
+        record_ttft(self.last_ttft)
+        if isinstance(response_obj, dict):
+            if response_obj.get("status") == "error":
+                raise RuntimeError(response_obj.get("answer", str(response_obj)))
+            yield response_obj.get("answer", str(response_obj))
+        else:
+            yield str(response_obj)
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name in ("_pool", "_engine", "_api_key"):
+            raise AttributeError(name)
+        return getattr(self.tutor, name)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_tutor_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = TutorPool()
+        return _pool
+
+
+# Claves de las sesiones que han encolado trabajos, por huella (solo en memoria, nunca en jobs.sqlite3)
+_job_keys = {}
+_job_keys_lock = threading.Lock()
+
+
+def session_api_key():
+    # Clave con la que se crea el TutorHandle de una sesión nueva
+    return os.getenv("GOOGLE_API_KEY") or "dummy_key_for_local_models"
+
+
+def job_api_key(params):
+    # La de la sesión que encoló el trabajo; tras reiniciar la app (ya no está en memoria),
+    # la que tendría una sesión nueva
+    with _job_keys_lock:
+        api_key = _job_keys.get(params.get("credentials"))
+    return api_key if api_key is not None else session_api_key()
+
+
+def run_tutor_job(kind, params, deadline=None, cancelled=None):
+    # Ejecuta un trabajo de la cola con un handle efímero (sin historial de sesión);
+    # deadline y cancelled llegan hasta el control de admisión del proveedor
+    from admission import CallCancelled
+    if cancelled is not None and cancelled():
+        raise CallCancelled("Trabajo cancelado")
+    handle = TutorHandle(get_tutor_pool(), params["provider"], params["model"], job_api_key(params))
+    return getattr(handle, "_generate_response" if kind == "generate_response" else kind)(
+        *params["args"], use_cache=params.get("use_cache", True), deadline=deadline, cancelled=cancelled
+    )
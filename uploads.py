@@ -0,0 +1,318 @@
+"""Subidas por trozos y reanudables al repositorio de temarios.
+
+El navegador parte el fichero en trozos de CHUNK_SIZE y los envía uno a uno
+al servidor de materiales (ver materials.py) con su CRC32. Cada trozo se
+escribe directamente en su posición de un fichero .part en UPLOAD_DIR, sin
+pasar por memoria más que en bloques pequeños; el estado (trozos recibidos)
+se guarda junto a él, así que si la conexión se corta basta con volver a
+elegir el mismo fichero para continuar donde se quedó. Al completarse, el
+fichero pasa de una vez al almacén de materiales (ver Manifest.add).
+
+Las cuotas (tamaño máximo por fichero y total del repositorio, contando las
+subidas en curso) se comprueban al iniciar la subida con el tamaño
+declarado, y cada trozo debe medir exactamente lo esperado.
+"""
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from auth import sign
+from materials import get_manifest
+
+APP_DIR = Path(__file__).parent
+UPLOAD_DIR = APP_DIR / "uploads_tmp"
+CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_MB", "8")) * 1024 * 1024
+MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_MB", "2048")) * 1024 * 1024
+MATERIALS_QUOTA_BYTES = int(os.getenv("MATERIALS_QUOTA_MB", "10240")) * 1024 * 1024
+# Subidas a medias que se descartan tras este tiempo sin actividad
+STALE_UPLOAD_SECONDS = 7 * 24 * 3600
+TOKEN_TTL_SECONDS = 12 * 3600
+READ_BLOCK = 64 * 1024
+
+
+class UploadError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def issue_upload_token(user_id, ttl=TOKEN_TTL_SECONDS):
+    # Como los tokens de sesión, pero solo valen para subir materiales
+    payload = f"upload:{user_id}.{int(time.time() + ttl)}"
+    return f"{payload}.{sign(payload)}"
+
+
+def _check_token(token):
+    try:
+        payload, signature = str(token).rsplit(".", 1)
+        expires = int(payload.rsplit(".", 1)[1])
+    except (ValueError, IndexError):
+        raise UploadError(403, "Token de subida no válido")
+    if not payload.startswith("upload:") or not hmac.compare_digest(signature, sign(payload)):
+        raise UploadError(403, "Token de subida no válido")
+    if expires < time.time():
+        raise UploadError(403, "El token de subida ha caducado; recarga la página")
+    # Usuario dueño del token
+    return payload[len("upload:"):].rsplit(".", 1)[0]
+
+
+def _safe_name(name):
+    name = os.path.basename(str(name).replace("\\", "/")).strip()
+    if not name or name.startswith("."):
+        raise UploadError(400, "Nombre de fichero no válido")
+    return name
+
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _lock_for(upload_id):
+    with _locks_guard:
+        return _locks.setdefault(upload_id, threading.Lock())
+
+
+def _paths(upload_id):
+    if not upload_id.isalnum():
+        raise UploadError(404, "Subida desconocida")
+    return UPLOAD_DIR / f"{upload_id}.part", UPLOAD_DIR / f"{upload_id}.json"
+
+
+def _read_state(upload_id, user_id=None):
+    # Con user_id, solo vale la subida de ese usuario
+    _, state_path = _paths(upload_id)
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        raise UploadError(404, "Subida desconocida")
+    if user_id is not None and state.get("user") != user_id:
+        raise UploadError(404, "Subida desconocida")
+    return state
+
+
+def _write_state(upload_id, state):
+    _, state_path = _paths(upload_id)
+    tmp = state_path.with_suffix(".json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, state_path)
+
+
+def _chunk_count(size, chunk_size):
+    return max(1, -(-size // chunk_size))
+
+
+def _pending_uploads():
+    # Estado de las subidas en curso (descarta las abandonadas)
+    states = {}
+    now = time.time()
+    for state_path in UPLOAD_DIR.glob("*.json"):
+        upload_id = state_path.stem
+        if now - state_path.stat().st_mtime > STALE_UPLOAD_SECONDS:
+            for path in _paths(upload_id):
+                path.unlink(missing_ok=True)
+            continue
+        try:
+            states[upload_id] = _read_state(upload_id)
+        except UploadError:
+            continue
+    return states
+
+
+def quota_usage():
+    # Cuenta el disco ocupado de verdad (tras deduplicar y comprimir)
+    used = get_manifest().report()["stored_bytes"]
+    reserved = sum(s["size"] for s in _pending_uploads().values())
+    return {"used": used, "reserved": reserved, "quota": MATERIALS_QUOTA_BYTES}
+
+
+def store_file(name, stream, size):
+    # Subida directa (st.file_uploader) cuando el navegador no llega al servidor de materiales
+    name = _safe_name(name)
+    size = int(size)
+    if size > MAX_FILE_BYTES:
+        raise UploadError(413, f"El fichero supera el máximo de {MAX_FILE_BYTES // (1024 * 1024)} MB")
+    usage = quota_usage()
+    if usage["used"] + usage["reserved"] + size > MATERIALS_QUOTA_BYTES:
+        raise UploadError(413, "No queda espacio en el repositorio de temarios")
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".direct")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(stream, f, 1024 * 1024)
+        get_manifest().add(name, tmp)
+    finally:
+        Path(tmp).unlink(missing_ok=True)
+    return name
+
+
+def start_upload(token, name, size, modified=0):
+    # Crea o reanuda la subida; el id depende del usuario y del fichero, no de la sesión
+    user_id = _check_token(token)
+    name = _safe_name(name)
+    size = int(size)
+    if size < 0 or size > MAX_FILE_BYTES:
+        raise UploadError(413, f"El fichero supera el máximo de {MAX_FILE_BYTES // (1024 * 1024)} MB")
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    upload_id = hashlib.sha256(f"{user_id}\0{name}\0{size}\0{modified}".encode("utf-8")).hexdigest()[:32]
+    part_path, _ = _paths(upload_id)
+    with _lock_for(upload_id):
+        pending = _pending_uploads()
+        if upload_id in pending:
+            state = pending[upload_id]
+        else:
+            usage = get_manifest().report()["stored_bytes"]
+            usage += sum(s["size"] for s in pending.values())
+            if usage + size > MATERIALS_QUOTA_BYTES:
+                raise UploadError(413, "No queda espacio en el repositorio de temarios")
+            with open(part_path, "wb") as f:
+                f.truncate(size)
+            state = {"user": user_id, "name": name, "size": size, "chunk_size": CHUNK_SIZE, "received": {}}
+            _write_state(upload_id, state)
+    return {
+        "id": upload_id,
+        "chunk_size": state["chunk_size"],
+        "chunks": _chunk_count(state["size"], state["chunk_size"]),
+        "received": sorted(int(i) for i in state["received"]),
+    }
+
+
+def write_chunk(token, upload_id, index, stream, length, crc32):
+    # Copia el cuerpo de la petición a su sitio en el .part comprobando el CRC32.
+    # Todo bajo el lock de la subida: ni dos envíos del mismo trozo ni un
+    # finish_upload a la vez pueden tocar el .part mientras se escribe
+    user_id = _check_token(token)
+    part_path, _ = _paths(upload_id)
+    index = int(index)
+    with _lock_for(upload_id):
+        state = _read_state(upload_id, user_id)
+        chunks = _chunk_count(state["size"], state["chunk_size"])
+        if not 0 <= index < chunks:
+            raise UploadError(400, "Trozo fuera de rango")
+        if str(index) in state["received"]:
+            raise UploadError(409, f"El trozo {index} ya se había recibido")
+        offset = index * state["chunk_size"]
+        expected = min(state["chunk_size"], state["size"] - offset)
+        if int(length) != expected:
+            raise UploadError(400, f"El trozo {index} debe medir {expected} bytes")
+
+        checksum = 0
+        remaining = expected
+        with open(part_path, "r+b") as f:
+            f.seek(offset)
+            while remaining:
+                data = stream.read(min(READ_BLOCK, remaining))
+                if not data:
+                    raise UploadError(400, "Trozo incompleto")
+                checksum = zlib.crc32(data, checksum)
+                f.write(data)
+                remaining -= len(data)
+        if f"{checksum:08x}" != str(crc32).lower().rjust(8, "0"):
+            raise UploadError(422, f"CRC32 incorrecto en el trozo {index}")
+
+        state["received"][str(index)] = f"{checksum:08x}"
+        _write_state(upload_id, state)
+    return len(state["received"]), chunks
+
+
+def finish_upload(token, upload_id):
+    # Pasa el fichero completo al almacén de materiales
+    user_id = _check_token(token)
+    part_path, state_path = _paths(upload_id)
+    with _lock_for(upload_id):
+        state = _read_state(upload_id, user_id)
+        chunks = _chunk_count(state["size"], state["chunk_size"])
+        missing = [i for i in range(chunks) if str(i) not in state["received"]]
+        if missing:
+            raise UploadError(409, f"Faltan {len(missing)} trozos")
+        with open(part_path, "rb") as f:
+            os.fsync(f.fileno())
+        get_manifest().add(state["name"], part_path)
+        state_path.unlink(missing_ok=True)
+    with _locks_guard:
+        _locks.pop(upload_id, None)
+    return state["name"]
+
+
+def upload_status(token, upload_id):
+    state = _read_state(upload_id, _check_token(token))
+    return {
+        "id": upload_id,
+        "chunk_size": state["chunk_size"],
+        "chunks": _chunk_count(state["size"], state["chunk_size"]),
+        "received": sorted(int(i) for i in state["received"]),
+    }
+
+
+_UPLOADER_HTML = """
+<div style="font-family: sans-serif; font-size: 0.9rem;">
+  <input type="file" id="files" multiple>
+  <button id="send">⬆️ Subir</button>
+  <div id="log" style="margin-top: 0.5rem;"></div>
+</div>
+<script>
+const API = __API__, TOKEN = __TOKEN__;
+const TABLE = new Uint32Array(256).map((_, n) => {
+  let c = n;
+  for (let k = 0; k < 8; k++) c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+  return c;
+});
+function crc32(bytes) {
+  let c = 0xFFFFFFFF;
+  for (let i = 0; i < bytes.length; i++) c = TABLE[(c ^ bytes[i]) & 0xFF] ^ (c >>> 8);
+  return ((c ^ 0xFFFFFFFF) >>> 0).toString(16).padStart(8, "0");
+}
+async function call(url, options) {
+  const r = await fetch(url, options);
+  const body = await r.json().catch(() => ({}));
+  if (!r.ok) throw Object.assign(new Error(body.error || r.statusText), {status: r.status});
+  return body;
+}
+async function upload(file, row) {
+  // El id depende de usuario, nombre, tamaño y fecha: volver a elegir el fichero reanuda la subida
+  const s = await call(API + "/uploads", {method: "POST", headers: {"Content-Type": "application/json"},
+    body: JSON.stringify({token: TOKEN, name: file.name, size: file.size, modified: file.lastModified})});
+  const done = new Set(s.received);
+  for (let i = 0; i < s.chunks; i++) {
+    if (done.has(i)) continue;
+    const data = new Uint8Array(await file.slice(i * s.chunk_size, (i + 1) * s.chunk_size).arrayBuffer());
+    const sum = crc32(data);
+    for (let attempt = 0; ; attempt++) {
+      try {
+        await call(`${API}/uploads/${s.id}/${i}?token=${encodeURIComponent(TOKEN)}`,
+          {method: "PUT", headers: {"X-Chunk-CRC32": sum}, body: data});
+        break;
+      } catch (e) {
+        if (e.status === 409) break;  // ya lo tenía (p. ej. reintento tras perder la respuesta)
+        if ((e.status && e.status < 500 && e.status !== 422) || attempt >= 5) throw e;
+        await new Promise(r => setTimeout(r, 1000 * 2 ** attempt));
+      }
+    }
+    done.add(i);
+    row.textContent = `${file.name}: ${Math.floor(100 * done.size / s.chunks)} %`;
+  }
+  await call(`${API}/uploads/${s.id}/complete?token=${encodeURIComponent(TOKEN)}`, {method: "POST"});
+  row.textContent = `✅ ${file.name}`;
+}
+document.getElementById("send").onclick = async () => {
+  for (const file of document.getElementById("files").files) {
+    const row = document.getElementById("log").appendChild(document.createElement("div"));
+    row.textContent = `${file.name}: 0 %`;
+    try { await upload(file, row); } catch (e) { row.textContent = `❌ ${file.name}: ${e.message}`; }
+  }
+};
+</script>
+"""
+
+
+def uploader_html(base_url, token):
+    # Subida desde el navegador: trozo a trozo, con CRC32 y reintentos
+    return _UPLOADER_HTML.replace("__API__", json.dumps(base_url)).replace("__TOKEN__", json.dumps(token))
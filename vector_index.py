@@ -0,0 +1,424 @@
+"""Índice vectorial persistente para la recuperación de documentos del tutor.
+
+Los embeddings viven en una matriz float32 contigua en disco (una fila por
+fragmento) que se abre en modo solo lectura con np.memmap. Las altas son
+appends al final de los ficheros, sin reescribir nada. Las filas nuevas no
+son visibles en las búsquedas hasta que el fichero del que salen se ha
+ingerido entero (register_file); si la ingesta falla a medias, quedan
+ocultas y solo sirven para deduplicar un reintento.
+
+Cada fichero pertenece a los ámbitos (owner: el usuario que lo subió) que lo
+han ingerido, y search()/documents() solo ven los del ámbito pedido, con el
+nombre y la ubicación que le dio ese ámbito. Los embeddings y los ficheros
+se siguen deduplicando entre todos. Lo indexado antes de los ámbitos
+(entradas sin "scopes" y documents.json) sigue visible para todos.
+
+Estructura de cada índice (un subdirectorio por embedder):
+    embeddings.f32   filas float32 de tamaño `dim`
+    offsets.u64      pares (offset, longitud) de cada fragmento en chunks.jsonl
+    chunks.jsonl     texto y metadatos de cada fragmento
+    hashes.u64       hash del texto de cada fragmento (deduplicación)
+    live.u8          1 si la fila pertenece a un fichero ingerido entero
+    files.json       hash de contenido de cada fichero ingerido -> filas, ubicaciones y ámbitos
+    documents.json   nº de fragmentos por documento (solo los anteriores a los ámbitos)
+    dedup_stats.json contadores de aciertos de la caché de deduplicación
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+import numpy as np
+
+INDEX_DIR = Path(os.getenv("TUTOR_INDEX_DIR", Path(__file__).parent / "tutor_index"))
+EMBEDDER = os.getenv("TUTOR_EMBEDDER", "hashing")
+SEARCH_BLOCK_ROWS = 65536
+
+_TOKEN_RE = re.compile(r"\w{2,}", re.UNICODE)
+
+
+def chunk_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def file_hash(stream, block_size=1024 * 1024):
+    # Hash del contenido leyendo por bloques; el stream vuelve a su posición inicial
+    h = hashlib.sha256()
+    pos = stream.tell()
+    for block in iter(lambda: stream.read(block_size), b""):
+        h.update(block)
+    stream.seek(pos)
+    return h.hexdigest()
+
+
+class HashingEmbedder:
+    """Embedding local sin dependencias: hashing de palabras y bigramas."""
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text):
+        words = _TOKEN_RE.findall(text.lower())
+        yield from words
+        for a, b in zip(words, words[1:]):
+            yield f"{a} {b}"
+
+    def embed(self, texts):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+                h = int.from_bytes(digest, "little")
+                out[row, h % self.dim] += 1.0 if (h >> 63) & 1 else -1.0
+        # log(tf) amortigua términos muy repetidos; luego normalización L2
+        np.copysign(np.log1p(np.abs(out)), out, out=out)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+
+class SentenceTransformerEmbedder:
+    """Embedding local con sentence-transformers (opcional, si está instalado)."""
+
+    def __init__(self, model_name=None):
+        from sentence_transformers import SentenceTransformer
+        model_name = model_name or os.getenv("TUTOR_EMBEDDER_MODEL", "paraphrase-multilingual-MiniLM-L12-v2")
+        self._model = SentenceTransformer(model_name)
+        self.dim = self._model.get_sentence_embedding_dimension()
+        self.name = "st-" + re.sub(r"[^\w.-]", "_", model_name)
+
+    def embed(self, texts):
+        vectors = self._model.encode(list(texts), normalize_embeddings=True)
+        return np.asarray(vectors, dtype=np.float32)
+
+
+def make_embedder(kind=EMBEDDER):
+    if kind == "sentence-transformers":
+        try:
+            return SentenceTransformerEmbedder()
+        except ImportError:
+            pass
+    return HashingEmbedder()
+
+
+class VectorIndex:
+    def __init__(self, root=INDEX_DIR, embedder=None):
+        self.embedder = embedder or make_embedder()
+        self.dim = self.embedder.dim
+        self.path = Path(root) / self.embedder.name
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._emb_path = self.path / "embeddings.f32"
+        self._off_path = self.path / "offsets.u64"
+        self._chunks_path = self.path / "chunks.jsonl"
+        self._hash_path = self.path / "hashes.u64"
+        self._live_path = self.path / "live.u8"
+        self._docs_path = self.path / "documents.json"
+        self._files_path = self.path / "files.json"
+        self._stats_path = self.path / "dedup_stats.json"
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._offsets = None
+        self._mapped_rows = 0
+        self._count = self._recover()
+        self._row_by_hash = None
+        self._documents = self._load_json(self._docs_path)
+        self._files = self._load_json(self._files_path)
+        # owner -> (nº de filas, máscara de filas visibles, {fila: (nombre, ubicación)})
+        self._scope_cache = {}
+        self.stats = {"file_hits": 0, "chunk_hits": 0, "bytes_saved": 0}
+        self.stats.update(self._load_json(self._stats_path))
+
+    # -- persistencia -------------------------------------------------------
+
+    def _recover(self):
+        # Tras un corte a mitad de escritura, el nº válido de filas es el mínimo
+        # común de matriz, offsets y fragmentos; lo que sobra se trunca.
+        for p in (self._emb_path, self._off_path, self._chunks_path):
+            p.touch(exist_ok=True)
+        row_bytes = self.dim * 4
+        rows = min(self._emb_path.stat().st_size // row_bytes, self._off_path.stat().st_size // 16)
+        if rows:
+            offsets = np.memmap(self._off_path, dtype=np.uint64, mode="r", shape=(rows, 2))
+            chunks_size = self._chunks_path.stat().st_size
+            while rows and int(offsets[rows - 1, 0] + offsets[rows - 1, 1]) > chunks_size:
+                rows -= 1
+            chunks_end = int(offsets[rows - 1, 0] + offsets[rows - 1, 1]) if rows else 0
+            del offsets
+        else:
+            chunks_end = 0
+        os.truncate(self._emb_path, rows * row_bytes)
+        os.truncate(self._off_path, rows * 16)
+        os.truncate(self._chunks_path, chunks_end)
+        self._recover_hashes(rows)
+        self._recover_live(rows)
+        return rows
+
+    def _recover_live(self, rows):
+        # Índices anteriores a live.u8: todas sus filas estaban ya en las búsquedas
+        if not self._live_path.exists():
+            np.ones(rows, dtype=np.uint8).tofile(self._live_path)
+        have = min(self._live_path.stat().st_size, rows)
+        os.truncate(self._live_path, have)
+        if have < rows:
+            with open(self._live_path, "ab") as f:
+                f.write(bytes(rows - have))
+        self._live = np.fromfile(self._live_path, dtype=np.uint8, count=rows)
+
+    def _recover_hashes(self, rows):
+        # hashes.u64 se puede regenerar desde chunks.jsonl (índices antiguos o cortes)
+        self._hash_path.touch(exist_ok=True)
+        have = min(self._hash_path.stat().st_size // 8, rows)
+        os.truncate(self._hash_path, have * 8)
+        if have == rows:
+            return
+        offsets = np.memmap(self._off_path, dtype=np.uint64, mode="r", shape=(rows, 2))
+        missing = np.empty(rows - have, dtype=np.uint64)
+        with open(self._chunks_path, "rb") as f:
+            for i, row in enumerate(range(have, rows)):
+                f.seek(int(offsets[row, 0]))
+                chunk = json.loads(f.read(int(offsets[row, 1])).decode("utf-8"))
+                missing[i] = chunk_hash(chunk["text"])
+        del offsets
+        with open(self._hash_path, "ab") as f:
+            f.write(missing.tobytes())
+
+    def _load_json(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_json(self, path, data):
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def _hash_rows(self):
+        if self._row_by_hash is None:
+            hashes = np.fromfile(self._hash_path, dtype=np.uint64, count=self._count)
+            self._row_by_hash = {int(h): row for row, h in enumerate(hashes)}
+        return self._row_by_hash
+
+    def _maps(self):
+        # Re-mapear solo cuando el índice ha crecido desde el último mapeo
+        if self._mapped_rows != self._count:
+            if self._count:
+                self._matrix = np.memmap(self._emb_path, dtype=np.float32, mode="r", shape=(self._count, self.dim))
+                self._offsets = np.memmap(self._off_path, dtype=np.uint64, mode="r", shape=(self._count, 2))
+            else:
+                self._matrix = self._offsets = None
+            self._mapped_rows = self._count
+        return self._matrix, self._offsets
+
+    # -- API ---------------------------------------------------------------
+
+    def __len__(self):
+        return self._count
+
+    def _scoped(self, owner):
+        # Filas que puede ver owner y con qué nombre; se recalcula tras cada cambio
+        cached = self._scope_cache.get(owner)
+        if cached is not None and cached[0] == self._count:
+            return cached[1], cached[2]
+        visible = np.zeros(self._count, dtype=bool)
+        referenced = np.zeros(self._count, dtype=bool)
+        labels = {}
+        for entry in self._files.values():
+            rows = np.asarray(entry["rows"], dtype=np.int64)
+            referenced[rows] = True
+            scopes = entry.get("scopes")
+            if scopes is None:
+                visible[rows] = True
+            elif owner in scopes:
+                visible[rows] = True
+                name = scopes[owner][0]
+                for row, location in zip(entry["rows"], entry.get("locations") or []):
+                    labels.setdefault(row, (name, location))
+        # Filas sin fichero: índices anteriores a files.json (públicas)
+        visible |= ~referenced
+        visible &= self._live[:self._count].astype(bool)
+        self._scope_cache[owner] = (self._count, visible, labels)
+        return visible, labels
+
+    def documents(self, owner=""):
+        # Documentos que ve owner: los suyos y los anteriores a los ámbitos
+        with self._lock:
+            docs = dict(self._documents)
+            for entry in self._files.values():
+                for name in (entry.get("scopes") or {}).get(owner, []):
+                    docs[name] = entry["chunks"]
+            return docs
+
+    def dedup_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["files_indexed"] = len(self._files)
+            stats["chunks_stored"] = self._count
+            return stats
+
+    def lookup_file(self, content_hash):
+        with self._lock:
+            entry = self._files.get(content_hash)
+            return dict(entry) if entry else None
+
+    def _add_scope(self, entry, file_name, owner):
+        if file_name not in entry["names"]:
+            entry["names"].append(file_name)
+        scopes = entry.get("scopes")
+        # Las entradas sin ámbitos (anteriores) ya son visibles para todos
+        if scopes is not None and file_name not in scopes.setdefault(owner, []):
+            scopes[owner].append(file_name)
+        self._scope_cache.clear()
+
+    def attach_file(self, content_hash, file_name, owner=""):
+        # Acierto de caché: el fichero ya está indexado, solo se añade al ámbito de owner
+        with self._lock:
+            entry = self._files[content_hash]
+            self._add_scope(entry, file_name, owner)
+            self.stats["file_hits"] += 1
+            self.stats["bytes_saved"] += entry["size"]
+            self._save_json(self._files_path, self._files)
+            self._save_json(self._stats_path, self.stats)
+            return dict(entry)
+
+    def register_file(self, content_hash, file_name, size, rows, owner="", locations=None):
+        # El fichero se ha ingerido entero: sus filas pasan a las búsquedas del ámbito de owner
+        with self._lock:
+            hidden = sorted({row for row in rows if not self._live[row]})
+            if hidden:
+                with open(self._live_path, "r+b") as f:
+                    for row in hidden:
+                        f.seek(row)
+                        f.write(b"\x01")
+                self._live[hidden] = 1
+            entry = self._files.get(content_hash)
+            if entry is None:
+                entry = self._files[content_hash] = {
+                    "names": [], "size": size, "chunks": len(rows), "rows": rows,
+                    "locations": list(locations or []), "scopes": {},
+                }
+            self._add_scope(entry, file_name, owner)
+            self._save_json(self._files_path, self._files)
+
+    def add_chunks(self, chunks):
+        # Devuelve la fila de cada fragmento; los repetidos reutilizan la fila
+        # (y el embedding) ya existente en lugar de añadir una nueva. Las filas
+        # nuevas quedan ocultas hasta register_file().
+        if not chunks:
+            return []
+        hashes = [chunk_hash(c["text"]) for c in chunks]
+        with self._lock:
+            known = self._hash_rows()
+            pending = {}
+            for i, h in enumerate(hashes):
+                if h not in known and h not in pending:
+                    pending[h] = i
+        # Solo se embeben los fragmentos nuevos, y fuera del lock
+        new_idx = list(pending.values())
+        vectors = self.embedder.embed([chunks[i]["text"] for i in new_idx]) if new_idx else None
+        with self._lock:
+            known = self._hash_rows()
+            keep = [j for j, i in enumerate(new_idx) if hashes[i] not in known]
+            fresh = [new_idx[j] for j in keep]
+            if fresh:
+                rows = self._append([chunks[i] for i in fresh], vectors[keep], [hashes[i] for i in fresh])
+                for i, row in zip(fresh, rows):
+                    known[hashes[i]] = row
+            fresh_set = set(fresh)
+            for i, c in enumerate(chunks):
+                if i not in fresh_set:
+                    self.stats["chunk_hits"] += 1
+                    self.stats["bytes_saved"] += len(c["text"].encode("utf-8")) + self.dim * 4
+            if len(fresh) < len(chunks):
+                self._save_json(self._stats_path, self.stats)
+            return [known[h] for h in hashes]
+
+    def _append(self, chunks, vectors, hashes):
+        lines = [(json.dumps(c, ensure_ascii=False) + "\n").encode("utf-8") for c in chunks]
+        start = self._count
+        with open(self._chunks_path, "ab") as f:
+            base = f.tell()
+            f.write(b"".join(lines))
+        offsets = np.empty((len(lines), 2), dtype=np.uint64)
+        pos = base
+        for i, line in enumerate(lines):
+            offsets[i] = (pos, len(line))
+            pos += len(line)
+        with open(self._off_path, "ab") as f:
+            f.write(offsets.tobytes())
+        with open(self._hash_path, "ab") as f:
+            f.write(np.asarray(hashes, dtype=np.uint64).tobytes())
+        with open(self._live_path, "ab") as f:
+            f.write(bytes(len(chunks)))
+        self._live = np.concatenate([self._live, np.zeros(len(chunks), dtype=np.uint8)])
+        # La matriz se escribe la última: una fila solo cuenta si su embedding existe
+        with open(self._emb_path, "ab") as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        self._count += len(chunks)
+        return list(range(start, self._count))
+
+    def add_chunk(self, chunk):
+        return self.add_chunks([chunk])[0]
+
+    def get_chunk(self, row, _offsets=None):
+        offsets = _offsets if _offsets is not None else self._maps()[1]
+        offset, length = int(offsets[row, 0]), int(offsets[row, 1])
+        with open(self._chunks_path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.read(length).decode("utf-8"))
+
+    def search(self, query, k=4, owner=""):
+        with self._lock:
+            matrix, offsets = self._maps()
+            visible, labels = self._scoped(owner) if matrix is not None else (None, None)
+        if matrix is None:
+            return []
+        q = self.embedder.embed([query])[0]
+        n = matrix.shape[0]
+        k = min(k, n)
+        best_scores = np.empty(0, dtype=np.float32)
+        best_rows = np.empty(0, dtype=np.int64)
+        # Producto matriz-vector por bloques para no crear temporales del tamaño del índice
+        for start in range(0, n, SEARCH_BLOCK_ROWS):
+            scores = matrix[start:start + SEARCH_BLOCK_ROWS] @ q
+            # Fuera las filas de otros ámbitos y las de ingestas sin terminar (o fallidas)
+            scores[~visible[start:start + len(scores)]] = 0
+            if len(scores) > k:
+                top = np.argpartition(scores, -k)[-k:]
+            else:
+                top = np.arange(len(scores))
+            best_scores = np.concatenate([best_scores, scores[top]])
+            best_rows = np.concatenate([best_rows, top + start])
+            if len(best_scores) > k:
+                keep = np.argpartition(best_scores, -k)[-k:]
+                best_scores, best_rows = best_scores[keep], best_rows[keep]
+        order = np.argsort(-best_scores)
+        results = []
+        for i in order:
+            if best_scores[i] <= 0:
+                continue
+            row = int(best_rows[i])
+            chunk = self.get_chunk(row, offsets)
+            # Un fragmento compartido lleva el nombre y la ubicación del fichero de este ámbito
+            if row in labels:
+                chunk["source"], chunk["location"] = labels[row]
+            chunk["score"] = float(best_scores[i])
+            results.append(chunk)
+        return results
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_vector_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = VectorIndex()
+        return _index